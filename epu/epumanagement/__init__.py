@@ -4,7 +4,8 @@ from epu.epumanagement.reactor import EPUMReactor
 from epu.epumanagement.doctor import EPUMDoctor
 from epu.epumanagement.decider import EPUMDecider
 from epu.epumanagement.store import EPUMStore, DTSubscribers
-from epu.epumanagement.conf import EPUM_INITIALCONF_EXTERNAL_DECIDE, CONF_IAAS_SITE, EPUM_INITIALCONF_DEFAULT_NEEDY_IAAS, EPUM_INITIALCONF_DEFAULT_NEEDY_IAAS_ALLOC, CONF_IAAS_ALLOCATION
+from epu.epumanagement.conf import EPUM_INITIALCONF_EXTERNAL_DECIDE, EPUM_INITIALCONF_HEARTBEAT_FLUSH, EPUM_INITIALCONF_DECIDE_CONCURRENCY, \
+    EPUM_INITIALCONF_DECIDE_FORCE_INTERVAL, CONF_IAAS_SITE, EPUM_INITIALCONF_DEFAULT_NEEDY_IAAS, EPUM_INITIALCONF_DEFAULT_NEEDY_IAAS_ALLOC, CONF_IAAS_ALLOCATION
 
 import ion.util.ionlog
 
@@ -32,6 +33,12 @@ class EPUManagement(object):
            "_external_decide_invocations": For unit and integration tests only. See use below.
            "needy_default_iaas_site": If register-need does not include IaaS site
            "needy_default_iaas_allocation": If register-need does not include IaaS allocation
+           "heartbeat_flush_interval": If present, seconds between batched writes of the
+               timestamps of heartbeats that do not change instance health.
+           "decide_concurrency": If present, maximum engine calls in flight at once across
+               all EPUs (calls for any one EPU are always serialized).  Default is 1.
+           "decide_force_interval": If present, the decider skips EPUs with no instance, sensor
+               or configuration changes since their last decide until this many seconds pass.
 
 
         NOTE: there are NOT any initial EPU requests in the initial config.  EPUs are either
@@ -74,14 +81,18 @@ class EPUManagement(object):
         # The instance of the EPUManagementService process that hosts a particular EPUMReactor instance
         # might not be configured to receive messages.  But when it is receiving messages, they all go
         # to the EPUMReactor instance.
-        self.reactor = EPUMReactor(self.epum_store, notifier, provisioner_client, epum_client)
+        heartbeat_flush_interval = initial_conf.get(EPUM_INITIALCONF_HEARTBEAT_FLUSH, None)
+        self.reactor = EPUMReactor(self.epum_store, notifier, provisioner_client, epum_client,
+                                   heartbeat_flush_interval=heartbeat_flush_interval)
         
         # The instance of the EPUManagementService process that hosts a particular EPUMDecider instance
         # might not be the elected decider.  When it is the elected decider, its EPUMDecider instance
         # handles that functionality.  When it is not the elected decider, its EPUMDecider instance
         # handles being available in the election.
         self.decider = EPUMDecider(self.epum_store, notifier, provisioner_client, epum_client,
-                                   disable_loop=self._external_decide_mode)
+                                   disable_loop=self._external_decide_mode,
+                                   decide_concurrency=initial_conf.get(EPUM_INITIALCONF_DECIDE_CONCURRENCY),
+                                   decide_force_interval=initial_conf.get(EPUM_INITIALCONF_DECIDE_FORCE_INTERVAL))
 
         # The instance of the EPUManagementService process that hosts a particular EPUMDoctor instance
         # might not be the elected leader.  When it is the elected leader, this EPUMDoctor handles that
@@ -110,6 +121,11 @@ class EPUManagement(object):
 
         self.initialized = True
 
+    def stop(self):
+        """Shut down this worker instance. Queued heartbeat times are written out first
+        """
+        return self.reactor.stop()
+
     @defer.inlineCallbacks
     def _run_decisions(self):
         """For unit and integration tests only
@@ -329,12 +345,22 @@ class EPUManagement(object):
 
     def msg_instance_info(self, caller, content):
         """ From R1: op_instance_state
-        Reactor parses content.
+        Reactor parses content. Content with a 'records' list is a batch
+        of instance states (op_instance_states).
         """
         if not self.initialized:
             raise Exception("Not initialized")
+        if 'records' in content:
+            return self.reactor.new_instance_states(content['records'])
         return self.reactor.new_instance_state(content)
 
+    def msg_decide_stats(self, caller):
+        """Return decide call timings for each EPU, see EPUMDecider.get_decide_stats()
+        """
+        if not self.initialized:
+            raise Exception("Not initialized")
+        return self.decider.get_decide_stats()
+
     def msg_sensor_info(self, caller, content):
         """ From R1: op_sensor_info
         Reactor parses content.
@@ -12,6 +12,9 @@ EPUM_INITIALCONF_PERSISTENCE_URL = "persistence_url"
 EPUM_INITIALCONF_PERSISTENCE_USER = "persistence_user"
 EPUM_INITIALCONF_PERSISTENCE_PW = "persistence_pw"
 EPUM_INITIALCONF_EXTERNAL_DECIDE = "_external_decide_invocations"
+EPUM_INITIALCONF_HEARTBEAT_FLUSH = "heartbeat_flush_interval"
+EPUM_INITIALCONF_DECIDE_CONCURRENCY = "decide_concurrency"
+EPUM_INITIALCONF_DECIDE_FORCE_INTERVAL = "decide_force_interval"
 
 EPUM_INITIALCONF_DEFAULT_NEEDY_IAAS = "needy_default_iaas_site"
 EPUM_INITIALCONF_DEFAULT_NEEDY_IAAS_ALLOC = "needy_default_iaas_allocation"
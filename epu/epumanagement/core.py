@@ -10,12 +10,28 @@ from epu.epumanagement.health import InstanceHealthState
 
 
 REQUIRED_INSTANCE_FIELDS = ('instance_id', 'launch_id', 'site', 'allocation', 'state')
+
+# Fields with their own slot in CoreInstance.  Anything else goes in a per-instance dict.
+_INSTANCE_SLOT_FIELDS = REQUIRED_INSTANCE_FIELDS + (
+    'state_time', 'state_desc', 'health', 'errors', 'error_time', 'caller', 'extravars',
+    'ctx_name', 'iaas_id', 'iaas_image', 'iaas_allocation', 'iaas_sshkeyname',
+    'public_ip', 'private_ip', 'client_token', 'pending_timestamp')
+
+_MISSING = object()
+
 class CoreInstance(Instance):
+    """Immutable instance record, see the Instance class for the read API.
+
+    Common fields live in __slots__ rather than a per-record __dict__, which matters with
+    tens of thousands of instances and several records per instance.  Use replace() to
+    get a new record with some values changed.
+    """
+
+    __slots__ = _INSTANCE_SLOT_FIELDS + ('_extra',)
+
     @classmethod
     def from_existing(cls, previous, **kwargs):
-        dct = previous.__dict__.copy()
-        dct.update(kwargs)
-        return cls(**kwargs)
+        return previous.replace(**kwargs)
 
     @classmethod
     def from_dict(cls, dct):
@@ -25,10 +41,35 @@ class CoreInstance(Instance):
         for f in REQUIRED_INSTANCE_FIELDS:
             if not f in kwargs:
                 raise TypeError("Missing required instance field: " + f)
-        self.__dict__.update(kwargs)
+        extra = None
+        setter = object.__setattr__
+        for key, value in kwargs.iteritems():
+            if key in _INSTANCE_SLOT_SET:
+                setter(self, key, value)
+            else:
+                if extra is None:
+                    extra = {}
+                extra[key] = value
+        setter(self, '_extra', extra)
+
+    def replace(self, **kwargs):
+        """Return a new record with the given values changed (or added)
+        """
+        d = dict(self.iteritems())
+        d.update(kwargs)
+        return self.__class__(**d)
 
     def __getattr__(self, item):
-        # only called when regular attribute resolution fails
+        # only called when regular attribute resolution fails: an unset slot
+        # or a field that is not slotted
+        if item.startswith('__'):
+            # keep protocols like pickle and copy working
+            raise AttributeError(item)
+        if item in _INSTANCE_SLOT_SET or item == '_extra':
+            return None
+        extra = object.__getattribute__(self, '_extra')
+        if extra:
+            return extra.get(item)
         return None
 
     def __setattr__(self, key, value):
@@ -36,35 +77,66 @@ class CoreInstance(Instance):
         raise KeyError("Instance attribute setting disabled")
 
     def __getitem__(self, item):
-        return self.__dict__[item]
+        value = self.get(item, _MISSING)
+        if value is _MISSING:
+            raise KeyError(item)
+        return value
 
     def __iter__(self):
-        return iter(self.__dict__)
+        return self.iterkeys()
+
+    def __getstate__(self):
+        return dict(self.iteritems())
+
+    def __setstate__(self, state):
+        self.__init__(**state)
 
     def get(self, key, default=None):
         """Get a single instance property
         """
-        return self.__dict__.get(key, default)
+        if key in _INSTANCE_SLOT_SET:
+            value = _slot_value(self, key)
+            if value is _MISSING:
+                return default
+            return value
+        if self._extra:
+            return self._extra.get(key, default)
+        return default
 
     def iteritems(self):
         """Iterator for (key,value) pairs of instance properties
         """
-        return self.__dict__.iteritems()
+        for key in _INSTANCE_SLOT_FIELDS:
+            value = _slot_value(self, key)
+            if value is not _MISSING:
+                yield key, value
+        if self._extra:
+            for item in self._extra.iteritems():
+                yield item
 
     def iterkeys(self):
         """Iterator for instance property keys
         """
-        return  self.__dict__.iterkeys()
+        for key, _ in self.iteritems():
+            yield key
 
     def items(self):
         """List of (key,value) pairs of instance properties
         """
-        return self.__dict__.items()
+        return list(self.iteritems())
 
     def keys(self):
         """List of available instance property keys
         """
-        return self.__dict__.keys()
+        return list(self.iterkeys())
+
+_INSTANCE_SLOT_SET = frozenset(_INSTANCE_SLOT_FIELDS)
+
+def _slot_value(instance, key):
+    try:
+        return object.__getattribute__(instance, key)
+    except AttributeError:
+        return _MISSING
 
 # OUT_OF_CONTACT is healthy because it is not marked truly missing yet
 _HEALTHY_STATES = (InstanceHealthState.OK, InstanceHealthState.UNKNOWN, InstanceHealthState.OUT_OF_CONTACT)
@@ -72,9 +144,13 @@ class EngineState(State):
     """State object given to decision engine
     """
 
-    def __init__(self):
+    def __init__(self, history_source=None):
+        """
+        @param history_source Store to query for sensor history (see ControllerStore), or None
+        """
         State.__init__(self)
-        
+        self.history_source = history_source
+
         # the last value of each sensor input.
         # for example `queue_size = state.sensors['queuestat']`
         self.sensors = None
@@ -110,9 +186,18 @@ class EngineState(State):
     def get_sensor_history(self, sensor_id, count=None, reverse=True):
         """Queries datastore for historical values of the specified sensor
 
-        @retval Deferred
+        Only the retained items are available, see ControllerStore sensor_history
+        and sensor_max_age.
+
+        @param sensor_id Sensor ID to query
+        @param count Maximum number of items, None for all retained
+        @param reverse If True, newest items first
+        @retval Deferred of list of SensorItem objects
         """
-        raise NotImplemented("History unavailable")
+        if self.history_source is None:
+            raise NotImplementedError("History unavailable")
+        return self.history_source.get_sensor_history(sensor_id, count=count,
+                                                      reverse=reverse)
 
     def get_instance(self, instance_id):
         """
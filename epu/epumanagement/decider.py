@@ -1,4 +1,6 @@
 from copy import deepcopy
+from itertools import izip
+import time
 from twisted.internet.task import LoopingCall
 from twisted.internet import defer
 import uuid
@@ -16,6 +18,14 @@ log = ion.util.ionlog.getLogger(__name__)
 
 DEFAULT_ENGINE_CLASS = "epu.decisionengine.impls.simplest.SimplestEngine"
 
+# Maximum number of engine calls (decide/reconfigure) in flight at once, across all EPUs.
+# Engines are called one at a time unless decide_concurrency is configured higher.
+DEFAULT_DECIDE_CONCURRENCY = 1
+
+# If set, EPUs with no changes since their last decide are skipped until this many seconds
+# have passed.  None means every EPU is recovered and decided every cycle.
+DEFAULT_DECIDE_FORCE_INTERVAL = None
+
 class EPUMDecider(object):
     """The decider handles critical sections related to running decision engine cycles.
 
@@ -33,13 +43,18 @@ class EPUMDecider(object):
     "I hear the voices [...] and I know the speculation.  But I'm the decider, and I decide what is best."
     """
 
-    def __init__(self, epum_store, notifier, provisioner_client, epum_client, disable_loop=False):
+    def __init__(self, epum_store, notifier, provisioner_client, epum_client, disable_loop=False,
+                 decide_concurrency=None, decide_force_interval=DEFAULT_DECIDE_FORCE_INTERVAL):
         """
         @param epum_store State abstraction for all EPUs
         @param notifier A way to signal state changes (TODO: don't think is needed)
         @param provisioner_client A way to launch/destroy VMs
         @param epum_client A way to launch subtasks to EPUM workers (reactor roles)
         @param disable_loop For unit/integration tests, don't run a timed decision loop
+        @param decide_concurrency Maximum engine calls in flight at once, across all EPUs.
+        Defaults to 1, so engines must be safe to run concurrently before raising it
+        @param decide_force_interval If set, only EPUs that changed since their last decide, or
+        that have not been decided for this many seconds, are recovered and decided each cycle
         """
 
         self.epum_store = epum_store
@@ -56,9 +71,29 @@ class EPUMDecider(object):
         # The instances of Control (stateful) that are passed to each Engine to get info and execute cmds
         self.controls = {}
 
-        # There can only ever be one 'decide' engine call run at ANY time.  This could be expanded
-        # to be a latch per EPU for concurrency, but keeping it simple, especially for prototype.
-        self.busy = defer.DeferredSemaphore(1)
+        # There can only ever be one engine call run at any time for a particular EPU, that is
+        # what the per-EPU latch is for.  Different EPUs' engines may run concurrently, but only
+        # up to decide_concurrency calls at once.
+        if decide_concurrency is None:
+            decide_concurrency = DEFAULT_DECIDE_CONCURRENCY
+        self.decide_concurrency = int(decide_concurrency)
+        self.busy = defer.DeferredSemaphore(self.decide_concurrency)
+
+        # Key: EPU name
+        # Value: DeferredSemaphore(1) guarding that EPU's engine
+        self.latches = {}
+
+        # Key: EPU name
+        # Value: DecideStats for that EPU's decide calls
+        self.decide_stats = {}
+
+        # Key: EPU name
+        # Value: tuple (change sequence, time) as of the last cycle that included the EPU
+        self.decide_force_interval = decide_force_interval
+        self.last_cycles = {}
+
+        # The first cycle after becoming leader reloads all EPU state, later ones only changes
+        self.full_recovery = True
 
     def recover(self):
         """Called whenever the whole EPUManagement instance is instantiated.
@@ -69,6 +104,8 @@ class EPUMDecider(object):
     def now_leader(self):
         """Called when this instance becomes the decider leader.
         """
+        self.full_recovery = True
+        self.last_cycles.clear()
         self._leader_initialize()
 
     def not_leader(self):
@@ -144,7 +181,8 @@ class EPUMDecider(object):
         """Every iteration of the decider loop, the following happens:
 
         1. Refresh state.  The EPUM worker processes are constantly updating persistence about the
-        state of instances.  We do not suffer from efficiency fears here (without evidence).
+        state of instances.  If decide_force_interval is set, only EPUs that changed since their
+        last cycle (or are past the interval) are refreshed and decided, see _due_epus().
 
         2. Handle the needs-sensor queue, see self._needs_sensors()
 
@@ -154,7 +192,7 @@ class EPUMDecider(object):
 
         4. For each new EPU, create an engine instance and initialize it.
 
-        5. For each pre-existing EPU that is not marked as removed:
+        5. For each pre-existing EPU that is not marked as removed (concurrently, see _engine_call()):
            A. Check if it has been reconfigured in the meantime.  If so, call reconfigure on the engine.
            B. Run decision cycle.
         """
@@ -170,8 +208,11 @@ class EPUMDecider(object):
         # EPUs could have been just added
         epus = yield self.epum_store.all_active_epus()
 
-        for epu_name in epus.keys():
-            yield epus[epu_name].recover()
+        due_epus = yield self._due_epus(epus)
+        full_recovery = self.full_recovery
+        self.full_recovery = False
+        for epu_name in due_epus:
+            yield epus[epu_name].recover(full=full_recovery)
 
         # Perhaps in the meantime, the leader connection failed, bail early
         if not self.epum_store.currently_decider():
@@ -182,6 +223,9 @@ class EPUMDecider(object):
             if epu_name not in epus.keys():
                 yield self.engines[epu_name].dying()
                 del self.engines[epu_name]
+                self.latches.pop(epu_name, None)
+                self.decide_stats.pop(epu_name, None)
+                self.last_cycles.pop(epu_name, None)
 
         # New engines (new to this decider instance, at least)
         for new_epu_name in filter(lambda x: x not in self.engines.keys(), epus.keys()):
@@ -190,30 +234,115 @@ class EPUMDecider(object):
             except Exception,e:
                 log.error("Error creating engine '%s': %s", new_epu_name, str(e), exc_info=True)
 
-        for epu_name in self.engines.keys():
-            # Perhaps in the meantime, the leader connection failed, bail early
-            if not self.epum_store.currently_decider():
-                defer.returnValue(None)
+        # Each EPU's cycle is independent, a failure in one does not stop the others
+        to_decide = [epu_name for epu_name in self.engines.keys() if epu_name in due_epus]
+        results = yield defer.DeferredList([self._decide_one(epu_name) for epu_name in to_decide],
+                                           consumeErrors=True)
+        for epu_name, (success, result) in izip(to_decide, results):
+            if success and result:
+                # only a completed cycle puts off the next one
+                self.last_cycles[epu_name] = due_epus[epu_name]
+            elif not success:
+                log.error("Error in decision cycle for '%s': %s", epu_name,
+                          result.getErrorMessage(),
+                          exc_info=(result.type, result.value, result.getTracebackObject()))
 
-            epu_state = yield self.epum_store.get_epu_state(epu_name)
-            
-            reconfigured = yield epu_state.has_been_reconfigured()
-            if reconfigured:
-                engine_conf = yield epu_state.get_engine_conf()
-                try:
-                    yield self.busy.run(self.engines[epu_name].reconfigure, self.controls[epu_name], engine_conf)
-                except Exception,e:
-                    log.error("Error in reconfigure call for '%s': %s", epu_name, str(e), exc_info=True)
-                yield epu_state.set_reconfigure_mark()
-
-            engine_state = yield epu_state.get_engine_state()
+    @defer.inlineCallbacks
+    def _due_epus(self, epus):
+        """Return the EPUs that need a cycle: changed, new, or past the force interval
+
+        @retval dict of EPU name -> (change sequence, time) the EPU is being cycled at, to be
+        recorded in last_cycles once its decide succeeds.  Changes made during its decide
+        (e.g. launches) make it due again on the next cycle.
+        """
+        now = time.time()
+        due = {}
+        for epu_name, epu_state in epus.iteritems():
+            change_seq = yield epu_state.get_change_seq()
+            last = self.last_cycles.get(epu_name)
+            if (self.decide_force_interval is None or last is None or
+                    last[0] != change_seq or
+                    now - last[1] >= self.decide_force_interval):
+                due[epu_name] = (change_seq, now)
+        defer.returnValue(due)
+
+    @defer.inlineCallbacks
+    def _decide_one(self, epu_name):
+        """Reconfigure (if needed) and run the decision cycle for one EPU
+
+        @retval Deferred True if the engine's decide completed
+        """
+        # Perhaps in the meantime, the leader connection failed, bail early
+        if not self.epum_store.currently_decider():
+            defer.returnValue(None)
+
+        epu_state = yield self.epum_store.get_epu_state(epu_name)
+
+        reconfigured = yield epu_state.has_been_reconfigured()
+        if reconfigured:
+            engine_conf = yield epu_state.get_engine_conf()
             try:
-                yield self.busy.run(self.engines[epu_name].decide, self.controls[epu_name], engine_state)
+                yield self._engine_call(epu_name, self.engines[epu_name].reconfigure,
+                                        self.controls[epu_name], engine_conf)
             except Exception,e:
-                # TODO: if failure, notify creator
-                # TODO: If initialization fails, the engine won't be added to the list and it will be
-                #       attempted over and over.  There could be a retry limit?  Or jut once is enough.
-                log.error("Error in decide call for '%s': %s", epu_name, str(e), exc_info=True)
+                log.error("Error in reconfigure call for '%s': %s", epu_name, str(e), exc_info=True)
+            yield epu_state.set_reconfigure_mark()
+
+        engine_state = yield epu_state.get_engine_state()
+        stats = self._get_decide_stats(epu_name)
+        try:
+            yield self._engine_call(epu_name, self.engines[epu_name].decide,
+                                    self.controls[epu_name], engine_state, stats=stats)
+        except Exception,e:
+            # TODO: if failure, notify creator
+            # TODO: If initialization fails, the engine won't be added to the list and it will be
+            #       attempted over and over.  There could be a retry limit?  Or jut once is enough.
+            log.error("Error in decide call for '%s': %s", epu_name, str(e), exc_info=True)
+            defer.returnValue(False)
+        log.debug("Decided '%s': %s", epu_name, stats)
+        defer.returnValue(True)
+
+    @defer.inlineCallbacks
+    def _engine_call(self, epu_name, f, *args, **kwargs):
+        """Call an engine method holding the EPU's latch and a slot of the global cap.
+
+        @param stats Optional DecideStats to record the queueing and call time in
+        @retval Deferred result of the engine call
+        """
+        stats = kwargs.pop('stats', None)
+        latch = self.latches.get(epu_name)
+        if latch is None:
+            latch = self.latches[epu_name] = defer.DeferredSemaphore(1)
+
+        queued = time.time()
+        yield latch.acquire()
+        try:
+            yield self.busy.acquire()
+            started = time.time()
+            try:
+                # DE routines can optionally return a Deferred
+                result = yield defer.maybeDeferred(f, *args, **kwargs)
+            finally:
+                self.busy.release()
+                if stats:
+                    stats.record(started - queued, time.time() - started)
+        finally:
+            latch.release()
+        defer.returnValue(result)
+
+    def get_decide_stats(self):
+        """Return decide call timings so far
+
+        @retval dict of EPU name -> dict of DecideStats values
+        """
+        return dict((epu_name, stats.to_dict())
+                    for epu_name, stats in self.decide_stats.iteritems())
+
+    def _get_decide_stats(self, epu_name):
+        stats = self.decide_stats.get(epu_name)
+        if stats is None:
+            stats = self.decide_stats[epu_name] = DecideStats()
+        return stats
 
     @defer.inlineCallbacks
     def _new_engine(self, epu_name):
@@ -237,6 +366,48 @@ class EPUMDecider(object):
         self.controls[epu_name] = control
 
 
+class DecideStats(object):
+    """Decide call timings for one EPU, in seconds.
+
+    queue time is how long a call waited for the EPU latch and a global slot, call time is
+    how long the engine took (including any Deferred it returned).
+    """
+    def __init__(self):
+        self.count = 0
+        self.last_queue_time = 0.0
+        self.max_queue_time = 0.0
+        self.total_queue_time = 0.0
+        self.last_call_time = 0.0
+        self.max_call_time = 0.0
+        self.total_call_time = 0.0
+
+    def record(self, queue_time, call_time):
+        self.count += 1
+        self.last_queue_time = queue_time
+        self.max_queue_time = max(self.max_queue_time, queue_time)
+        self.total_queue_time += queue_time
+        self.last_call_time = call_time
+        self.max_call_time = max(self.max_call_time, call_time)
+        self.total_call_time += call_time
+
+    def to_dict(self):
+        d = dict(count=self.count,
+                 last_queue_time=self.last_queue_time, max_queue_time=self.max_queue_time,
+                 last_call_time=self.last_call_time, max_call_time=self.max_call_time,
+                 avg_queue_time=0.0, avg_call_time=0.0)
+        if self.count:
+            d['avg_queue_time'] = self.total_queue_time / self.count
+            d['avg_call_time'] = self.total_call_time / self.count
+        return d
+
+    def __str__(self):
+        if not self.count:
+            return "DecideStats(count=0)"
+        return ("DecideStats(count=%d, call avg=%.3f max=%.3f, queue avg=%.3f max=%.3f)" %
+                (self.count, self.total_call_time / self.count, self.max_call_time,
+                 self.total_queue_time / self.count, self.max_queue_time))
+
+
 class ControllerCoreControl(Control):
     def __init__(self, provisioner_client, epu_state, prov_vars, controller_name, health_not_checked=True):
         super(ControllerCoreControl, self).__init__()
@@ -47,6 +47,9 @@ class EPUMDoctor(object):
         # a latch per EPU for better concurrency, but keeping it simple, especially for prototype.
         self.busy = defer.DeferredSemaphore(1)
 
+        # The first loop after becoming leader reloads all EPU state, later ones only changes
+        self.full_recovery = True
+
     def recover(self):
         """Called whenever the whole EPUManagement instance is instantiated.
         """
@@ -56,6 +59,7 @@ class EPUMDoctor(object):
     def now_leader(self):
         """Called when this instance becomes the doctor leader.
         """
+        self.full_recovery = True
         self._leader_initialize()
 
     def not_leader(self):
@@ -85,8 +89,10 @@ class EPUMDoctor(object):
             defer.returnValue(None)
 
         epus = yield self.epum_store.all_active_epus()
+        full_recovery = self.full_recovery
+        self.full_recovery = False
         for epu_name in epus.keys():
-            yield epus[epu_name].recover()
+            yield epus[epu_name].recover(full=full_recovery)
         
         # Perhaps in the meantime, the leader connection failed, bail early
         if not self.epum_store.currently_doctor():
@@ -154,6 +154,10 @@ class Instance(object):
     keys(), etc. These methods behave like that of a dict. Attempting to get
     an nonexistent property will return None.
     """
+
+    # implementations may use __slots__
+    __slots__ = ()
+
     def get(self, key, default=None):
         """Get a single instance property
         """
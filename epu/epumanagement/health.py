@@ -1,3 +1,4 @@
+import heapq
 import time
 from twisted.internet import defer
 
@@ -43,6 +44,13 @@ class InstanceHealthState(object):
     ZOMBIE = "ZOMBIE"
 
 class HealthMonitor(object):
+    """Applies the boot/missing/zombie windows to the instances of one EPU.
+
+    Rather than examining every instance on each update, the monitor keeps a heap of the
+    next time each instance could change health (see _next_check()) and only examines
+    instances whose time has come, plus those whose record or heartbeat time changed since
+    the last update (see EPUState.take_health_changes()).
+    """
     def __init__(self, epu_state, ouagent_client, boot_seconds=300, missing_seconds=120,
                  really_missing_seconds=15, zombie_seconds=120, init_time=None):
         self.epu_state = epu_state
@@ -58,6 +66,17 @@ class HealthMonitor(object):
         # in place of the iaas_time as the basis for window comparisons.
         self.init_time = time.time() if init_time is None else init_time
 
+        # heap of (deadline, instance_id).  Entries that no longer match self.deadlines
+        # have been rescheduled and are skipped when popped.
+        self.deadline_heap = []
+
+        # Key: instance ID
+        # Value: time of the next check
+        self.deadlines = {}
+
+        # Until the first update, all instances need a check
+        self.scheduled_all = False
+
     def monitor_age(self, timestamp=None):
         now = time.time() if timestamp is None else timestamp
         return now - self.init_time
@@ -65,9 +84,88 @@ class HealthMonitor(object):
     @defer.inlineCallbacks
     def update(self, timestamp=None):
         now = time.time() if timestamp is None else timestamp
-        for node in self.epu_state.instances.itervalues():
+
+        changed = self.epu_state.take_health_changes()
+        if not self.scheduled_all:
+            changed = self.epu_state.instances.keys()
+            self.scheduled_all = True
+        for instance_id in changed:
+            self._schedule(instance_id, now)
+
+        for instance_id in self._pop_due(now):
+            node = self.epu_state.instances.get(instance_id)
+            if node is None:
+                continue
             yield self._update_one_node(node, now)
 
+            # the instance record may have been replaced with a new health
+            node = self.epu_state.instances[instance_id]
+            last_heard = yield self.epu_state.last_heartbeat_time(instance_id)
+            self._schedule(instance_id, self._next_check(node, last_heard, now))
+
+    def _schedule(self, instance_id, deadline):
+        """Set (or with None, clear) the time of the next check for an instance
+        """
+        if deadline is None:
+            self.deadlines.pop(instance_id, None)
+            return
+        if self.deadlines.get(instance_id) == deadline:
+            return
+        self.deadlines[instance_id] = deadline
+        heapq.heappush(self.deadline_heap, (deadline, instance_id))
+
+        # drop rescheduled entries once they are most of the heap
+        if len(self.deadline_heap) > 2 * len(self.deadlines) + 64:
+            self.deadline_heap = [(d, i) for i, d in self.deadlines.iteritems()]
+            heapq.heapify(self.deadline_heap)
+
+    def _pop_due(self, now):
+        """Remove and return the IDs of instances whose check time has come
+        """
+        due = []
+        heap = self.deadline_heap
+        while heap and heap[0][0] <= now:
+            deadline, instance_id = heapq.heappop(heap)
+            if self.deadlines.get(instance_id) == deadline:
+                del self.deadlines[instance_id]
+                due.append(instance_id)
+        return due
+
+    def _next_check(self, node, last_heard, now):
+        """Return the earliest time _update_one_node() could change this node's health
+        without a change to its record or heartbeat time, or None if it cannot.
+
+        This mirrors the windows in _update_one_node(), which compare with '>' so a node
+        checked exactly at its deadline is simply checked again at the next update.
+        """
+        if node.state >= InstanceStates.TERMINATING:
+            if last_heard is None:
+                if node.health != InstanceHealthState.UNKNOWN:
+                    return now
+                return None
+            return max(node.state_time, last_heard) + self.zombie_timeout
+
+        if node.state != InstanceStates.RUNNING:
+            return None
+
+        if node.health == InstanceHealthState.OUT_OF_CONTACT:
+            if last_heard is None:
+                return now
+            return last_heard + self.really_missing_timeout
+
+        if node.health == InstanceHealthState.MISSING:
+            return None
+
+        if last_heard is None:
+            if self.init_time > node.state_time:
+                # monitor started after the node was RUNNING, windows start at init_time
+                if node.health == InstanceHealthState.UNKNOWN:
+                    return self.init_time + self.boot_timeout
+                return self.init_time + self.missing_timeout
+            return node.state_time + self.boot_timeout
+
+        return last_heard + self.missing_timeout
+
     @defer.inlineCallbacks
     def _update_one_node(self, node, now):
         last_heard = yield self.epu_state.last_heartbeat_time(node.instance_id)
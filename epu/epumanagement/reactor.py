@@ -1,4 +1,5 @@
-from twisted.internet import defer
+import time
+from twisted.internet import defer, reactor
 
 from epu.epumanagement.conf import *
 from epu.epumanagement.health import InstanceHealthState
@@ -19,12 +20,29 @@ class EPUMReactor(object):
     See: https://confluence.oceanobservatories.org/display/CIDev/EPUManagement+Refactor
     """
 
-    def __init__(self, epum_store, notifier, provisioner_client, epum_client):
+    def __init__(self, epum_store, notifier, provisioner_client, epum_client,
+                 heartbeat_flush_interval=None):
+        """
+        @param heartbeat_flush_interval If set, heartbeats that do not change instance health
+        only have their timestamps recorded, and those are written to the store at most once
+        per this many seconds.  If None, every heartbeat timestamp is written as it arrives.
+        Keep it well under the health missing_timeout, the doctor only sees flushed times.
+        Between flushes, a repeat of a queued heartbeat is coalesced without any store lookups,
+        so a health change made elsewhere (e.g. by the doctor) is only noticed by the first
+        heartbeat after the next flush.
+        """
         self.epum_store = epum_store
         self.notifier = notifier
         self.provisioner_client = provisioner_client
         self.epum_client = epum_client
 
+        self.heartbeat_flush_interval = heartbeat_flush_interval
+
+        # Key: instance ID
+        # Value: tuple (EPUState, health state, timestamp) of the latest heartbeat not yet written
+        self.pending_heartbeats = {}
+        self.heartbeat_flush_call = None
+
     @defer.inlineCallbacks
     def add_epu(self, caller, epu_name, epu_config):
         """See: EPUManagement.msg_add_epu()
@@ -82,6 +100,17 @@ class EPUMReactor(object):
         else:
             log.error("Could not parse instance ID from state message: '%s'" % content)
 
+    @defer.inlineCallbacks
+    def new_instance_states(self, records):
+        """Handle an incoming batch of instance state messages
+
+        @param records List of raw instance state contents
+        @retval Deferred
+        """
+        log.debug("Got %d instance state records", len(records))
+        for content in records:
+            yield self.new_instance_state(content)
+
     @defer.inlineCallbacks
     def new_heartbeat(self, caller, content, timestamp=None):
         """Handle an incoming heartbeat message
@@ -98,6 +127,13 @@ class EPUMReactor(object):
             log.error("Got invalid heartbeat message from '%s': %s", (caller, content))
             defer.returnValue(None)
 
+        pending = self.pending_heartbeats.get(instance_id)
+        if pending and pending[1] == state:
+            # Same as a heartbeat already queued since the last flush, which was checked
+            # against the store then.  Only the "last heard" time needs to move forward.
+            self._queue_heartbeat(pending[0], instance_id, state, timestamp)
+            defer.returnValue(None)
+
         epu_state = yield self.epum_store.get_epu_state_by_instance_id(instance_id)
         if not epu_state:
             log.error("Unknown EPU for health message for instance '%s'" % instance_id)
@@ -113,15 +149,17 @@ class EPUMReactor(object):
             log.error("Could not retrieve instance information for '%s'" % instance_id)
             defer.returnValue(None)
 
-        if state == InstanceHealthState.OK:
+        if not self._is_health_transition(instance, state):
+            # The common case: another heartbeat that agrees with what we already know.
+            # Only the "last heard" time needs to move forward.
+            yield self._coalesce_heartbeat(epu_state, instance_id, state, timestamp)
+            defer.returnValue(None)
 
-            if instance.health not in (InstanceHealthState.OK,
-                                       InstanceHealthState.ZOMBIE) and \
-               instance.state < InstanceStates.TERMINATED:
+        if state == InstanceHealthState.OK:
 
-                # Only updated when we receive an OK heartbeat and instance health turned out to
-                # be wrong (e.g. it was missing and now we finally hear from it)
-                yield epu_state.new_instance_health(instance_id, state, caller=caller)
+            # Only updated when we receive an OK heartbeat and instance health turned out to
+            # be wrong (e.g. it was missing and now we finally hear from it)
+            yield epu_state.new_instance_health(instance_id, state, caller=caller)
 
         else:
 
@@ -131,20 +169,79 @@ class EPUMReactor(object):
             # But for now we want OU agent to send full error information.
             # The EPUMStore should key error storage off {node_id + error_time}
 
-            if state != instance.health:
-                errors = []
-                error_time = content.get('error_time')
-                err = content.get('error')
-                if err:
-                    errors.append(err)
-                procs = content.get('failed_processes')
-                if procs:
-                    errors.extend(p.copy() for p in procs)
+            errors = []
+            error_time = content.get('error_time')
+            err = content.get('error')
+            if err:
+                errors.append(err)
+            procs = content.get('failed_processes')
+            if procs:
+                errors.extend(p.copy() for p in procs)
 
-                yield epu_state.new_instance_health(instance_id, state, error_time, errors, caller)
+            yield epu_state.new_instance_health(instance_id, state, error_time, errors, caller)
 
         # Only update this "last heard" timestamp when the other work is committed.  In situations
         # where a heartbeat is re-queued or never ACK'd and the message is picked up by another
         # EPUM worker, the lack of a timestamp update will give the doctor a better chance to
         # catch health issues.
+        self.pending_heartbeats.pop(instance_id, None)
         yield epu_state.new_instance_heartbeat(instance_id, timestamp=timestamp)
+
+    def _is_health_transition(self, instance, state):
+        """Return True if a heartbeat in this state changes the instance's recorded health
+        """
+        if state == InstanceHealthState.OK:
+            return (instance.health not in (InstanceHealthState.OK,
+                                            InstanceHealthState.ZOMBIE) and
+                    instance.state < InstanceStates.TERMINATED)
+        return state != instance.health
+
+    def _coalesce_heartbeat(self, epu_state, instance_id, state, timestamp):
+        """Record the heartbeat time now, or queue it for the next flush
+        """
+        if not self.heartbeat_flush_interval:
+            return epu_state.new_instance_heartbeat(instance_id, timestamp=timestamp)
+
+        self._queue_heartbeat(epu_state, instance_id, state, timestamp)
+        return defer.succeed(None)
+
+    def _queue_heartbeat(self, epu_state, instance_id, state, timestamp):
+        now = time.time() if timestamp is None else timestamp
+        self.pending_heartbeats[instance_id] = (epu_state, state, now)
+        if not self.heartbeat_flush_call:
+            self.heartbeat_flush_call = reactor.callLater(self.heartbeat_flush_interval,
+                                                          self.flush_heartbeats)
+
+    def stop(self):
+        """Write any queued heartbeat times and cancel the pending flush
+        """
+        return self.flush_heartbeats()
+
+    @defer.inlineCallbacks
+    def flush_heartbeats(self):
+        """Write all queued heartbeat times, one store write per EPU
+        """
+        if self.heartbeat_flush_call:
+            if self.heartbeat_flush_call.active():
+                self.heartbeat_flush_call.cancel()
+            self.heartbeat_flush_call = None
+
+        pending = self.pending_heartbeats
+        if not pending:
+            defer.returnValue(None)
+        self.pending_heartbeats = {}
+
+        # Key: EPU name
+        # Value: tuple (EPUState, dict of instance ID -> timestamp)
+        by_epu = {}
+        for instance_id, (epu_state, state, timestamp) in pending.iteritems():
+            if epu_state.epu_name not in by_epu:
+                by_epu[epu_state.epu_name] = (epu_state, {})
+            by_epu[epu_state.epu_name][1][instance_id] = timestamp
+
+        for epu_name, (epu_state, heartbeats) in by_epu.iteritems():
+            try:
+                yield epu_state.new_instance_heartbeats(heartbeats)
+            except Exception, e:
+                log.error("Error recording %d heartbeats for '%s': %s", len(heartbeats),
+                          epu_name, str(e), exc_info=True)
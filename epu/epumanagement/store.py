@@ -1,5 +1,7 @@
 import copy
-from collections import defaultdict
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import defaultdict, deque
 import simplejson as json
 import time
 from twisted.internet import defer
@@ -58,6 +60,13 @@ class EPUMStore(object):
         # Value: list of node IDs that client would prefer be terminated first
         self.needy_retirable = {}
 
+        # Key: instance ID
+        # Value: name of the EPU that launched it.  Shared with each EPUState, which
+        # adds to it as instances are recorded.  Entries live as long as the instance
+        # record does, they are dropped once the EPU is gone.  See
+        # get_epu_state_by_instance_id()
+        self.instance_epus = {}
+
         self.dt_subscribers = dt_subscribers
 
     def epum_service_name(self):
@@ -82,7 +91,8 @@ class EPUMStore(object):
         if exists:
             raise ValueError("The epu_name is already in use: " + epu_name)
         else:
-            self.epus[epu_name] = EPUState(creator, epu_name, epu_config, dt_subscribers=self.dt_subscribers)
+            self.epus[epu_name] = EPUState(creator, epu_name, epu_config, dt_subscribers=self.dt_subscribers,
+                                           instance_index=self.instance_epus)
 
     def all_active_epus(self):
         """Return dict of EPUState instances for all that are not removed
@@ -123,12 +133,22 @@ class EPUMStore(object):
     def get_epu_state_by_instance_id(self, instance_id):
         """Return the EPUState instance that launched an instance ID, or None.
 
-        In the future some efficient lookup mechanism might be used (reverse map under a znode?).
+        This is on the path of every heartbeat and instance state message, so it only
+        consults the instance_id -> epu_name index, which each EPUState keeps up to date
+        from new_instance_launch() and recover().  Unknown instances are not searched for.
         """
-        for epu_name in self.epus.keys():
-            if self.epus[epu_name]._has_instance_id(instance_id):
-                return self.epus[epu_name]
-        return None
+        epu_name = self.instance_epus.get(instance_id)
+        if epu_name is None:
+            return None
+
+        epu_state = self.epus.get(epu_name)
+        if epu_state is None:
+            # the EPU itself is gone
+            del self.instance_epus[instance_id]
+            return None
+        if not epu_state._has_instance_id(instance_id):
+            return None
+        return epu_state
 
 
     # -------------------
@@ -267,7 +287,8 @@ class EPUState(object):
     See EPUManagement.msg_reconfigure_epu() for a long message about the epu_config parameter
     """
 
-    def __init__(self, creator, epu_name, epu_config, backing_store=None, dt_subscribers=None):
+    def __init__(self, creator, epu_name, epu_config, backing_store=None, dt_subscribers=None,
+                 instance_index=None):
         self.creator = creator
         self.epu_name = epu_name
         self.removed = False
@@ -279,6 +300,9 @@ class EPUState(object):
 
         self.dt_subscribers = dt_subscribers
 
+        # Shared instance_id -> epu_name dict owned by EPUMStore, or None
+        self.instance_index = instance_index
+
         if epu_config.has_key(EPUM_CONF_GENERAL):
             self.add_general_conf(epu_config[EPUM_CONF_GENERAL])
 
@@ -291,7 +315,7 @@ class EPUState(object):
         # See self.set_reconfigure_mark() and self.has_been_reconfigured()
         self.was_reconfigured = False
 
-        self.engine_state = EngineState()
+        self.engine_state = EngineState(history_source=self.store)
 
         self.instance_parser = InstanceParser()
         self.sensor_parser = SensorItemParser()
@@ -301,6 +325,12 @@ class EPUState(object):
         self.pending_instances = defaultdict(list)
         self.pending_sensors = defaultdict(list)
 
+        # Store change sequence as of the last recover(), None before the first one
+        self.recovered_seq = None
+
+        # IDs of instances whose record or heartbeat time changed, see take_health_changes()
+        self.health_changes = set()
+
     def is_removed(self):
         """Return True if the EPU was removed.
         We can't just delete this EPU state instance, it is still being used during
@@ -319,9 +349,26 @@ class EPUState(object):
             yield health_conf[EPUM_CONF_HEALTH_MONITOR]
 
     @defer.inlineCallbacks
-    def recover(self):
-        log.debug("Attempting recovery of controller state")
-        instance_ids = yield self.store.get_instance_ids()
+    def recover(self, full=False):
+        """Refresh instances and sensors from the backing store
+
+        After the first recovery, only records that changed since the previous one are
+        reloaded (see ControllerStore.get_changes()).
+
+        @param full If True, reload everything.  Use when taking over as leader.
+        @retval Deferred
+        """
+        if full or self.recovered_seq is None:
+            log.debug("Attempting full recovery of controller state")
+            change_seq = yield self.store.get_change_seq()
+            instance_ids = yield self.store.get_instance_ids()
+            sensor_ids = yield self.store.get_sensor_ids()
+        else:
+            change_seq = yield self.store.get_change_seq()
+            if change_seq == self.recovered_seq:
+                defer.returnValue(None)
+            change_seq, instance_ids, sensor_ids = yield self.store.get_changes(self.recovered_seq)
+
         for instance_id in instance_ids:
             instance = yield self.store.get_instance(instance_id)
             if instance:
@@ -329,8 +376,9 @@ class EPUState(object):
                 #         instance_id, instance.state, instance.health,
                 #         instance.iaas_id)
                 self.instances[instance_id] = instance
+                self._index_instance(instance)
+                self.health_changes.add(instance_id)
 
-        sensor_ids = yield self.store.get_sensor_ids()
         for sensor_id in sensor_ids:
             sensor = yield self.store.get_sensor(sensor_id)
             if sensor:
@@ -338,6 +386,8 @@ class EPUState(object):
                 #         sensor.value)
                 self.sensors[sensor_id] = sensor
 
+        self.recovered_seq = change_seq
+
     @defer.inlineCallbacks
     def new_instance_state(self, content, timestamp=None):
         """Introduce a new instance state from an incoming message
@@ -404,13 +454,8 @@ class EPUState(object):
         @retval Deferred
         """
         instance = self.instances[instance_id]
-        d = dict(instance.iteritems())
-        d['health'] = health_state
-        d['errors'] = errors
-        d['error_time'] = error_time
         if not caller:
             caller = instance_id
-        d['caller'] = caller
 
         if errors:
             log.error("Got error heartbeat from instance %s. State: %s. "+
@@ -421,7 +466,8 @@ class EPUState(object):
             log.info("Instance %s (%s) entering health state %s", instance_id,
                      instance.state, health_state)
 
-        newinstance = CoreInstance(**d)
+        newinstance = instance.replace(health=health_state, errors=errors,
+                                       error_time=error_time, caller=caller)
         return self._add_instance(newinstance)
 
     @defer.inlineCallbacks
@@ -439,8 +485,17 @@ class EPUState(object):
         @retval Deferred
         """
         now = time.time() if timestamp is None else timestamp
+        self.health_changes.add(instance_id)
         return self.store.add_heartbeat(instance_id, now)
 
+    def new_instance_heartbeats(self, heartbeats):
+        """Record that several heartbeats happened
+        @param heartbeats dict of instance ID -> integer timestamp
+        @retval Deferred
+        """
+        self.health_changes.update(heartbeats)
+        return self.store.add_heartbeats(heartbeats)
+
     def last_heartbeat_time(self, instance_id):
         """Return time (seconds since epoch) of last heartbeat for a node, or None
         @param instance_id ID of instance heartbeat to retrieve
@@ -453,8 +508,17 @@ class EPUState(object):
         @param instance_id ID of instance to clear
         @retval Deferred
         """
+        self.health_changes.add(instance_id)
         return self.store.add_heartbeat(instance_id, None)
 
+    def take_health_changes(self):
+        """Return the set of instance IDs whose record or heartbeat time changed since
+        the last call.  For the health monitor.
+        """
+        changes = self.health_changes
+        self.health_changes = set()
+        return changes
+
     def new_sensor_item(self, content):
         """Introduce new sensor item from an incoming message
 
@@ -480,6 +544,13 @@ class EPUState(object):
         self._reset_pending()
         return s
 
+    def get_change_seq(self):
+        """Return a number that changes whenever instances, sensors or configuration change
+
+        @retval Deferred of integer
+        """
+        return self.store.get_change_seq()
+
     def set_reconfigure_mark(self):
         """Signal that any configuration changes to this EPU will be judged a reconfigure
         starting now.
@@ -545,11 +616,22 @@ class EPUState(object):
         instance_id = instance.instance_id
         self.instances[instance_id] = instance
         self.pending_instances[instance_id].append(instance)
+        self._index_instance(instance)
+        self.health_changes.add(instance_id)
         return self.store.add_instance(instance)
 
     def _has_instance_id(self, instance_id):
         return self.instances.has_key(instance_id)
 
+    def _index_instance(self, instance):
+        """Record the instance in the shared index.
+
+        Terminated instances stay indexed as long as their record does: late state
+        messages and zombie heartbeats about them must still reach this EPU.
+        """
+        if self.instance_index is not None:
+            self.instance_index[instance.instance_id] = self.epu_name
+
     def _add_sensor(self, sensor):
         sensor_id = sensor.sensor_id
         previous = self.sensors.get(sensor_id)
@@ -655,20 +737,156 @@ class DTSubscribers(object):
         return copy.copy(self.needy_subscribers[dt_id])
 
 
+# Number of records kept per instance.  Only the latest is ever read back, the rest are
+# kept for debugging.  None keeps every record.
+DEFAULT_INSTANCE_HISTORY = 10
+
+# Number of items kept per sensor, for get_sensor_history().  None keeps every item.
+DEFAULT_SENSOR_HISTORY = 1000
+
+# If set, sensor items more than this many seconds older than the newest item are dropped.
+DEFAULT_SENSOR_MAX_AGE = None
+
+class SensorHistory(object):
+    """Time-ordered items of one sensor, with bounded retention.
+
+    Times are kept in an array next to a list of the items, both sorted by time.  Items
+    usually arrive in order and are appended; late ones are placed with bisect.  Items
+    dropped by retention are skipped with an offset and compacted away in bulk.
+    """
+
+    def __init__(self, max_items=DEFAULT_SENSOR_HISTORY, max_age=DEFAULT_SENSOR_MAX_AGE):
+        self.max_items = max_items
+        self.max_age = max_age
+        self.times = array('d')
+        self.values = []
+        self.start = 0
+
+    def __len__(self):
+        return len(self.values) - self.start
+
+    def add(self, item):
+        t = float(item.time)
+        if not len(self) or t >= self.times[-1]:
+            self.times.append(t)
+            self.values.append(item)
+        else:
+            # equal times keep arrival order
+            i = bisect_right(self.times, t, self.start)
+            self.times.insert(i, t)
+            self.values.insert(i, item)
+        self._trim()
+
+    def latest(self):
+        if not len(self):
+            return None
+        return self.values[-1]
+
+    def items(self, count=None, reverse=True):
+        """Return up to count items, newest first if reverse
+        """
+        start = self.start
+        if count is not None:
+            start = max(start, len(self.values) - count)
+        items = self.values[start:]
+        if reverse:
+            items.reverse()
+        return items
+
+    def _trim(self):
+        start = self.start
+        if self.max_items is not None:
+            start = max(start, len(self.values) - self.max_items)
+        if self.max_age is not None:
+            cutoff = self.times[-1] - self.max_age
+            start = max(start, bisect_left(self.times, cutoff, start))
+        self.start = start
+
+        # compact once the dropped prefix is as large as what is retained
+        if start and start >= len(self.values) - start:
+            del self.times[:start]
+            del self.values[:start]
+            self.start = 0
+
+
 class ControllerStore(object):
     """In memory "persistence" for EPU Controller state
 
     The same interface wille be used for real ZK persistence.
     """
 
-    def __init__(self):
-        self.instances = defaultdict(list)
-        self.sensors = defaultdict(list)
+    def __init__(self, instance_history=DEFAULT_INSTANCE_HISTORY,
+                 sensor_history=DEFAULT_SENSOR_HISTORY, sensor_max_age=DEFAULT_SENSOR_MAX_AGE):
+        """
+        @param instance_history Number of records to keep per instance, None for all
+        @param sensor_history Number of items to keep per sensor, None for all
+        @param sensor_max_age Seconds of items to keep per sensor (by item time), None for all
+        """
+        self.instance_history = instance_history
+        self.sensor_history = sensor_history
+        self.sensor_max_age = sensor_max_age
+        self.instances = defaultdict(lambda: deque(maxlen=instance_history))
+
+        # Key: sensor ID
+        # Value: SensorHistory
+        self.sensors = {}
         self.config = {}
         self.health_config = {}
         self.general_config = {}
         self.heartbeats = {}
 
+        # Bumped by every change that matters to the decision engine (instance records,
+        # sensor items, configuration).  Heartbeat times do not count.
+        self.change_seq = 0
+
+        # Log of (change_seq, kind, ID) for instance records and sensor items, in change_seq
+        # order, so get_changes() only looks at entries after its since_seq.  Entries that
+        # are superseded by a later change to the same ID are compacted away in _log_change()
+        self.change_log = []
+
+        # Key: tuple (kind, ID)
+        # Value: change_seq of its latest entry in change_log
+        self.latest_changes = {}
+
+    def get_change_seq(self):
+        """Retrieves the current change sequence number
+
+        Two equal values mean nothing but heartbeat times changed in between.
+
+        @retval Deferred of integer
+        """
+        return defer.succeed(self.change_seq)
+
+    def get_changes(self, since_seq):
+        """Retrieves the IDs of instances and sensors with records added after a change sequence
+
+        @param since_seq change sequence number from a previous get_change_seq()/get_changes()
+        @retval Deferred of tuple (current change sequence, instance IDs, sensor IDs)
+        """
+        instance_ids = []
+        sensor_ids = []
+        change_log = self.change_log
+        for i in xrange(bisect_left(change_log, (since_seq + 1,)), len(change_log)):
+            seq, kind, change_id = change_log[i]
+            if self.latest_changes[(kind, change_id)] != seq:
+                # a later entry covers it
+                continue
+            if kind == "instance":
+                instance_ids.append(change_id)
+            else:
+                sensor_ids.append(change_id)
+        return defer.succeed((self.change_seq, instance_ids, sensor_ids))
+
+    def _log_change(self, kind, change_id):
+        self.change_seq += 1
+        self.change_log.append((self.change_seq, kind, change_id))
+        self.latest_changes[(kind, change_id)] = self.change_seq
+
+        # keep the log within twice the number of IDs it covers
+        if len(self.change_log) > 2 * len(self.latest_changes) + 64:
+            self.change_log = [entry for entry in self.change_log
+                               if self.latest_changes[entry[1:]] == entry[0]]
+
     def add_instance(self, instance):
         """Adds a new instance object to persistence
         @param instance Instance to add
@@ -676,6 +894,7 @@ class ControllerStore(object):
         """
         instance_id = instance.instance_id
         self.instances[instance_id].append(instance)
+        self._log_change("instance", instance_id)
         return defer.succeed(None)
 
     def get_instance_ids(self):
@@ -709,6 +928,14 @@ class ControllerStore(object):
         self.heartbeats[instance_id] = timestamp
         return defer.succeed(None)
 
+    def add_heartbeats(self, heartbeats):
+        """Adds several heartbeat times at once, replacing any old values
+        @param heartbeats dict of instance ID -> integer timestamp
+        @retval Deferred
+        """
+        self.heartbeats.update(heartbeats)
+        return defer.succeed(None)
+
     def get_heartbeat(self, instance_id):
         """Retrieves last known heartbeat
         @param instance_id ID of instance heartbeat to retrieve
@@ -722,15 +949,12 @@ class ControllerStore(object):
         @retval Deferred
         """
         sensor_id = sensor.sensor_id
-        sensor_list = self.sensors[sensor_id]
-        sensor_list.append(sensor)
-
-        # this isn't efficient but not a big deal because this is only used
-        # in tests
-        # if a sensor item has an earlier timestamp, store it but sort it into
-        # the appropriate place. Would be faster to use bisect here
-        if len(sensor_list) > 1 and sensor_list[-2].time > sensor.time:
-            sensor_list.sort(key=lambda s: s.time)
+        history = self.sensors.get(sensor_id)
+        if history is None:
+            history = SensorHistory(self.sensor_history, self.sensor_max_age)
+            self.sensors[sensor_id] = history
+        history.add(sensor)
+        self._log_change("sensor", sensor_id)
         return defer.succeed(None)
 
     def get_sensor_ids(self):
@@ -746,15 +970,23 @@ class ControllerStore(object):
         @param sensor_id ID of the sensor item to retrieve
         @retval Deferred of SensorItem object or None
         """
-        if sensor_id in self.sensors:
-            sensor_list = self.sensors[sensor_id]
-            if sensor_list:
-                sensor = sensor_list[-1]
-            else:
-                sensor = None
-        else:
-            sensor = None
-        return defer.succeed(sensor)
+        history = self.sensors.get(sensor_id)
+        if history is None:
+            return defer.succeed(None)
+        return defer.succeed(history.latest())
+
+    def get_sensor_history(self, sensor_id, count=None, reverse=True):
+        """Retrieve retained sensor items for the specified sensor, ordered by time
+
+        @param sensor_id ID of the sensor
+        @param count Maximum number of items, None for all retained
+        @param reverse If True, newest items first
+        @retval Deferred of list of SensorItem objects
+        """
+        history = self.sensors.get(sensor_id)
+        if history is None:
+            return defer.succeed([])
+        return defer.succeed(history.items(count, reverse))
 
     def get_config(self, keys=None):
         """Retrieve the engine config dictionary.
@@ -781,6 +1013,7 @@ class ControllerStore(object):
         """
         for k,v in conf.iteritems():
             self.config[k] = json.dumps(v)
+        self.change_seq += 1
 
     def get_health_config(self, keys=None):
         """Retrieve the health config dictionary.
@@ -807,6 +1040,7 @@ class ControllerStore(object):
         """
         for k,v in conf.iteritems():
             self.health_config[k] = json.dumps(v)
+        self.change_seq += 1
 
     def get_general_config(self, keys=None):
         """Retrieve the general config dictionary.
@@ -833,4 +1067,5 @@ class ControllerStore(object):
         """
         for k,v in conf.iteritems():
             self.general_config[k] = json.dumps(v)
+        self.change_seq += 1
 
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+
+"""
+@file epu/epumanagement/test/bench_reactor.py
+@brief EPUM reactor benchmarks
+
+Run with: python -m epu.epumanagement.test.bench_reactor
+"""
+
+import time
+import uuid
+
+from twisted.internet import defer
+
+from epu.epumanagement.conf import *
+from epu.epumanagement.health import InstanceHealthState
+from epu.epumanagement.reactor import EPUMReactor
+from epu.epumanagement.store import EPUMStore
+from epu.test import run_benchmarks, print_benchmark
+
+
+@defer.inlineCallbacks
+def _get_reactor(epu_count, instances_per_epu):
+    store = EPUMStore({EPUM_INITIALCONF_PERSISTENCE: "memory"})
+    epum_reactor = EPUMReactor(store, None, None, None)
+
+    epu_config = {EPUM_CONF_HEALTH: {EPUM_CONF_HEALTH_MONITOR: True}}
+    instance_ids = []
+    for i in range(epu_count):
+        epu_name = "epu%d" % i
+        yield store.create_new_epu(None, epu_name, epu_config)
+        epu_state = yield store.get_epu_state(epu_name)
+        for j in range(instances_per_epu):
+            instance_id = str(uuid.uuid4())
+            yield epu_state.new_instance_launch("dt", instance_id,
+                                                str(uuid.uuid4()), "site",
+                                                "small")
+            instance_ids.append(instance_id)
+    defer.returnValue((epum_reactor, instance_ids))
+
+
+@defer.inlineCallbacks
+def bench_heartbeat_ingest(instances_per_epu=10, heartbeat_count=20000):
+    """Times OK heartbeats from known instances as the EPU count grows
+    """
+    for epu_count in (1, 10, 100, 1000):
+        epum_reactor, instance_ids = yield _get_reactor(epu_count,
+                                                        instances_per_epu)
+
+        # first heartbeat from each instance moves it to OK health
+        for instance_id in instance_ids:
+            content = {'node_id': instance_id,
+                       'state': InstanceHealthState.OK}
+            yield epum_reactor.new_heartbeat(None, content)
+
+        start = time.time()
+        for i in xrange(heartbeat_count):
+            content = {'node_id': instance_ids[i % len(instance_ids)],
+                       'state': InstanceHealthState.OK}
+            yield epum_reactor.new_heartbeat(None, content)
+        elapsed = time.time() - start
+        print_benchmark("new_heartbeat epus=%d" % epu_count,
+                        heartbeat_count, elapsed, "heartbeats")
+
+
+if __name__ == '__main__':
+    run_benchmarks(bench_heartbeat_ingest)
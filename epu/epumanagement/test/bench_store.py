@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+
+"""
+@file epu/epumanagement/test/bench_store.py
+@brief EPUM store benchmarks
+
+Run with: python -m epu.epumanagement.test.bench_store
+"""
+
+import sys
+import time
+import uuid
+
+from twisted.internet import defer
+
+from epu.epumanagement.core import CoreInstance
+from epu.epumanagement.health import InstanceHealthState
+from epu.epumanagement.store import ControllerStore
+from epu.test import run_benchmarks, print_benchmark
+import epu.states as InstanceStates
+
+# records written per instance: REQUESTING through RUNNING plus a health change
+_STATES = (InstanceStates.REQUESTING, InstanceStates.REQUESTED,
+           InstanceStates.PENDING, InstanceStates.STARTED,
+           InstanceStates.RUNNING)
+
+
+class _DictInstance(object):
+    """The previous CoreInstance layout: every field in a per-record __dict__
+    """
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+    def replace(self, **kwargs):
+        d = self.__dict__.copy()
+        d.update(kwargs)
+        return _DictInstance(**d)
+
+
+def _record_size(record):
+    """Approximate bytes used by a record itself, not counting shared values
+    """
+    size = sys.getsizeof(record)
+    if '__dict__' in dir(record):
+        size += sys.getsizeof(record.__dict__)
+    extra = getattr(record, '_extra', None)
+    if extra:
+        size += sys.getsizeof(extra)
+    return size
+
+
+def _store_size(store):
+    size = sys.getsizeof(store.instances)
+    for records in store.instances.itervalues():
+        size += sys.getsizeof(records)
+        for record in records:
+            size += _record_size(record)
+    return size
+
+
+@defer.inlineCallbacks
+def _fill_store(store, record_class, instance_count, health_changes):
+    for i in xrange(instance_count):
+        instance_id = str(uuid.uuid4())
+        record = record_class(instance_id=instance_id, launch_id=instance_id,
+                              site="site", allocation="small",
+                              state=_STATES[0], state_time=i,
+                              health=InstanceHealthState.UNKNOWN,
+                              extravars=None, public_ip="1.2.3.4",
+                              iaas_id="i-%d" % i)
+        yield store.add_instance(record)
+        for state in _STATES[1:]:
+            record = record.replace(state=state, state_time=i)
+            yield store.add_instance(record)
+        for j in range(health_changes):
+            health = (InstanceHealthState.OK, InstanceHealthState.OUT_OF_CONTACT)[j % 2]
+            record = record.replace(health=health)
+            yield store.add_instance(record)
+
+
+@defer.inlineCallbacks
+def bench_instance_memory(instance_count=50000, health_changes=20):
+    """Approximate memory for instance records, old layout vs slots and bounded history
+    """
+    cases = (("dict records, unbounded history", _DictInstance, None),
+             ("slots records, unbounded history", CoreInstance, None),
+             ("slots records, history=10", CoreInstance, 10))
+    for name, record_class, history in cases:
+        store = ControllerStore(instance_history=history)
+        start = time.time()
+        yield _fill_store(store, record_class, instance_count, health_changes)
+        elapsed = time.time() - start
+        size = _store_size(store)
+        print_benchmark(name, instance_count, elapsed, "instances")
+        print "    ~%.1f MB, %d bytes/instance" % (size / 1048576.0,
+                                                  size / instance_count)
+
+
+if __name__ == '__main__':
+    run_benchmarks(bench_instance_memory)
@@ -168,3 +168,35 @@ class MockDecisionEngine03(Engine):
         yield d
 
         self.reconfigure_count += 1
+
+class MockDecisionEngine04(Engine):
+    """Test engine whose decide takes a while, tracks how many run at once (class-wide)
+    """
+    running = 0
+    max_running = 0
+
+    def __init__(self):
+        Engine.__init__(self)
+        self.initialize_count = 0
+        self.decide_count = 0
+        self.reconfigure_count = 0
+
+    def initialize(self, *args):
+        self.initialize_count += 1
+
+    @defer.inlineCallbacks
+    def decide(self, control, state):
+        cls = MockDecisionEngine04
+        cls.running += 1
+        cls.max_running = max(cls.max_running, cls.running)
+        try:
+            d = defer.Deferred()
+            reactor.callLater(0.01, d.callback, "hiiii")
+            yield d
+        finally:
+            cls.running -= 1
+
+        self.decide_count += 1
+
+    def reconfigure(self, *args):
+        self.reconfigure_count += 1
@@ -177,6 +177,44 @@ class ControllerStateStoreTests(BaseControllerStateTests):
         self.assertEqual(len(self.state.instances), 0)
         self.assertEqual(len(self.state.sensors), 0)
 
+    @defer.inlineCallbacks
+    def test_recovery_incremental(self):
+        yield self.store.add_sensor(SensorItem("s1", 100, "s1v1"))
+        yield self.store.add_sensor(SensorItem("s2", 100, "s2v1"))
+        d1 = dict(instance_id="i1", launch_id="l1", allocation="big",
+                  site="cleveland", state=InstanceStates.PENDING)
+        yield self.store.add_instance(CoreInstance.from_dict(d1))
+        yield self.state.recover()
+
+        fetched = []
+        get_instance = self.store.get_instance
+        def counting_get_instance(instance_id):
+            fetched.append(instance_id)
+            return get_instance(instance_id)
+        self.store.get_instance = counting_get_instance
+
+        # nothing changed, nothing is fetched
+        yield self.state.recover()
+        self.assertEqual(fetched, [])
+
+        d2 = dict(instance_id="i2", launch_id="l2", allocation="big",
+                  site="cleveland", state=InstanceStates.PENDING)
+        yield self.store.add_instance(CoreInstance.from_dict(d2))
+        yield self.store.add_sensor(SensorItem("s2", 200, "s2v2"))
+
+        # only the changed records are fetched
+        yield self.state.recover()
+        self.assertEqual(fetched, ["i2"])
+        yield self.assertInstance("i2", launch_id="l2", allocation="big",
+                  site="cleveland", state=InstanceStates.PENDING)
+        yield self.assertSensor("s1", 100, "s1v1")
+        yield self.assertSensor("s2", 200, "s2v2")
+
+        # a full recovery fetches everything
+        del fetched[:]
+        yield self.state.recover(full=True)
+        self.assertEqual(sorted(fetched), ["i1", "i2"])
+
 class ControllerCoreStateTests(BaseControllerStateTests):
     """ControllerCoreState tests that only use in memory store
 
@@ -333,6 +371,40 @@ class ControllerCoreStateTests(BaseControllerStateTests):
         self.assertEqual(len(self.state.pending_sensors[sensor_id]), 2)
 
 
+class CoreInstanceTests(unittest.TestCase):
+    def test_fields(self):
+        instance = CoreInstance(instance_id="i1", launch_id="l1", site="chicago",
+                                allocation="big", state=InstanceStates.RUNNING,
+                                public_ip="1.2.3.4", something_else=[1, 2])
+        self.assertEqual(instance.public_ip, "1.2.3.4")
+        self.assertEqual(instance.something_else, [1, 2])
+        self.assertEqual(instance["something_else"], [1, 2])
+        self.assertEqual(instance.get("private_ip", "nope"), "nope")
+        self.assertEqual(instance.private_ip, None)
+        self.assertEqual(instance.not_a_field, None)
+        self.assertRaises(KeyError, instance.__getitem__, "private_ip")
+        self.assertEqual(set(instance.keys()),
+                         set(["instance_id", "launch_id", "site", "allocation",
+                              "state", "public_ip", "something_else"]))
+        self.assertRaises(KeyError, setattr, instance, "state", InstanceStates.FAILED)
+        self.assertRaises(TypeError, CoreInstance, instance_id="i2")
+
+    def test_replace(self):
+        instance = CoreInstance(instance_id="i1", launch_id="l1", site="chicago",
+                                allocation="big", state=InstanceStates.RUNNING,
+                                health=InstanceHealthState.UNKNOWN)
+        new = instance.replace(health=InstanceHealthState.OK, caller="i1")
+        self.assertEqual(instance.health, InstanceHealthState.UNKNOWN)
+        self.assertEqual(instance.caller, None)
+        self.assertEqual(new.health, InstanceHealthState.OK)
+        self.assertEqual(new.caller, "i1")
+        self.assertEqual(new.launch_id, "l1")
+
+        copied = CoreInstance.from_existing(instance, state=InstanceStates.TERMINATED)
+        self.assertEqual(copied.state, InstanceStates.TERMINATED)
+        self.assertEqual(copied.site, "chicago")
+
+
 class EngineStateTests(unittest.TestCase):
     def test_sensors(self):
         s1 = [SensorItem("s1", i, "v" + str(i)) for i in range(3)]
@@ -4,8 +4,9 @@ from twisted.trial import unittest
 from epu.decisionengine.impls.simplest import CONF_PRESERVE_N
 from epu.epumanagement.core import CoreInstance
 from epu.epumanagement.forengine import SensorItem
-from epu.epumanagement.store import EPUMStore, ControllerStore
+from epu.epumanagement.store import EPUMStore, EPUState, ControllerStore
 from epu.epumanagement.conf import *
+import epu.states as InstanceStates
 import ion.util.ionlog
 
 log = ion.util.ionlog.getLogger(__name__)
@@ -58,6 +59,49 @@ class EPUStoreBasicTests(unittest.TestCase):
         health_enabled = yield epu.is_health_enabled()
         self.assertFalse(health_enabled)
 
+    @defer.inlineCallbacks
+    def test_instance_lookup(self):
+        yield self.store.create_new_epu(None, "testing03", {})
+        yield self.store.create_new_epu(None, "testing04", {})
+        epu3 = yield self.store.get_epu_state("testing03")
+        epu4 = yield self.store.get_epu_state("testing04")
+
+        yield epu3.new_instance_launch("dt", "i-3", "l-3", "chicago", "small")
+        yield epu4.new_instance_launch("dt", "i-4", "l-4", "chicago", "small")
+        self.assertEqual(self.store.instance_epus,
+                         {"i-3" : "testing03", "i-4" : "testing04"})
+
+        found = yield self.store.get_epu_state_by_instance_id("i-3")
+        self.assertIs(found, epu3)
+        found = yield self.store.get_epu_state_by_instance_id("i-4")
+        self.assertIs(found, epu4)
+        found = yield self.store.get_epu_state_by_instance_id("i-5")
+        self.assertEqual(found, None)
+
+        # instances of an EPU that is gone are dropped from the index
+        del self.store.epus["testing04"]
+        found = yield self.store.get_epu_state_by_instance_id("i-4")
+        self.assertEqual(found, None)
+        self.assertEqual(self.store.instance_epus, {"i-3" : "testing03"})
+
+    @defer.inlineCallbacks
+    def test_instance_lookup_terminated(self):
+        yield self.store.create_new_epu(None, "testing05", {})
+        epu5 = yield self.store.get_epu_state("testing05")
+        yield epu5.new_instance_launch("dt", "i-5", "l-5", "chicago", "small")
+
+        content = {"node_id": "i-5", "state": InstanceStates.TERMINATED}
+        epu = yield self.store.get_epu_state_by_instance_id("i-5")
+        yield epu.new_instance_state(content)
+
+        # a late or resent state message for a terminated instance still finds its EPU
+        self.assertEqual(self.store.instance_epus, {"i-5" : "testing05"})
+        found = yield self.store.get_epu_state_by_instance_id("i-5")
+        self.assertIs(found, epu5)
+        content = {"node_id": "i-5", "state": InstanceStates.FAILED}
+        yield found.new_instance_state(content)
+        self.assertEqual(epu5.instances["i-5"].state, InstanceStates.FAILED)
+
 class ControllerStoreTests(unittest.TestCase):
     def setUp(self):
         self.store = ControllerStore()
@@ -123,6 +167,46 @@ class ControllerStoreTests(unittest.TestCase):
 
         # could go on to verify each instance record
 
+    @defer.inlineCallbacks
+    def test_instance_history_bounded(self):
+        store = ControllerStore(instance_history=3)
+        d = dict(instance_id="i1", launch_id="l1", site="Chicago", allocation="small")
+        for i in range(5):
+            yield store.add_instance(CoreInstance(state=i, **d))
+        self.assertEqual([instance.state for instance in store.instances["i1"]], [2, 3, 4])
+        instance = yield store.get_instance("i1")
+        self.assertEqual(instance.state, 4)
+
+    @defer.inlineCallbacks
+    def test_get_changes(self):
+        d = dict(launch_id="l1", site="Chicago", allocation="small")
+        for i in range(3):
+            yield self.store.add_instance(CoreInstance(instance_id="i%d" % i, state=0, **d))
+        seq, instance_ids, sensor_ids = yield self.store.get_changes(0)
+        self.assertEqual(instance_ids, ["i0", "i1", "i2"])
+        self.assertEqual(sensor_ids, [])
+
+        yield self.store.add_sensor(SensorItem("s1", 1, "1"))
+        yield self.store.add_instance(CoreInstance(instance_id="i0", state=1, **d))
+        yield self.store.add_config({"a": 1})
+        seq2, instance_ids, sensor_ids = yield self.store.get_changes(seq)
+        self.assertEqual(instance_ids, ["i0"])
+        self.assertEqual(sensor_ids, ["s1"])
+
+        seq3, instance_ids, sensor_ids = yield self.store.get_changes(seq2)
+        self.assertEqual(seq3, seq2)
+        self.assertEqual((instance_ids, sensor_ids), ([], []))
+
+        # repeated records for the same instances do not grow the log without bound
+        for i in range(500):
+            yield self.store.add_instance(CoreInstance(instance_id="i%d" % (i % 3), state=2, **d))
+        self.assertTrue(len(self.store.change_log) <= 2 * 4 + 64 + 1)
+        seq4, instance_ids, sensor_ids = yield self.store.get_changes(seq3)
+        self.assertEqual(sorted(instance_ids), ["i0", "i1", "i2"])
+        seq4, instance_ids, sensor_ids = yield self.store.get_changes(0)
+        self.assertEqual(sorted(instance_ids), ["i0", "i1", "i2"])
+        self.assertEqual(sensor_ids, ["s1"])
+
     @defer.inlineCallbacks
     def test_sensors_put_get_3(self):
         yield self._sensors_put_get(3)
@@ -150,3 +234,43 @@ class ControllerStoreTests(unittest.TestCase):
         log.debug("Put %d sensors, got %d sensor IDs", count, len(found_ids))
         self.assertEqual(len(found_ids), len(sensor_ids))
         self.assertEqual(found_ids, sensor_ids)
+
+    @defer.inlineCallbacks
+    def test_sensor_history(self):
+        for t in (1, 2, 4, 3, 5):
+            yield self.store.add_sensor(SensorItem("s1", t, "v%d" % t))
+
+        latest = yield self.store.get_sensor("s1")
+        self.assertEqual(latest.time, 5)
+
+        history = yield self.store.get_sensor_history("s1")
+        self.assertEqual([s.time for s in history], [5, 4, 3, 2, 1])
+        history = yield self.store.get_sensor_history("s1", count=2, reverse=False)
+        self.assertEqual([s.time for s in history], [4, 5])
+        history = yield self.store.get_sensor_history("nope")
+        self.assertEqual(history, [])
+
+    @defer.inlineCallbacks
+    def test_sensor_history_retention(self):
+        store = ControllerStore(sensor_history=3)
+        for t in range(10):
+            yield store.add_sensor(SensorItem("s1", t, t))
+        history = yield store.get_sensor_history("s1")
+        self.assertEqual([s.time for s in history], [9, 8, 7])
+
+        store = ControllerStore(sensor_max_age=5)
+        for t in range(0, 20, 2):
+            yield store.add_sensor(SensorItem("s1", t, t))
+        # late item older than the window is dropped
+        yield store.add_sensor(SensorItem("s1", 3, 3))
+        history = yield store.get_sensor_history("s1", reverse=False)
+        self.assertEqual([s.time for s in history], [14, 16, 18])
+
+    @defer.inlineCallbacks
+    def test_engine_state_sensor_history(self):
+        state = EPUState(None, "epu1", {}, backing_store=self.store)
+        for t in range(5):
+            yield state.new_sensor_item(dict(sensor_id="queue", time=t, value=t * 10))
+        engine_state = state.get_engine_state()
+        history = yield engine_state.get_sensor_history("queue", count=3)
+        self.assertEqual([s.value for s in history], [40, 30, 20])
@@ -3,8 +3,10 @@ from twisted.trial import unittest
 
 from epu.decisionengine.impls.simplest import CONF_PRESERVE_N
 from epu.epumanagement import EPUManagement
-from epu.epumanagement.test.mocks import MockSubscriberNotifier, MockProvisionerClient, MockOUAgentClient
+from epu.epumanagement.test.mocks import MockSubscriberNotifier, MockProvisionerClient, MockOUAgentClient, \
+    MockDecisionEngine04
 from epu.epumanagement.conf import *
+import epu.states as InstanceStates
 
 import ion.util.ionlog
 
@@ -55,6 +57,13 @@ class EPUManagementBasicTests(unittest.TestCase):
         conf[EPUM_CONF_GENERAL] = {EPUM_CONF_ENGINE_CLASS: MOCK_PKG + ".MockDecisionEngine03"}
         return conf
 
+    def _config_mock4(self):
+        """slow decide, tracks concurrency
+        """
+        conf = self._config_mock1()
+        conf[EPUM_CONF_GENERAL] = {EPUM_CONF_ENGINE_CLASS: MOCK_PKG + ".MockDecisionEngine04"}
+        return conf
+
     def _config_simplest_epuconf(self, n_preserving):
         """Get 'simplest' EPU conf with specified NPreserving policy
         """
@@ -240,6 +249,28 @@ class EPUManagementBasicTests(unittest.TestCase):
         self.assertEqual(epu1.epu_name, epu_name1)
         self.assertEqual(epu2.epu_name, epu_name2)
 
+    @defer.inlineCallbacks
+    def test_instance_states_batch(self):
+        """
+        A batched instance_states message updates every instance it names
+        """
+        yield self.epum.initialize()
+        epu_config = self._config_simplest_epuconf(2)
+        yield self.epum.msg_add_epu(None, "testing123", epu_config)
+        yield self.epum._run_decisions()
+        instance_ids = self.provisioner_client.launched_instance_ids
+        self.assertEqual(len(instance_ids), 2)
+
+        records = [{"node_id": instance_id, "state": InstanceStates.RUNNING}
+                   for instance_id in instance_ids]
+        records.append({"node_id": "unknown", "state": InstanceStates.RUNNING})
+        yield self.epum.msg_instance_info(None, {"records": records})
+
+        epu_state = yield self.epum.epum_store.get_epu_state("testing123")
+        for instance_id in instance_ids:
+            self.assertEqual(epu_state.instances[instance_id].state,
+                             InstanceStates.RUNNING)
+
     @defer.inlineCallbacks
     def test_failing_engine_decide(self):
         """Exceptions during decide cycle should not affect EPUM.
@@ -293,6 +324,101 @@ class EPUManagementBasicTests(unittest.TestCase):
         yield self.epum._run_decisions()
         self.assertEqual(epu_engine.reconfigure_count, 1)
 
+    @defer.inlineCallbacks
+    def test_concurrent_decide(self):
+        """Engines for different EPUs run concurrently, up to the cap
+        """
+        MockDecisionEngine04.running = 0
+        MockDecisionEngine04.max_running = 0
+        self.epum.decider.busy = defer.DeferredSemaphore(2)
+
+        yield self.epum.initialize()
+        epu_names = ["slow_epu%d" % i for i in range(3)]
+        for epu_name in epu_names:
+            yield self.epum.msg_add_epu(None, epu_name, self._config_mock4())
+        yield self.epum._run_decisions()
+        yield self.epum._run_decisions()
+
+        self.assertEqual(MockDecisionEngine04.max_running, 2)
+        self.assertEqual(MockDecisionEngine04.running, 0)
+        for epu_name in epu_names:
+            self.assertEqual(self.epum.decider.engines[epu_name].decide_count, 2)
+        stats = self.epum.msg_decide_stats(None)
+        self.assertEqual(sorted(stats.keys()), epu_names)
+        for epu_name in epu_names:
+            self.assertEqual(stats[epu_name]['count'], 2)
+            self.assertTrue(stats[epu_name]['max_call_time'] > 0)
+
+    @defer.inlineCallbacks
+    def test_serial_decide_default(self):
+        """Without decide_concurrency, engines for different EPUs are called one at a time
+        """
+        MockDecisionEngine04.running = 0
+        MockDecisionEngine04.max_running = 0
+
+        yield self.epum.initialize()
+        for i in range(3):
+            yield self.epum.msg_add_epu(None, "slow_epu%d" % i, self._config_mock4())
+        yield self.epum._run_decisions()
+
+        self.assertEqual(self.epum.decider.decide_concurrency, 1)
+        self.assertEqual(MockDecisionEngine04.max_running, 1)
+
+    @defer.inlineCallbacks
+    def test_decide_only_changed(self):
+        """With a force interval, engines of unchanged EPUs are not called
+        """
+        initial_conf = {EPUM_INITIALCONF_PERSISTENCE: "memory",
+                        EPUM_INITIALCONF_EXTERNAL_DECIDE: True,
+                        EPUM_INITIALCONF_DECIDE_FORCE_INTERVAL: 3600}
+        self.epum = EPUManagement(initial_conf, self.notifier, self.provisioner_client, self.ou_client)
+        yield self.epum.initialize()
+
+        yield self.epum.msg_add_epu(None, "epu1", self._config_mock1())
+        yield self.epum.msg_add_epu(None, "epu2", self._config_mock1())
+        yield self.epum._run_decisions()
+        epu1_engine = self.epum.decider.engines["epu1"]
+        epu2_engine = self.epum.decider.engines["epu2"]
+        self.assertEqual(epu1_engine.decide_count, 1)
+        self.assertEqual(epu2_engine.decide_count, 1)
+
+        yield self.epum._run_decisions()
+        self.assertEqual(epu1_engine.decide_count, 1)
+        self.assertEqual(epu2_engine.decide_count, 1)
+
+        config2 = {EPUM_CONF_ENGINE: {CONF_PRESERVE_N:2}}
+        yield self.epum.msg_reconfigure_epu(None, "epu2", config2)
+        yield self.epum._run_decisions()
+        self.assertEqual(epu1_engine.decide_count, 1)
+        self.assertEqual(epu2_engine.decide_count, 2)
+        self.assertEqual(epu2_engine.reconfigure_count, 1)
+
+        # past the force interval, everything is decided again
+        for epu_name, (change_seq, t) in self.epum.decider.last_cycles.items():
+            self.epum.decider.last_cycles[epu_name] = (change_seq, t - 3600)
+        yield self.epum._run_decisions()
+        self.assertEqual(epu1_engine.decide_count, 2)
+        self.assertEqual(epu2_engine.decide_count, 3)
+
+    @defer.inlineCallbacks
+    def test_decide_failure_retried(self):
+        """With a force interval, an EPU whose decide failed is decided again next cycle
+        """
+        initial_conf = {EPUM_INITIALCONF_PERSISTENCE: "memory",
+                        EPUM_INITIALCONF_EXTERNAL_DECIDE: True,
+                        EPUM_INITIALCONF_DECIDE_FORCE_INTERVAL: 3600}
+        self.epum = EPUManagement(initial_conf, self.notifier, self.provisioner_client, self.ou_client)
+        yield self.epum.initialize()
+
+        yield self.epum.msg_add_epu(None, "fail_epu", self._config_mock2())
+        yield self.epum.msg_add_epu(None, "epu1", self._config_mock1())
+        yield self.epum._run_decisions()
+        yield self.epum._run_decisions()
+
+        self.assertEqual(self.epum.decider.engines["fail_epu"].decide_count, 2)
+        self.assertEqual(self.epum.decider.engines["epu1"].decide_count, 1)
+        self.assertNotIn("fail_epu", self.epum.decider.last_cycles)
+
 # TODO
 #    @defer.inlineCallbacks
 #    def test_initialize_no_instance_recovery(self):
@@ -32,9 +32,6 @@ class FakeState(EPUState):
 class HeartbeatMonitorTests(unittest.TestCase):
     def setUp(self):
         self.epu_name = "epuX"
-        epu_config = self._epu_config(health_init_time=100)
-        self.state = FakeState(None, self.epu_name, epu_config, backing_store=ControllerStore())
-
         initial_conf = {EPUM_INITIALCONF_PERSISTENCE: "memory",
                         EPUM_INITIALCONF_EXTERNAL_DECIDE: True}
         self.notifier = MockSubscriberNotifier()
@@ -44,7 +41,11 @@ class HeartbeatMonitorTests(unittest.TestCase):
         self.provisioner_client._set_epum(self.epum)
         self.ou_client._set_epum(self.epum)
 
-        # inject the FakeState instance directly instead of using msg_add_epu()
+        # inject the FakeState instance directly instead of using msg_add_epu(),
+        # sharing the store's instance index so messages can find it
+        epu_config = self._epu_config(health_init_time=100)
+        self.state = FakeState(None, self.epu_name, epu_config, backing_store=ControllerStore(),
+                               instance_index=self.epum.epum_store.instance_epus)
         self.epum.epum_store.epus[self.epu_name] = self.state
 
     def _epu_config(self, health_init_time=0):
@@ -352,8 +353,100 @@ class HeartbeatMonitorTests(unittest.TestCase):
         self.assertEquals(1, self.ou_client.dump_state_called)
         self.assertEquals(0, self.ou_client.heartbeats_sent)
 
+    @defer.inlineCallbacks
+    def test_only_due_instances_checked(self):
+        yield self.epum.initialize()
+        yield self.epum.msg_reconfigure_epu(None, self.epu_name, self._epu_config())
+
+        nodes = [str(uuid.uuid4()) for i in range(20)]
+        for n in nodes:
+            self.state.new_fake_instance_state(n, InstanceStates.RUNNING, 0)
+            yield self.ok_heartbeat(n, 1)
+        yield self.epum._doctor_appt(1)
+        self.assertNodeState(InstanceHealthState.OK, *nodes)
+
+        monitor = self.epum.doctor.monitors[self.epu_name]
+        checked = []
+        update_one_node = monitor._update_one_node
+        def counting_update_one_node(node, now):
+            checked.append(node.instance_id)
+            return update_one_node(node, now)
+        monitor._update_one_node = counting_update_one_node
+
+        # nothing is due before the missing timeout (5)
+        yield self.epum._doctor_appt(3)
+        self.assertEqual(checked, [])
+
+        # a heartbeat makes just that instance due, and moves its deadline
+        yield self.ok_heartbeat(nodes[0], 4)
+        yield self.epum._doctor_appt(4)
+        self.assertEqual(checked, [nodes[0]])
+
+        del checked[:]
+        yield self.epum._doctor_appt(7)
+        self.assertEqual(sorted(checked), sorted(nodes[1:]))
+        self.assertNodeState(InstanceHealthState.OK, nodes[0])
+        self.assertNodeState(InstanceHealthState.OUT_OF_CONTACT, *nodes[1:])
+
+    @defer.inlineCallbacks
+    def test_heartbeat_coalescing(self):
+        yield self.epum.initialize()
+        yield self.epum.msg_reconfigure_epu(None, self.epu_name, self._epu_config())
+        self.epum.reactor.heartbeat_flush_interval = 60
+
+        n1, n2 = nodes = [str(uuid.uuid4()) for i in range(2)]
+        for n in nodes:
+            self.state.new_fake_instance_state(n, InstanceStates.RUNNING, 1)
+
+        # first heartbeats change health and are recorded right away
+        yield self.ok_heartbeat(n1, 2)
+        yield self.ok_heartbeat(n2, 2)
+        self.assertNodeState(InstanceHealthState.OK, *nodes)
+        yield self.assertLastHeard(2, *nodes)
+
+        # unchanged OK heartbeats wait for the flush
+        yield self.ok_heartbeat(n1, 3)
+        yield self.ok_heartbeat(n2, 3)
+        yield self.ok_heartbeat(n1, 4)
+        yield self.assertLastHeard(2, *nodes)
+        self.assertEqual(2, len(self.epum.reactor.pending_heartbeats))
+
+        # repeats of a queued heartbeat skip the store lookups
+        lookups = []
+        get_epu_state = self.epum.epum_store.get_epu_state_by_instance_id
+        def counting_get(instance_id):
+            lookups.append(instance_id)
+            return get_epu_state(instance_id)
+        self.epum.epum_store.get_epu_state_by_instance_id = counting_get
+        yield self.ok_heartbeat(n1, 4)
+        self.assertEqual(lookups, [])
+
+        # a health transition goes through the full path
+        yield self.err_heartbeat(n2, 5)
+        self.assertNodeState(InstanceHealthState.MONITOR_ERROR, n2)
+        yield self.assertLastHeard(5, n2)
+
+        yield self.epum.reactor.flush_heartbeats()
+        self.assertFalse(self.epum.reactor.pending_heartbeats)
+        self.assertEqual(None, self.epum.reactor.heartbeat_flush_call)
+        yield self.assertLastHeard(4, n1)
+        yield self.assertLastHeard(5, n2)
+
+        # stopping the EPUM writes out queued heartbeats
+        yield self.ok_heartbeat(n1, 6)
+        self.assertNotEqual(None, self.epum.reactor.heartbeat_flush_call)
+        yield self.epum.stop()
+        self.assertEqual(None, self.epum.reactor.heartbeat_flush_call)
+        yield self.assertLastHeard(6, n1)
+
     # ----------------------------------------------------------------------------------
 
+    @defer.inlineCallbacks
+    def assertLastHeard(self, timestamp, *node_ids):
+        for n in node_ids:
+            last_heard = yield self.state.last_heartbeat_time(n)
+            self.assertEqual(timestamp, last_heard)
+
     def assertNodeState(self, state, *node_ids):
         for n in node_ids:
             self.assertEqual(state, self.state.instances[n].health)
@@ -32,6 +32,10 @@ class EPUManagementService(ServiceProcess):
 
         yield self.epumanagement.initialize()
 
+    def slc_terminate(self):
+        if getattr(self, 'epumanagement', None):
+            return self.epumanagement.stop()
+
     def op_register_need(self, content, headers, msg):
         dt_id = content.get('dt_id')
         constraints = content.get('constraints')
@@ -77,9 +81,17 @@ class EPUManagementService(ServiceProcess):
     def op_instance_info(self, content, headers, msg):
         self.epumanagement.msg_instance_info(None, content) # epum parses
 
+    def op_instance_states(self, content, headers, msg):
+        self.epumanagement.msg_instance_info(None, content) # epum parses
+
     def op_sensor_info(self, content, headers, msg):
         self.epumanagement.msg_sensor_info(None, content) # epum parses
 
+    @defer.inlineCallbacks
+    def op_decide_stats(self, content, headers, msg):
+        stats = self.epumanagement.msg_decide_stats(None)
+        yield self.reply_ok(msg, stats)
+
 _unported_r1 = """
     @defer.inlineCallbacks
     def op_reconfigure_epu_rpc(self, content, headers, msg):
@@ -147,6 +159,12 @@ class EPUManagementClient(ServiceClient):
             kwargs['targetname'] = "epumanagement"
         ServiceClient.__init__(self, proc, **kwargs)
 
+    @defer.inlineCallbacks
+    def decide_stats(self):
+        yield self._check_init()
+        stats, headers, msg = yield self.rpc_send('decide_stats', {})
+        defer.returnValue(stats)
+
     # TODO: make operations e.g. "msg_add_epu" with full argument list that translate into
     # the 'content' bag for ION that in turn calls corresponding e.g. "op_add_epu" via ION
 
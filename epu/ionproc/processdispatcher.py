@@ -19,7 +19,8 @@ class ProcessDispatcherService(ServiceProcess):
 
     def slc_init(self):
         self.registry = ExecutionEngineRegistry()
-        self.eeagent_client = EEAgentClient(self)
+        self.eeagent_client = EEAgentClient(self,
+            batch=bool(self.spawn_args.get('eeagent_batch_ops')))
         self.notifier = SubscriberNotifier(self)
         self.core = ProcessDispatcherCore(self.registry, self.eeagent_client,
                                           self.notifier)
@@ -35,9 +36,11 @@ class ProcessDispatcherService(ServiceProcess):
         subscribers = content['subscribers']
         constraints = content.get('constraints')
         immediate = bool(content.get('immediate'))
+        priority = int(content.get('priority') or 0)
 
         result = yield self.core.dispatch_process(epid, spec, subscribers,
-                                                  constraints, immediate)
+                                                  constraints, immediate,
+                                                  priority)
         yield self.reply_ok(msg, self._make_process_dict(result))
 
     @defer.inlineCallbacks
@@ -47,6 +50,22 @@ class ProcessDispatcherService(ServiceProcess):
         result = yield self.core.terminate_process(epid)
         yield self.reply_ok(msg, self._make_process_dict(result))
 
+    @defer.inlineCallbacks
+    def op_dispatch_processes(self, content, headers, msg):
+        requests = content['processes']
+
+        results = yield self.core.dispatch_processes(requests)
+        yield self.reply_ok(msg, [self._make_process_dict(proc)
+                                  for proc in results])
+
+    @defer.inlineCallbacks
+    def op_terminate_processes(self, content, headers, msg):
+        epids = content['epids']
+
+        results = yield self.core.terminate_processes(epids)
+        yield self.reply_ok(msg, [proc and self._make_process_dict(proc)
+                                  for proc in results])
+
     def op_dt_state(self, content, headers, msg):
         node_id = content['node_id']
         deployable_type = content['deployable_type']
@@ -90,22 +109,52 @@ class SubscriberNotifier(object):
 
 class EEAgentClient(object):
     """Client that uses ION to send messages to EEAgents
+
+    Batches of dispatches or terminates are sent as a single
+    dispatch_processes or terminate_processes message only when batch is
+    True, because EEAgents may not implement those ops. Otherwise each
+    process gets its own dispatch or terminate message.
     """
-    def __init__(self, ionprocess):
+    def __init__(self, ionprocess, batch=False):
         self.ionprocess = ionprocess
+        self.batch = batch
 
     def dispatch_process(self, eeagent, epid, round, spec):
         request = dict(epid=epid, round=round, spec=spec)
         return self.ionprocess.send(eeagent, "dispatch", request)
 
+    def dispatch_processes(self, eeagent, processes):
+        if not self.batch:
+            return self._send_each([self.dispatch_process(eeagent, *process)
+                                    for process in processes])
+        request = dict(processes=[dict(epid=epid, round=round, spec=spec)
+                                  for epid, round, spec in processes])
+        return self.ionprocess.send(eeagent, "dispatch_processes", request)
+
     def terminate_process(self, eeagent, epid):
         request = dict(epid=epid)
         return self.ionprocess.send(eeagent, "terminate", request)
 
+    def terminate_processes(self, eeagent, epids):
+        if not self.batch:
+            return self._send_each([self.terminate_process(eeagent, epid)
+                                    for epid in epids])
+        request = dict(epids=list(epids))
+        return self.ionprocess.send(eeagent, "terminate_processes", request)
+
+    def _send_each(self, sends):
+        d = defer.DeferredList(sends, fireOnOneErrback=True,
+                               consumeErrors=True)
+        d.addErrback(lambda failure: failure.value.subFailure)
+        return d
+
     def cleanup_process(self, eeagent, epid):
         request = dict(epid=epid)
         return self.ionprocess.send(eeagent, "cleanup", request)
 
+    def resync(self, eeagent):
+        return self.ionprocess.send(eeagent, "resync", {})
+
 
 class ProcessDispatcherClient(ServiceClient):
     def __init__(self, proc=None, **kwargs):
@@ -115,10 +164,11 @@ class ProcessDispatcherClient(ServiceClient):
 
     @defer.inlineCallbacks
     def dispatch_process(self, epid, spec, subscribers, constraints=None,
-                         immediate=False):
+                         immediate=False, priority=0):
         yield self._check_init()
         request = dict(epid=epid, spec=spec, immediate=immediate,
-                       subscribers=subscribers, constraints=constraints)
+                       subscribers=subscribers, constraints=constraints,
+                       priority=priority)
         process, headers, msg = yield self.rpc_send('dispatch_process', request)
         defer.returnValue(process)
 
@@ -129,6 +179,22 @@ class ProcessDispatcherClient(ServiceClient):
         process, headers, msg = yield self.rpc_send('terminate_process', request)
         defer.returnValue(process)
 
+    @defer.inlineCallbacks
+    def dispatch_processes(self, requests):
+        yield self._check_init()
+        request = dict(processes=list(requests))
+        processes, headers, msg = yield self.rpc_send('dispatch_processes',
+                                                      request)
+        defer.returnValue(processes)
+
+    @defer.inlineCallbacks
+    def terminate_processes(self, epids):
+        yield self._check_init()
+        request = dict(epids=list(epids))
+        processes, headers, msg = yield self.rpc_send('terminate_processes',
+                                                      request)
+        defer.returnValue(processes)
+
     @defer.inlineCallbacks
     def dt_state(self, node_id, deployable_type, state, properties=None):
         yield self._check_init()
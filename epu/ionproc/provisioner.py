@@ -15,7 +15,8 @@ from ion.util import procutils
 from twisted.internet.defer import TimeoutError
 
 from epu.util import get_class
-from epu.provisioner.store import ProvisionerStore, CassandraProvisionerStore
+from epu.provisioner.store import ProvisionerStore, \
+    IndexedProvisionerStore, CassandraProvisionerStore
 from epu.provisioner.core import ProvisionerCore, ProvisionerContextClient
 from epu.ionproc.dtrs import DeployableTypeRegistryClient
 from epu import cei_events
@@ -43,12 +44,38 @@ class ProvisionerService(ServiceProcess):
 
         self.store = store
 
+        # records from before the store kept state indexes must be indexed
+        # before anything queries by state
+        if hasattr(store, "assure_state_index"):
+            yield store.assure_state_index()
+
         notifier = self.spawn_args.get('notifier')
-        self.notifier = notifier or ProvisionerNotifier(self)
+        self.notifier = notifier or ProvisionerNotifier(self,
+            batch_subscribers=self.spawn_args.get('batch_subscribers'))
         self.dtrs = DeployableTypeRegistryClient(self)
 
         self.core = ProvisionerCore(self.store, self.notifier, self.dtrs,
-                                    site_drivers, context_client)
+                                    site_drivers, context_client,
+                                    site_query_concurrency=self.spawn_args.get(
+                                        'site_query_concurrency'),
+                                    site_query_timeout=self.spawn_args.get(
+                                        'site_query_timeout'),
+                                    context_query_concurrency=self.spawn_args.get(
+                                        'context_query_concurrency'),
+                                    context_query_backoff=self.spawn_args.get(
+                                        'context_query_backoff'),
+                                    context_query_max_backoff=self.spawn_args.get(
+                                        'context_query_max_backoff'),
+                                    terminate_concurrency=self.spawn_args.get(
+                                        'terminate_concurrency'),
+                                    launch_group_concurrency=self.spawn_args.get(
+                                        'launch_group_concurrency'),
+                                    launch_cache_size=self.spawn_args.get(
+                                        'launch_cache_size'),
+                                    site_thread_pool_size=self.spawn_args.get(
+                                        'site_thread_pool_size'),
+                                    site_thread_pool_sizes=self.spawn_args.get(
+                                        'site_thread_pool_sizes'))
         yield self.core.recover()
         cei_events.event("provisioner", "init_end")
 
@@ -60,6 +87,8 @@ class ProvisionerService(ServiceProcess):
         if self.store and hasattr(self.store, "disconnect"):
             log.debug("Terminating store process")
             self.store.disconnect()
+        if getattr(self, 'core', None):
+            self.core.stop()
 
     @defer.inlineCallbacks
     def op_provision(self, content, headers, msg):
@@ -239,10 +268,13 @@ class ProvisionerClient(ServiceClient):
         yield self.send('provision', request)
 
     @defer.inlineCallbacks
-    def query(self, rpc=False):
+    def query(self, rpc=False, request=None):
         """Triggers a query operation in the provisioner. Node updates
         are not sent in reply, but are instead sent to subscribers
         (most likely a sensor aggregator).
+
+        An optional request dict narrows the query to some sites or node
+        states, see ProvisionerCore.query_nodes().
         """
         yield self._check_init()
         log.debug('Sending query request to provisioner')
@@ -251,10 +283,10 @@ class ProvisionerClient(ServiceClient):
         # Deferred will not be fired util provisioner has a response from
         # all underlying IaaS. Right now this is only used in tests.
         if rpc:
-            (content, headers, msg) = yield self.rpc_send('query', None)
+            (content, headers, msg) = yield self.rpc_send('query', request)
             defer.returnValue(content)
         else:
-            yield self.send('query', None)
+            yield self.send('query', request)
 
     @defer.inlineCallbacks
     def terminate_launches(self, launches):
@@ -317,9 +349,14 @@ class ProvisionerClient(ServiceClient):
 
 class ProvisionerNotifier(object):
     """Abstraction for sending node updates to subscribers.
+
+    Subscribers named in batch_subscribers receive sets of records as a
+    single message per subscriber, with content {'records': [...]}. All
+    other subscribers get one message per record.
     """
-    def __init__(self, process):
+    def __init__(self, process, batch_subscribers=None):
         self.process = process
+        self.batch_subscribers = set(batch_subscribers or ())
 
     @defer.inlineCallbacks
     def send_record(self, record, subscribers, operation='instance_state'):
@@ -331,11 +368,26 @@ class ProvisionerNotifier(object):
             yield self.process.send(sub, operation, record)
 
     @defer.inlineCallbacks
-    def send_records(self, records, subscribers, operation='instance_state'):
+    def send_records(self, records, subscribers, operation='instance_state',
+                     batch_operation='instance_states'):
         """Send a set of node records to all subscribers.
         """
-        for rec in records:
-            yield self.send_record(rec, subscribers, operation)
+        records = list(records)
+        if not records or not subscribers:
+            return
+
+        single = []
+        for sub in subscribers:
+            if sub in self.batch_subscribers:
+                log.debug('Sending %d records to %s', len(records), sub)
+                yield self.process.send(sub, batch_operation,
+                                        {'records': records})
+            else:
+                single.append(sub)
+
+        if single:
+            for rec in records:
+                yield self.send_record(rec, single, operation)
 
 # Spawn of the process using the module name
 factory = ProcessFactory(ProvisionerService)
@@ -351,6 +403,17 @@ def start(container, starttype, *args, **kwargs):
              'class': ProvisionerService.__name__,
              'spawnargs': {
                  'query_period' : conf.getValue('query_period'),
+                 'site_query_concurrency' : conf.getValue('site_query_concurrency'),
+                 'site_query_timeout' : conf.getValue('site_query_timeout'),
+                 'context_query_concurrency' : conf.getValue('context_query_concurrency'),
+                 'context_query_backoff' : conf.getValue('context_query_backoff'),
+                 'context_query_max_backoff' : conf.getValue('context_query_max_backoff'),
+                 'terminate_concurrency' : conf.getValue('terminate_concurrency'),
+                 'launch_group_concurrency' : conf.getValue('launch_group_concurrency'),
+                 'launch_cache_size' : conf.getValue('launch_cache_size'),
+                 'site_thread_pool_size' : conf.getValue('site_thread_pool_size'),
+                 'site_thread_pool_sizes' : conf.getValue('site_thread_pool_sizes'),
+                 'batch_subscribers' : conf.getValue('batch_subscribers'),
                  'store' : get_provisioner_store(conf),
                  'site_drivers' : get_site_drivers(conf.getValue('sites')),
                  'context_client' : get_context_client(conf)}}]
@@ -370,9 +433,11 @@ def stop(container, state):
     # Return the deferred
     return supdesc.terminate()
 
-def get_cassandra_store(host, username, password, keyspace, port=None, prefix=""):
+def get_cassandra_store(host, username, password, keyspace, port=None,
+                        prefix="", batch_size=None, final_state_index_ttl=None):
     store = CassandraProvisionerStore(host, port or 9160, username, password,
-                                      keyspace, prefix)
+                                      keyspace, prefix, batch_size=batch_size,
+                                      final_state_index_ttl=final_state_index_ttl)
     store.connect()
     return store
 
@@ -385,9 +450,15 @@ def get_provisioner_store(conf):
                                         conf['cassandra_username'],
                                         conf['cassandra_password'],
                                         conf.getValue('cassandra_keyspace'),
-                                        conf.getValue('cassandra_port'))
+                                        conf.getValue('cassandra_port'),
+                                        batch_size=conf.getValue('cassandra_batch_size'),
+                                        final_state_index_ttl=conf.getValue(
+                                            'cassandra_final_state_index_ttl'))
         except KeyError,e:
             raise KeyError("Provisioner config missing: " + str(e))
+    elif conf.getValue('indexed_memory_store'):
+        log.info("Using indexed in-memory Provisioner store")
+        store = IndexedProvisionerStore()
     else:
         log.info("Using in-memory Provisioner store")
         store = ProvisionerStore()
@@ -397,7 +468,9 @@ def get_context_client(conf):
     try:
         return ProvisionerContextClient(conf['context_uri'],
                                         conf['context_key'],
-                                        conf['context_secret'])
+                                        conf['context_secret'],
+                                        thread_pool_size=conf.getValue(
+                                            'context_thread_pool_size'))
     except KeyError,e:
         raise KeyError("Provisioner config missing: " + str(e))
 
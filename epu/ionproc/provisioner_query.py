@@ -1,6 +1,8 @@
 #!/usr/bin/env python
 from ion.core.process.process import ProcessDesc, ProcessFactory
 
+import time
+
 from twisted.internet import defer
 from twisted.internet.task import LoopingCall
 
@@ -9,13 +11,28 @@ from ion.core.process.service_process import ServiceProcess
 from ion.core.pack import app_supervisor
 
 from epu.ionproc.provisioner import ProvisionerClient
+from epu import states
 
 log = ion.util.ionlog.getLogger(__name__)
 
 DEFAULT_QUERY_INTERVAL = 10.0
 
+# Nodes that are past booting (RUNNING and later) are only queried this
+# often. Booting nodes and their contexts are queried every interval.
+DEFAULT_FULL_QUERY_INTERVAL = 60.0
+
+# query request for nodes that are booting, and launch contexts
+ACTIVE_QUERY = {'min_state': states.PENDING, 'max_state': states.STARTED,
+                'contexts': True}
+
 class ProvisionerQueryService(ServiceProcess):
     """Provisioner querying service
+
+    Every interval_seconds the provisioner is asked to query booting
+    (PENDING or STARTED) nodes and open contexts. Sites that have no such
+    nodes are not contacted. A full query of all nodes is sent every
+    full_interval_seconds. Set full_interval_seconds to 0 to always send
+    full queries.
     """
 
     declare = ServiceProcess.service_declare(name='provisioner_query',
@@ -25,18 +42,33 @@ class ProvisionerQueryService(ServiceProcess):
     def slc_init(self):
         interval = float(self.spawn_args.get("interval_seconds",
                                              DEFAULT_QUERY_INTERVAL))
+        full_interval = self.spawn_args.get("full_interval_seconds")
+        if full_interval is None:
+            full_interval = DEFAULT_FULL_QUERY_INTERVAL
+        self.full_interval = float(full_interval)
+        self.last_full_query = None
 
         self.client = ProvisionerClient(self)
 
-        log.debug('Starting provisioner query loop - %s second interval',
-                  interval)
-        self.loop = LoopingCall(self.query)
+        log.debug('Starting provisioner query loop - %s second interval, '+
+                  'full query every %s seconds', interval, self.full_interval)
+        self.loop = LoopingCall(self.tick)
         self.loop.start(interval)
 
     def slc_terminate(self):
         if self.loop:
             self.loop.stop()
 
+    def tick(self):
+        """Sends a full query if one is due, otherwise an active query
+        """
+        now = time.time()
+        if (self.last_full_query is None or
+                now - self.last_full_query >= self.full_interval):
+            self.last_full_query = now
+            return self.query()
+        return self.query_active()
+
     @defer.inlineCallbacks
     def query(self):
         try:
@@ -46,9 +78,20 @@ class ProvisionerQueryService(ServiceProcess):
                       exc_info=True)
 
     @defer.inlineCallbacks
-    def _do_query(self):
+    def query_active(self):
+        try:
+            yield self._do_query(ACTIVE_QUERY)
+        except Exception,e:
+            log.error("Error sending provisioner query request: %s", e,
+                      exc_info=True)
+
+    @defer.inlineCallbacks
+    def _do_query(self, request=None):
         log.debug("Sending query request to provisioner")
-        yield self.client.query()
+        if request is None:
+            yield self.client.query()
+        else:
+            yield self.client.query(request=request)
 
         # This is an unfortunate hack to work around a memory leak in ion.
         # Some caches are only cleared after a received message is handled.
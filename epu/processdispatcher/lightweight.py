@@ -1,4 +1,5 @@
-from itertools import ifilter
+import heapq
+from itertools import count, izip
 from twisted.internet import defer
 
 import ion.util.ionlog
@@ -25,6 +26,8 @@ class ProcessState(object):
 
         self.assigned = None
 
+        self.constraint_signature = make_signature(constraints)
+
     def check_resource_match(self, resource):
         return match_constraints(self.constraints, resource.properties)
 
@@ -73,11 +76,19 @@ class ExecutionEngineResource(object):
 
         self.last_heartbeat = None
         self.slot_count = 0
-        self.processes = {}
+        self.processes = set()
         self.pending = set()
 
+        # sequence number of the last incremental heartbeat, if any
+        self.heartbeat_seq = None
+
         self.enabled = True
 
+        self.property_signature = make_signature(properties)
+
+        # key of this resource's live entry in the ResourceIndex, if any
+        self.index_key = None
+
     @property
     def available_slots(self):
         if not self.enabled:
@@ -105,6 +116,222 @@ class ExecutionEngineResource(object):
         return match_constraints(process.constraints, self.properties)
 
 
+class ResourceIndex(object):
+    """Index of EE resources with available slots
+
+    Resources are bucketed by their properties, so constraints are matched
+    once per bucket instead of once per resource. Each bucket keeps a heap
+    of its resources with available slots, ordered by slot count so that
+    the smallest resource is preferred (a cheating way to try and enforce
+    compaction for now).
+
+    Heap entries are removed lazily: availability is checked when an entry
+    reaches the top of its heap, and update() must be called whenever a
+    resource may have gained available slots.
+    """
+    def __init__(self):
+        # property signature -> ResourceBucket
+        self.buckets = {}
+
+        # (constraint signature, property signature) -> bool
+        self.match_cache = {}
+
+        self.counter = count()
+
+    def update(self, resource):
+        """Add a resource to the index or refresh its availability
+        """
+        bucket = self.buckets.get(resource.property_signature)
+        if bucket is None:
+            bucket = ResourceBucket(resource.properties)
+            self.buckets[resource.property_signature] = bucket
+
+        if resource.available_slots <= 0:
+            return
+        if resource.index_key and resource.index_key[0] == resource.slot_count:
+            return
+
+        key = (resource.slot_count, self.counter.next())
+        resource.index_key = key
+        heapq.heappush(bucket.heap, (key, resource))
+
+    def remove(self, resource):
+        """Remove a resource from the index. Its heap entry is dropped lazily
+        """
+        resource.index_key = None
+        bucket = self.buckets.get(resource.property_signature)
+        if bucket is not None:
+            bucket.discard_stale()
+            if not bucket.heap:
+                del self.buckets[resource.property_signature]
+
+    def find(self, process):
+        """Find the best resource with an available slot for a process
+
+        @param process: L{ProcessState} to match
+        @retval L{ExecutionEngineResource} or None if no slot is available
+        """
+        best = None
+        for signature, bucket in self.buckets.iteritems():
+            if not self._matches(process, signature, bucket.properties):
+                continue
+            top = bucket.peek()
+            if top is not None and (best is None or top[0] < best[0]):
+                best = top
+        if best is None:
+            return None
+        return best[1]
+
+    def _matches(self, process, signature, properties):
+        cache_key = (process.constraint_signature, signature)
+        matched = self.match_cache.get(cache_key)
+        if matched is None:
+            matched = match_constraints(process.constraints, properties)
+            self.match_cache[cache_key] = matched
+        return matched
+
+
+class ResourceBucket(object):
+    """Resources in a ResourceIndex that share the same properties
+    """
+    def __init__(self, properties):
+        self.properties = properties
+        self.heap = []
+
+    def peek(self):
+        """Return the top (key, resource) entry with an available slot
+        """
+        self.discard_stale()
+        if self.heap:
+            return self.heap[0]
+        return None
+
+    def discard_stale(self):
+        heap = self.heap
+        while heap:
+            key, resource = heap[0]
+            if key == resource.index_key and resource.available_slots > 0:
+                return
+            heapq.heappop(heap)
+            if key == resource.index_key:
+                # resource is full or disabled. update() will add it back
+                resource.index_key = None
+
+
+class ProcessQueue(object):
+    """Priority queue of WAITING processes, indexed by constraints
+
+    Processes are bucketed by their constraint signature and each bucket is
+    a heap. Matching a resource checks each distinct set of constraints
+    once, rather than every queued process.
+
+    Processes are ordered by priority (higher first), then by round (higher
+    first, so processes that died and were rescheduled jump ahead of new
+    work), then by arrival. Removal by epid marks the heap entry dead and
+    it is dropped when it reaches the top of its bucket. Processes that
+    leave the WAITING state while queued are dropped the same way.
+    """
+    def __init__(self):
+        # constraint signature -> ProcessBucket
+        self.buckets = {}
+
+        # epid -> live [key, process] heap entry
+        self.entries = {}
+
+        # (constraint signature, property signature) -> bool
+        self.match_cache = {}
+
+        self.counter = count()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, epid):
+        return epid in self.entries
+
+    def put(self, process):
+        """Add a WAITING process to the queue, or reposition it if queued
+        """
+        self.remove(process.epid)
+
+        bucket = self.buckets.get(process.constraint_signature)
+        if bucket is None:
+            bucket = ProcessBucket(process.constraints)
+            self.buckets[process.constraint_signature] = bucket
+
+        key = (-process.priority, -process.round, self.counter.next())
+        entry = [key, process]
+        self.entries[process.epid] = entry
+        heapq.heappush(bucket.heap, entry)
+
+    def remove(self, epid):
+        """Remove a process from the queue
+
+        @param epid: process to remove
+        @retval L{ProcessState} that was removed, or None if not queued
+        """
+        entry = self.entries.pop(epid, None)
+        if entry is None:
+            return None
+        process = entry[1]
+        entry[1] = None
+        return process
+
+    def pop_match(self, resource):
+        """Remove and return the first queued process a resource can run
+
+        @param resource: L{ExecutionEngineResource} with an available slot
+        @retval L{ProcessState} or None if no queued process matches
+        """
+        best = None
+        for signature, bucket in self.buckets.items():
+            top = self._peek(bucket)
+            if top is None:
+                del self.buckets[signature]
+                continue
+            if not self._matches(resource, signature, bucket.constraints):
+                continue
+            if best is None or top[0] < best[0]:
+                best = top
+
+        if best is None:
+            return None
+        return self.remove(best[1].epid)
+
+    def _peek(self, bucket):
+        while True:
+            top = bucket.peek()
+            if top is None or top[1].state == ProcessStates.WAITING:
+                return top
+            self.remove(top[1].epid)
+
+    def _matches(self, resource, signature, constraints):
+        cache_key = (signature, resource.property_signature)
+        matched = self.match_cache.get(cache_key)
+        if matched is None:
+            matched = match_constraints(constraints, resource.properties)
+            self.match_cache[cache_key] = matched
+        return matched
+
+
+class ProcessBucket(object):
+    """Queued processes in a ProcessQueue that share the same constraints
+    """
+    def __init__(self, constraints):
+        self.constraints = constraints
+        self.heap = []
+
+    def peek(self):
+        """Return the top [key, process] entry that has not been removed
+        """
+        heap = self.heap
+        while heap and heap[0][1] is None:
+            heapq.heappop(heap)
+        if heap:
+            return heap[0]
+        return None
+
+
 class ProcessDispatcherCore(object):
     """Service that fields requests from application engines and operators
     for process launches and termination.
@@ -142,11 +369,13 @@ class ProcessDispatcherCore(object):
         self.resources = {}
         self.nodes = {}
 
-        self.queue = []
+        self.resource_index = ResourceIndex()
+        self.queue = ProcessQueue()
 
 
     @defer.inlineCallbacks
-    def dispatch_process(self, epid, spec, subscribers, constraints=None, immediate=False):
+    def dispatch_process(self, epid, spec, subscribers, constraints=None,
+                         immediate=False, priority=0):
         """Dispatch a new process into the system
 
         @param epid: unique process identifier
@@ -154,6 +383,7 @@ class ProcessDispatcherCore(object):
         @param subscribers: where to send status updates of this process
         @param constraints: optional scheduling constraints (IaaS site? other stuff?)
         @param immediate: don't provision new resources if no slots are available
+        @param priority: processes with higher priority leave the queue first
         @rtype: L{ProcessState}
         @return: description of process launch status
 
@@ -186,7 +416,8 @@ class ProcessDispatcherCore(object):
                 defer.returnValue(self.processes[epid])
 
             process = ProcessState(epid, spec, ProcessStates.REQUESTED,
-                                   subscribers, constraints, immediate=immediate)
+                                   subscribers, constraints, priority=priority,
+                                   immediate=immediate)
 
             self.processes[epid] = process
 
@@ -196,6 +427,68 @@ class ProcessDispatcherCore(object):
             log.exception("faillll")
             raise
 
+    @defer.inlineCallbacks
+    def dispatch_processes(self, requests):
+        """Dispatch a batch of new processes into the system
+
+        @param requests: sequence of dicts, each with the epid, spec,
+            subscribers and optional constraints, immediate and priority
+            parameters of dispatch_process()
+        @rtype: list of L{ProcessState}
+        @return: description of each process launch status, in request order
+
+        The whole batch is matchmade in one pass and dispatches are sent as
+        a single request per EEAgent. Retry semantics are the same as for
+        dispatch_process(): epids that are already known are not repeated
+        and their current state is returned.
+
+        Every request is validated before any process is recorded, so a
+        malformed entry rejects the whole batch without side effects. If
+        the send to an EEAgent fails, its processes are released from
+        their slots and go back to the queue as WAITING.
+        """
+        new_processes = {}
+        batch = []
+        for request in requests:
+            epid = request['epid']
+            process = self.processes.get(epid) or new_processes.get(epid)
+            if process is None:
+                process = ProcessState(epid, request['spec'],
+                                       ProcessStates.REQUESTED,
+                                       request.get('subscribers'),
+                                       request.get('constraints'),
+                                       priority=int(request.get('priority') or 0),
+                                       immediate=bool(request.get('immediate')))
+                new_processes[epid] = process
+            batch.append(process)
+
+        matched = {}
+        for process in batch:
+            if process.epid not in new_processes or \
+               process.epid in self.processes:
+                continue
+            self.processes[process.epid] = process
+
+            resource = self._match_process(process)
+            if resource is not None:
+                self._assign_process(process, resource)
+                matched.setdefault(resource.ee_id, []).append(process)
+
+        ees = matched.keys()
+        results = yield defer.DeferredList(
+            [self.eeagent_client.dispatch_processes(ee,
+                [(p.epid, p.round, p.spec) for p in matched[ee]])
+             for ee in ees], consumeErrors=True)
+        for ee, (success, result) in izip(ees, results):
+            if not success:
+                log.error("Failed to dispatch %d processes to %s. Requeuing",
+                          len(matched[ee]), ee, exc_info=(result.type,
+                          result.value, result.getTracebackObject()))
+                for process in matched[ee]:
+                    self._release_process(process)
+
+        defer.returnValue(batch)
+
     def _matchmake_process(self, process):
         """Match process against available resources and dispatch if matched
 
@@ -203,12 +496,24 @@ class ProcessDispatcherCore(object):
         @return:
         """
 
-        # do an inefficient search, shrug
-        not_full = ifilter(lambda r: r.available_slots > 0,
-                           self.resources.itervalues())
-        matching = filter(process.check_resource_match, not_full)
+        resource = self._match_process(process)
+
+        if resource is None:
+            return defer.succeed(None)
+        else:
+            return self._dispatch_matched_process(process, resource)
+
+    def _match_process(self, process):
+        """Find a resource for a process, or queue or reject it
+
+        @param process: L{ProcessState} to match
+        @retval L{ExecutionEngineResource} with a slot for the process, or
+            None if the process is now WAITING or REJECTED
+        """
+
+        resource = self.resource_index.find(process)
 
-        if not matching:
+        if resource is None:
 
             if process.immediate:
                 log.info("Process %s: no available slots. "+
@@ -220,20 +525,23 @@ class ProcessDispatcherCore(object):
                      process.epid)
 
                 process.state = ProcessStates.WAITING
-                self.queue.append(process)
-
-            return defer.succeed(None)
-
-        else:
-            # pick a resource with the lowest available slot count, cheating
-            # way to try and enforce compaction for now.
-            resource = min(matching, key=lambda r: r.slot_count)
+                self.queue.put(process)
 
-            return self._dispatch_matched_process(process, resource)
+        return resource
 
     def _dispatch_matched_process(self, process, resource):
         """Enact a match between process and resource
         """
+        self._assign_process(process, resource)
+
+        return self.eeagent_client.dispatch_process(resource.ee_id,
+                                                    process.epid,
+                                                    process.round,
+                                                    process.spec)
+
+    def _assign_process(self, process, resource):
+        """Record a match between process and resource
+        """
         ee = resource.ee_id
 
         log.info("Process %s assigned slot on %s. PENDING!", process.epid, ee)
@@ -243,9 +551,17 @@ class ProcessDispatcherCore(object):
 
         resource.add_pending_process(process)
 
-        return self.eeagent_client.dispatch_process(ee, process.epid,
-                                                    process.round,
-                                                    process.spec)
+    def _release_process(self, process):
+        """Undo a match whose dispatch was never sent, and requeue the process
+        """
+        resource = self.resources.get(process.assigned)
+        if resource is not None:
+            resource.pending.discard(process.epid)
+            self.resource_index.update(resource)
+
+        process.assigned = None
+        process.state = ProcessStates.WAITING
+        self.queue.put(process)
 
     @defer.inlineCallbacks
     def terminate_process(self, epid):
@@ -273,6 +589,7 @@ class ProcessDispatcherCore(object):
             defer.returnValue(process)
 
         if process.assigned is None:
+            self.queue.remove(epid)
             process.state = ProcessStates.TERMINATED
             defer.returnValue(process)
 
@@ -281,6 +598,62 @@ class ProcessDispatcherCore(object):
         process.state = ProcessStates.TERMINATING
         defer.returnValue(process)
 
+    @defer.inlineCallbacks
+    def terminate_processes(self, epids):
+        """Kill a batch of processes
+
+        @param epids: sequence of process IDs
+        @rtype: list of L{ProcessState}
+        @return: description of each process termination status, in the
+            order of epids. Unknown epids have a None result.
+
+        Terminate requests are sent as a single request per EEAgent. Like
+        terminate_process(), this operation is idempotent and can be
+        safely retried.
+
+        Processes are marked TERMINATING before the requests are sent, and
+        every EEAgent is sent its request even if another fails. If any
+        send fails the error is raised after all have been attempted, and
+        a retry resends terminates for the processes still TERMINATING.
+        """
+        results = []
+        assigned = {}
+        seen = set()
+        for epid in epids:
+            process = self.processes.get(epid)
+            if process is None:
+                log.warn("Asked to terminate unknown process %s", epid)
+                results.append(None)
+                continue
+            results.append(process)
+
+            if epid in seen or process.state >= ProcessStates.TERMINATED:
+                continue
+            seen.add(epid)
+
+            if process.assigned is None:
+                self.queue.remove(epid)
+                process.state = ProcessStates.TERMINATED
+            else:
+                process.state = ProcessStates.TERMINATING
+                assigned.setdefault(process.assigned, []).append(epid)
+
+        ees = assigned.keys()
+        sends = yield defer.DeferredList(
+            [self.eeagent_client.terminate_processes(ee, assigned[ee])
+             for ee in ees], consumeErrors=True)
+        failure = None
+        for ee, (success, result) in izip(ees, sends):
+            if not success:
+                log.error("Failed to terminate %d processes on %s",
+                          len(assigned[ee]), ee, exc_info=(result.type,
+                          result.value, result.getTracebackObject()))
+                failure = failure or result
+        if failure is not None:
+            failure.raiseException()
+
+        defer.returnValue(results)
+
     @defer.inlineCallbacks
     def dt_state(self, node_id, deployable_type, state, properties=None):
         """
@@ -324,7 +697,7 @@ class ProcessDispatcherCore(object):
 
             # go through resources on this node and reschedule any processes
             for resource in node.resources:
-                for epid in resource.processes:
+                for epid in list(resource.processes):
 
                     process = self.processes.get(epid)
                     if process is None:
@@ -353,6 +726,7 @@ class ProcessDispatcherCore(object):
             del self.nodes[node_id]
             for resource in node.resources:
                 del self.resources[resource.ee_id]
+                self.resource_index.remove(resource)
 
     @defer.inlineCallbacks
     def ee_heartbeart(self, sender, beat):
@@ -372,12 +746,25 @@ class ProcessDispatcherCore(object):
             - timestamp - time heartbeat was generated
             - processes - list of running process IDs
             - slot_count - number of available slots
+
+        EEAgents may also send incremental heartbeats, with these fields:
+            - seq - heartbeat sequence number, increasing by one per beat
+            - full - False when processes only lists (epid, round, state)
+                     for processes that changed since the previous beat
+
+        A full heartbeat always replaces what the PD knows about the EE.
+        Incremental heartbeats that arrive out of order are dropped. If
+        one or more are missed, the PD still applies the one it has (process
+        reports are ordered by round and state, so this is safe) and asks
+        the EEAgent to resync with a full heartbeat.
         """
 
         node_id = beat['node_id']
         engine_type = beat['engine_type']
         processes = beat['processes']
         slot_count = int(beat['slot_count'])
+        seq = beat.get('seq')
+        full = beat.get('full', True)
 
         resource = self.resources.get(sender)
         if resource is None:
@@ -414,11 +801,29 @@ class ProcessDispatcherCore(object):
             log.info("Got first heartbeat from EEAgent %s on node %s",
                      sender, node_id)
 
-        running_epids = []
+        resync = False
+        if seq is not None:
+            last_seq = resource.heartbeat_seq
+            if not full:
+                if last_seq is not None and seq <= last_seq:
+                    log.debug("Dropping stale heartbeat %s from EEAgent %s",
+                              seq, sender)
+                    defer.returnValue(None)
+
+                resync = last_seq is None or seq != last_seq + 1
+            resource.heartbeat_seq = seq
+
+        if full:
+            running_epids = set()
+        else:
+            running_epids = resource.processes
+
         for epid, round, state in processes:
 
             if state <= ProcessStates.RUNNING:
-                running_epids.append(epid)
+                running_epids.add(epid)
+            else:
+                running_epids.discard(epid)
 
             process = self.processes.get(epid)
             if not process:
@@ -468,10 +873,17 @@ class ProcessDispatcherCore(object):
                 yield self.eeagent_client.cleanup_process(sender, epid)
 
         resource.processes = running_epids
-        
+
+        if resync:
+            log.info("Missed heartbeats from EEAgent %s. Requesting resync",
+                     sender)
+            yield self.eeagent_client.resync(sender)
+
         new_slots_available = slot_count > resource.slot_count
         resource.slot_count = slot_count
 
+        self.resource_index.update(resource)
+
         if new_slots_available:
             yield self._consider_resource(resource)
 
@@ -483,7 +895,7 @@ class ProcessDispatcherCore(object):
         for resource in self.resources.itervalues():
             resource_dict = dict(ee_id=resource.ee_id,
                                  node_id=resource.node_id,
-                                 processes=resource.processes,
+                                 processes=list(resource.processes),
                                  slot_count=resource.slot_count)
             resources[resource.ee_id] = resource_dict
 
@@ -505,19 +917,13 @@ class ProcessDispatcherCore(object):
         @param resource: The resource with new slots
         @return: None
         """
-        matched = set()
-        for process in ifilter(resource.check_process_match, self.queue):
-
-            if not resource.available_slots:
+        while resource.available_slots:
+            process = self.queue.pop_match(resource)
+            if process is None:
                 break
 
-            matched.add(process.epid)
             yield self._dispatch_matched_process(process, resource)
 
-        # dumb slow whatever.
-        if matched:
-            self.queue = [p for p in self.queue if p.epid not in matched]
-
 
 def match_constraints(constraints, properties):
     """Match process constraints against resource properties
@@ -547,3 +953,25 @@ def match_constraints(constraints, properties):
 
     return True
 
+
+def make_signature(d):
+    """Make a hashable signature of a constraints or properties dict
+
+    Equal dicts have equal signatures. None values are left out since they
+    are ignored when matching constraints.
+    """
+    if not d:
+        return ()
+    return tuple(sorted((key, _freeze(value)) for key, value in d.iteritems()
+                        if value is not None))
+
+
+def _freeze(value):
+    if isinstance(value, dict):
+        return make_signature(value)
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(v) for v in value)
+    if isinstance(value, (set, frozenset)):
+        return frozenset(_freeze(v) for v in value)
+    return value
+
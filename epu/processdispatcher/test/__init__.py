@@ -18,8 +18,18 @@ class FakeEEAgent(Process):
         self.node_id = self.spawn_args['node_id']
         self.slot_count = int(self.spawn_args['slot_count'])
 
+        # send incremental heartbeats, with a full one at start and on resync
+        self.incremental = bool(self.spawn_args.get('incremental'))
+        self.seq = 0
+        self.changed = set()
+        self.needs_full = True
+        self.resync_count = 0
+
         self.processes = {}
 
+        # number of dispatch_processes/terminate_processes requests handled
+        self.batch_requests = 0
+
         # keep around old processes til they are cleaned up
         self.history = []
 
@@ -34,6 +44,19 @@ class FakeEEAgent(Process):
 
         if epid not in self.processes:
             self.processes[epid] = process
+            self.changed.add(epid)
+        yield self.send_heartbeat()
+
+    @defer.inlineCallbacks
+    def op_dispatch_processes(self, content, headers, msg):
+        self.batch_requests += 1
+        for request in content['processes']:
+            epid = request['epid']
+            process = dict(epid=epid, spec=request['spec'],
+                           state=ProcessStates.RUNNING, round=request['round'])
+            if epid not in self.processes:
+                self.processes[epid] = process
+                self.changed.add(epid)
         yield self.send_heartbeat()
 
     def op_terminate(self, content, headers, msg):
@@ -42,6 +65,17 @@ class FakeEEAgent(Process):
         if process:
             process['state'] = ProcessStates.TERMINATED
             self.history.append(process)
+            self.changed.add(epid)
+        return self.send_heartbeat()
+
+    def op_terminate_processes(self, content, headers, msg):
+        self.batch_requests += 1
+        for epid in content['epids']:
+            process = self.processes.pop(epid, None)
+            if process:
+                process['state'] = ProcessStates.TERMINATED
+                self.history.append(process)
+                self.changed.add(epid)
         return self.send_heartbeat()
 
     def op_cleanup(self, content, headers, msg):
@@ -50,19 +84,34 @@ class FakeEEAgent(Process):
             del self.history[epid]
         return defer.succeed(None)
 
-    def make_heartbeat(self, timestamp=None):
+    def op_resync(self, content, headers, msg):
+        self.resync_count += 1
+        self.needs_full = True
+        return self.send_heartbeat()
+
+    def make_heartbeat(self, timestamp=None, full=None):
         now = time.time() if timestamp is None else timestamp
+        if full is None:
+            full = not self.incremental or self.needs_full
 
         # processes format is a list of (epid, round, state) tuples
         processes = []
-        for process in chain(self.processes.itervalues(), self.history):
-            p = (process['epid'], process['round'], process['state'])
-            processes.append(p)
+        for process in chain(self.history, self.processes.itervalues()):
+            if full or process['epid'] in self.changed:
+                p = (process['epid'], process['round'], process['state'])
+                processes.append(p)
 
         available_slots = self.slot_count - len(self.processes)
 
         beat = dict(node_id=self.node_id, timestamp=now, processes=processes,
                     slot_count=available_slots, engine_type=self.engine_type)
+
+        if self.incremental:
+            self.seq += 1
+            beat['seq'] = self.seq
+            beat['full'] = full
+            self.changed.clear()
+            self.needs_full = False
         return beat
 
     def send_heartbeat(self, timestamp=None):
@@ -75,7 +124,69 @@ class FakeEEAgent(Process):
         process = self.processes.pop(epid)
         process['state'] = ProcessStates.FAILED
         self.history.append(process)
+        self.changed.add(epid)
         return self.send_heartbeat()
 
 
+class FakeEEAgentClient(object):
+    """Records requests the PD core makes of EEAgents, without sending them
+    """
+    def __init__(self):
+        self.dispatched = []
+        self.terminated = []
+        self.cleaned = []
+
+        # number of requests sent, as opposed to processes
+        self.dispatch_requests = 0
+        self.terminate_requests = 0
+
+        self.resyncs = []
+
+        # EEAgents that bulk requests fail to reach
+        self.failing = set()
+
+    def dispatch_process(self, eeagent, epid, round, spec):
+        self.dispatch_requests += 1
+        self.dispatched.append((eeagent, epid, round))
+        return defer.succeed(None)
+
+    def dispatch_processes(self, eeagent, processes):
+        self.dispatch_requests += 1
+        if eeagent in self.failing:
+            return defer.fail(Exception("can't reach %s" % eeagent))
+        for epid, round, spec in processes:
+            self.dispatched.append((eeagent, epid, round))
+        return defer.succeed(None)
+
+    def terminate_process(self, eeagent, epid):
+        self.terminate_requests += 1
+        self.terminated.append((eeagent, epid))
+        return defer.succeed(None)
+
+    def terminate_processes(self, eeagent, epids):
+        self.terminate_requests += 1
+        if eeagent in self.failing:
+            return defer.fail(Exception("can't reach %s" % eeagent))
+        for epid in epids:
+            self.terminated.append((eeagent, epid))
+        return defer.succeed(None)
+
+    def cleanup_process(self, eeagent, epid):
+        self.cleaned.append((eeagent, epid))
+        return defer.succeed(None)
+
+    def resync(self, eeagent):
+        self.resyncs.append(eeagent)
+        return defer.succeed(None)
+
+
+class FakeSubscriberNotifier(object):
+    def __init__(self):
+        self.notified = []
+
+    def notify_process(self, process):
+        self.notified.append((process.epid, process.state))
+        return defer.succeed(None)
+
+
 factory = ProcessFactory(FakeEEAgent)
\ No newline at end of file
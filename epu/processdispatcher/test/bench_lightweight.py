@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+
+"""
+@file epu/processdispatcher/test/bench_lightweight.py
+@brief Process Dispatcher core benchmarks
+
+Run with: python -m epu.processdispatcher.test.bench_lightweight
+"""
+
+import time
+
+from twisted.internet import defer
+
+from epu.processdispatcher.lightweight import ProcessDispatcherCore, \
+    ExecutionEngineRegistry, ProcessStates
+from epu.processdispatcher.test import FakeEEAgentClient, \
+    FakeSubscriberNotifier
+from epu.test import run_benchmarks, print_benchmark
+import epu.states as InstanceStates
+
+ENGINE_TYPES = ["engine%d" % i for i in range(5)]
+SITES = ["site%d" % i for i in range(4)]
+
+
+def _get_core():
+    return ProcessDispatcherCore(ExecutionEngineRegistry(),
+                                 FakeEEAgentClient(), FakeSubscriberNotifier())
+
+
+def _constraints(i):
+    # a mix of fully, partly and un-constrained processes
+    if i % 4 == 0:
+        return None
+    constraints = dict(engine_type=ENGINE_TYPES[i % len(ENGINE_TYPES)])
+    if i % 2:
+        constraints['site'] = SITES[i % len(SITES)]
+    return constraints
+
+
+@defer.inlineCallbacks
+def _add_resources(core, resource_count, slot_count):
+    for i in xrange(resource_count):
+        node_id = "node%d" % i
+        properties = dict(site=SITES[i % len(SITES)])
+        yield core.dt_state(node_id, "dt1", InstanceStates.RUNNING, properties)
+        beat = dict(node_id=node_id, processes=[], slot_count=slot_count,
+                    engine_type=ENGINE_TYPES[i % len(ENGINE_TYPES)])
+        yield core.ee_heartbeart("ee%d" % i, beat)
+
+
+@defer.inlineCallbacks
+def bench_matchmaking(resource_count=10000, process_count=100000,
+                      slot_count=4):
+    """Dispatch against many resources, then drain a large waiting queue
+    """
+    core = _get_core()
+    yield _add_resources(core, resource_count, slot_count)
+
+    start = time.time()
+    for i in xrange(process_count):
+        yield core.dispatch_process("proc%d" % i, {}, None, _constraints(i))
+    elapsed = time.time() - start
+    print_benchmark("dispatch_process resources=%d" % resource_count,
+                    process_count, elapsed, "processes")
+
+    queued = len(core.queue)
+    dispatched = len(core.eeagent_client.dispatched)
+    print "    %d dispatched, %d waiting" % (dispatched, queued)
+
+    # every resource doubles its slots, pulling work from the queue
+    start = time.time()
+    for i in xrange(resource_count):
+        beat = dict(node_id="node%d" % i, processes=[],
+                    slot_count=slot_count * 2,
+                    engine_type=ENGINE_TYPES[i % len(ENGINE_TYPES)])
+        yield core.ee_heartbeart("ee%d" % i, beat)
+    elapsed = time.time() - start
+    print_benchmark("ee_heartbeat queue drain queued=%d" % queued,
+                    resource_count, elapsed, "heartbeats")
+    print "    %d dispatched, %d waiting" % (
+        len(core.eeagent_client.dispatched) - dispatched, len(core.queue))
+
+
+class _SimulatedEE(object):
+    """Minimal EEAgent that reports processes by heartbeat
+    """
+    def __init__(self, ee_id, node_id, slot_count, incremental):
+        self.ee_id = ee_id
+        self.node_id = node_id
+        self.slot_count = slot_count
+        self.incremental = incremental
+
+        # epid -> (round, state)
+        self.processes = {}
+        self.changed = set()
+        self.seq = 0
+
+    def set_process(self, epid, round, state):
+        self.processes[epid] = (round, state)
+        self.changed.add(epid)
+
+    def make_heartbeat(self):
+        full = not self.incremental or self.seq == 0
+        if full:
+            epids = self.processes.keys()
+        else:
+            epids = self.changed
+        processes = [(epid,) + self.processes[epid] for epid in epids]
+
+        running = sum(1 for _, state in self.processes.itervalues()
+                      if state <= ProcessStates.RUNNING)
+        beat = dict(node_id=self.node_id, engine_type=ENGINE_TYPES[0],
+                    processes=processes, slot_count=self.slot_count - running)
+        if self.incremental:
+            self.seq += 1
+            beat['seq'] = self.seq
+            beat['full'] = full
+
+        # processes that were reported dead are cleaned up right away
+        for epid, round, state in processes:
+            if state > ProcessStates.RUNNING:
+                del self.processes[epid]
+        self.changed.clear()
+        return beat
+
+
+@defer.inlineCallbacks
+def bench_heartbeats(ee_count=1000, processes_per_ee=40, seconds=10):
+    """Simulated EEs heartbeating at 1 Hz, full beats vs incremental beats
+
+    Each simulated second a tenth of the EEs have one process terminated.
+    """
+    for incremental in (False, True):
+        core = _get_core()
+        ees = []
+        for i in xrange(ee_count):
+            ee = _SimulatedEE("ee%d" % i, "node%d" % i, processes_per_ee,
+                              incremental)
+            ees.append(ee)
+            yield core.dt_state(ee.node_id, "dt1", InstanceStates.RUNNING)
+            yield core.ee_heartbeart(ee.ee_id, ee.make_heartbeat())
+
+        by_ee = dict((ee.ee_id, ee) for ee in ees)
+        for i in xrange(ee_count * processes_per_ee):
+            process = yield core.dispatch_process("proc%d" % i, {}, None)
+            by_ee[process.assigned].set_process(process.epid, 0,
+                                                ProcessStates.RUNNING)
+
+        elapsed = 0.0
+        for second in xrange(seconds):
+            for i, ee in enumerate(ees):
+                if i % 10 == second % 10 and ee.processes:
+                    epid = ee.processes.iterkeys().next()
+                    yield core.terminate_process(epid)
+                    ee.set_process(epid, 0, ProcessStates.TERMINATED)
+
+            beats = [(ee.ee_id, ee.make_heartbeat()) for ee in ees]
+            start = time.time()
+            for ee_id, beat in beats:
+                yield core.ee_heartbeart(ee_id, beat)
+            elapsed += time.time() - start
+
+        name = "ee_heartbeat %s ees=%d processes=%d" % (
+            "incremental" if incremental else "full", ee_count,
+            processes_per_ee)
+        print_benchmark(name, ee_count * seconds, elapsed, "heartbeats")
+
+
+if __name__ == '__main__':
+    run_benchmarks(bench_matchmaking, bench_heartbeats)
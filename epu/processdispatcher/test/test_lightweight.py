@@ -0,0 +1,354 @@
+from twisted.trial import unittest
+from twisted.internet import defer
+
+from epu.processdispatcher.lightweight import ProcessDispatcherCore, \
+    ExecutionEngineRegistry, ProcessStates
+from epu.processdispatcher.test import FakeEEAgentClient, \
+    FakeSubscriberNotifier
+import epu.states as InstanceStates
+
+
+class ProcessDispatcherCoreTests(unittest.TestCase):
+
+    def setUp(self):
+        self.eeagent_client = FakeEEAgentClient()
+        self.notifier = FakeSubscriberNotifier()
+        self.core = ProcessDispatcherCore(ExecutionEngineRegistry(),
+                                          self.eeagent_client, self.notifier)
+
+    @defer.inlineCallbacks
+    def _add_resource(self, ee_id, node_id, slot_count, engine_type,
+                      properties=None):
+        if node_id not in self.core.nodes:
+            yield self.core.dt_state(node_id, "dt1", InstanceStates.RUNNING,
+                                     properties)
+        beat = dict(node_id=node_id, engine_type=engine_type, processes=[],
+                    slot_count=slot_count)
+        yield self.core.ee_heartbeart(ee_id, beat)
+
+    def _assert_assigned(self, epid, ee_id):
+        process = self.core.processes[epid]
+        self.assertEqual(process.assigned, ee_id)
+        if ee_id is None:
+            self.assertEqual(process.state, ProcessStates.WAITING)
+        else:
+            self.assertEqual(process.state, ProcessStates.PENDING)
+
+    @defer.inlineCallbacks
+    def test_matchmake_constraints(self):
+        yield self._add_resource("ee1", "node1", 1, "engine1")
+        yield self._add_resource("ee2", "node2", 3, "engine2")
+        yield self._add_resource("ee3", "node3", 2, "engine2")
+
+        yield self.core.dispatch_process("p1", {}, None,
+                                         dict(engine_type="engine2"))
+        yield self.core.dispatch_process("p2", {}, None,
+                                         dict(engine_type="engine1"))
+        yield self.core.dispatch_process("p3", {}, None,
+                                         dict(engine_type="engine1"))
+        yield self.core.dispatch_process("p4", {}, None,
+                                         dict(engine_type=["engine3", "engine2"]))
+
+        # smallest matching resource is preferred
+        self._assert_assigned("p1", "ee3")
+        self._assert_assigned("p2", "ee1")
+        self._assert_assigned("p3", None)
+        self._assert_assigned("p4", "ee3")
+
+        # ee3 is now full so the next engine2 process goes to ee2
+        yield self.core.dispatch_process("p5", {}, None,
+                                         dict(engine_type="engine2"))
+        self._assert_assigned("p5", "ee2")
+
+    @defer.inlineCallbacks
+    def test_queue_drain(self):
+        for i in range(3):
+            yield self.core.dispatch_process("a%d" % i, {}, None,
+                                             dict(engine_type="engine1"))
+            yield self.core.dispatch_process("b%d" % i, {}, None,
+                                             dict(engine_type="engine2"))
+        self.assertEqual(len(self.core.queue), 6)
+
+        # terminating a waiting process takes it out of consideration
+        yield self.core.terminate_process("a0")
+
+        yield self._add_resource("ee1", "node1", 2, "engine1")
+        self._assert_assigned("a1", "ee1")
+        self._assert_assigned("a2", "ee1")
+        for epid in ("b0", "b1", "b2"):
+            self._assert_assigned(epid, None)
+        self.assertEqual(self.core.processes["a0"].state,
+                         ProcessStates.TERMINATED)
+
+        # more slots on a resource drain the matching processes in order
+        yield self._add_resource("ee2", "node2", 2, "engine2")
+        self._assert_assigned("b0", "ee2")
+        self._assert_assigned("b1", "ee2")
+        self._assert_assigned("b2", None)
+
+        beat = dict(node_id="node2", engine_type="engine2", processes=[],
+                    slot_count=3)
+        yield self.core.ee_heartbeart("ee2", beat)
+        self._assert_assigned("b2", "ee2")
+        self.assertEqual(len(self.core.queue), 0)
+
+    @defer.inlineCallbacks
+    def test_node_properties(self):
+        yield self._add_resource("ee1", "node1", 2, "engine1",
+                                 dict(site="chicago"))
+        yield self._add_resource("ee2", "node2", 2, "engine1",
+                                 dict(site="ec2-east"))
+
+        yield self.core.dispatch_process("p1", {}, None,
+                                         dict(site="ec2-east"))
+        yield self.core.dispatch_process("p2", {}, None,
+                                         dict(site="ec2-west"))
+        self._assert_assigned("p1", "ee2")
+        self._assert_assigned("p2", None)
+
+        # node death reschedules its processes onto remaining resources
+        yield self.core.dispatch_process("p3", {}, None)
+        self._assert_assigned("p3", "ee1")
+        beat = dict(node_id="node1", engine_type="engine1", slot_count=2,
+                    processes=[("p3", 0, ProcessStates.RUNNING)])
+        yield self.core.ee_heartbeart("ee1", beat)
+
+        yield self.core.dt_state("node1", "dt1", InstanceStates.TERMINATING)
+        self.assertFalse("ee1" in self.core.resources)
+        self.assertEqual(self.core.processes["p3"].round, 1)
+        self._assert_assigned("p3", "ee2")
+
+    @defer.inlineCallbacks
+    def test_queue_priority(self):
+        yield self.core.dispatch_process("p1", {}, None)
+        yield self.core.dispatch_process("p2", {}, None, priority=5)
+        yield self.core.dispatch_process("p3", {}, None)
+        yield self.core.dispatch_process("p4", {}, None, priority=5)
+        yield self.core.dispatch_process("p5", {}, None, priority=-1)
+
+        yield self.core.terminate_process("p3")
+        self.assertEqual(len(self.core.queue), 4)
+        self.assertFalse("p3" in self.core.queue)
+
+        # higher priority first, FIFO within a priority
+        yield self._add_resource("ee1", "node1", 4, "engine1")
+        dispatched = [epid for _, epid, _ in self.eeagent_client.dispatched]
+        self.assertEqual(dispatched, ["p2", "p4", "p1", "p5"])
+        self.assertEqual(len(self.core.queue), 0)
+
+    @defer.inlineCallbacks
+    def test_queue_died_first(self):
+        yield self._add_resource("ee1", "node1", 2, "engine1")
+        yield self._add_resource("ee2", "node2", 1, "engine1")
+
+        for epid in ("p1", "p2", "p3"):
+            yield self.core.dispatch_process(epid, {}, None)
+        running = [(epid, 0, ProcessStates.RUNNING) for epid in ("p2", "p3")]
+        beat = dict(node_id="node1", engine_type="engine1", slot_count=0,
+                    processes=running)
+        yield self.core.ee_heartbeart("ee1", beat)
+
+        # new work queues up behind the full resources
+        yield self.core.dispatch_process("p4", {}, None)
+        yield self.core.dispatch_process("p5", {}, None)
+
+        # node1 dies and its processes are rescheduled ahead of new work
+        yield self.core.dt_state("node1", "dt1", InstanceStates.TERMINATING)
+        for epid in ("p2", "p3"):
+            self.assertEqual(self.core.processes[epid].round, 1)
+            self._assert_assigned(epid, None)
+
+        self.eeagent_client.dispatched[:] = []
+        yield self._add_resource("ee3", "node3", 3, "engine1")
+        dispatched = [epid for _, epid, _ in self.eeagent_client.dispatched]
+        self.assertEqual(dispatched, ["p2", "p3", "p4"])
+        self._assert_assigned("p5", None)
+
+    @defer.inlineCallbacks
+    def test_dispatch_processes(self):
+        yield self._add_resource("ee1", "node1", 3, "engine1")
+        yield self._add_resource("ee2", "node2", 3, "engine2")
+
+        requests = []
+        for i in range(4):
+            requests.append(dict(epid="a%d" % i, spec={}, subscribers=None,
+                                 constraints=dict(engine_type="engine1")))
+        requests.append(dict(epid="b0", spec={}, subscribers=None,
+                             constraints=dict(engine_type="engine2")))
+        requests.append(dict(epid="c0", spec={}, subscribers=None,
+                             constraints=dict(engine_type="engine3"),
+                             immediate=True))
+
+        results = yield self.core.dispatch_processes(requests)
+        self.assertEqual([p.epid for p in results],
+                         [r['epid'] for r in requests])
+        for epid in ("a0", "a1", "a2"):
+            self._assert_assigned(epid, "ee1")
+        self._assert_assigned("a3", None)
+        self._assert_assigned("b0", "ee2")
+        self.assertEqual(self.core.processes["c0"].state,
+                         ProcessStates.REJECTED)
+
+        # one request per EEAgent
+        self.assertEqual(self.eeagent_client.dispatch_requests, 2)
+        self.assertEqual(len(self.eeagent_client.dispatched), 4)
+
+        # retrying the batch repeats nothing
+        results = yield self.core.dispatch_processes(requests)
+        self.assertEqual(len(results), len(requests))
+        self.assertEqual(self.eeagent_client.dispatch_requests, 2)
+        self.assertEqual(len(self.core.queue), 1)
+
+    @defer.inlineCallbacks
+    def test_dispatch_processes_bad_request(self):
+        yield self._add_resource("ee1", "node1", 3, "engine1")
+
+        requests = [dict(epid="p%d" % i, spec={}, subscribers=None)
+                    for i in range(3)]
+        del requests[1]['spec']
+        try:
+            yield self.core.dispatch_processes(requests)
+        except KeyError:
+            pass
+        else:
+            self.fail("Expected KeyError")
+
+        # nothing was recorded, assigned or sent
+        self.assertEqual(self.core.processes, {})
+        self.assertEqual(self.core.resources["ee1"].pending, set())
+        self.assertEqual(self.eeagent_client.dispatch_requests, 0)
+
+        requests[1]['spec'] = {}
+        requests[2]['priority'] = "5"
+        yield self.core.dispatch_processes(requests)
+        for epid in ("p0", "p1", "p2"):
+            self._assert_assigned(epid, "ee1")
+        self.assertEqual(self.core.processes["p2"].priority, 5)
+
+    @defer.inlineCallbacks
+    def test_dispatch_processes_send_failure(self):
+        yield self._add_resource("ee1", "node1", 2, "engine1")
+        yield self._add_resource("ee2", "node2", 2, "engine2")
+        self.eeagent_client.failing.add("ee1")
+
+        requests = [dict(epid="a%d" % i, spec={}, subscribers=None,
+                         constraints=dict(engine_type="engine1"))
+                    for i in range(2)]
+        requests.append(dict(epid="b0", spec={}, subscribers=None,
+                             constraints=dict(engine_type="engine2")))
+        results = yield self.core.dispatch_processes(requests)
+        self.assertEqual(len(results), 3)
+
+        # processes for the unreachable EE were released and requeued
+        self._assert_assigned("a0", None)
+        self._assert_assigned("a1", None)
+        self._assert_assigned("b0", "ee2")
+        self.assertEqual(len(self.core.queue), 2)
+        self.assertEqual(self.core.resources["ee1"].available_slots, 2)
+
+    @defer.inlineCallbacks
+    def test_terminate_processes_send_failure(self):
+        yield self._add_resource("ee1", "node1", 1, "engine1")
+        yield self._add_resource("ee2", "node2", 1, "engine1")
+        requests = [dict(epid="p%d" % i, spec={}, subscribers=None)
+                    for i in range(2)]
+        yield self.core.dispatch_processes(requests)
+        failing = self.core.processes["p0"].assigned
+        self.eeagent_client.failing.add(failing)
+
+        try:
+            yield self.core.terminate_processes(["p0", "p1"])
+        except Exception:
+            pass
+        else:
+            self.fail("Expected terminate failure")
+
+        # the other EE was still sent its terminate, and both processes
+        # are TERMINATING so a retry resends them
+        self.assertEqual(self.eeagent_client.terminate_requests, 2)
+        self.assertEqual(self.eeagent_client.terminated,
+                         [(self.core.processes["p1"].assigned, "p1")])
+        for epid in ("p0", "p1"):
+            self.assertEqual(self.core.processes[epid].state,
+                             ProcessStates.TERMINATING)
+
+        self.eeagent_client.failing.clear()
+        yield self.core.terminate_processes(["p0", "p1"])
+        self.assertEqual(self.eeagent_client.terminate_requests, 4)
+
+    @defer.inlineCallbacks
+    def test_terminate_processes(self):
+        yield self._add_resource("ee1", "node1", 2, "engine1")
+        yield self._add_resource("ee2", "node2", 1, "engine1")
+        requests = [dict(epid="p%d" % i, spec={}, subscribers=None)
+                    for i in range(4)]
+        yield self.core.dispatch_processes(requests)
+        self._assert_assigned("p3", None)
+
+        epids = ["p0", "p1", "p2", "p3", "p1", "unknown"]
+        results = yield self.core.terminate_processes(epids)
+        self.assertEqual(len(results), len(epids))
+        self.assertEqual(results[-1], None)
+        self.assertEqual(self.eeagent_client.terminate_requests, 2)
+        self.assertEqual(len(self.eeagent_client.terminated), 3)
+
+        for epid in ("p0", "p1", "p2"):
+            self.assertEqual(self.core.processes[epid].state,
+                             ProcessStates.TERMINATING)
+        self.assertEqual(self.core.processes["p3"].state,
+                         ProcessStates.TERMINATED)
+        self.assertEqual(len(self.core.queue), 0)
+
+        # retry resends terminates for processes still terminating
+        results = yield self.core.terminate_processes(epids[:4])
+        self.assertEqual(self.eeagent_client.terminate_requests, 4)
+        self.assertEqual(len(self.eeagent_client.terminated), 6)
+
+    @defer.inlineCallbacks
+    def test_incremental_heartbeats(self):
+        yield self.core.dt_state("node1", "dt1", InstanceStates.RUNNING)
+
+        def beat(seq, processes, slot_count=4, full=False):
+            return dict(node_id="node1", engine_type="engine1", seq=seq,
+                        full=full, processes=processes, slot_count=slot_count)
+
+        yield self.core.ee_heartbeart("ee1", beat(1, [], full=True))
+        for epid in ("p1", "p2", "p3"):
+            yield self.core.dispatch_process(epid, {}, None)
+        resource = self.core.resources["ee1"]
+
+        running = [(epid, 0, ProcessStates.RUNNING)
+                   for epid in ("p1", "p2", "p3")]
+        yield self.core.ee_heartbeart("ee1", beat(2, running, 1))
+        self.assertEqual(resource.processes, set(["p1", "p2", "p3"]))
+        self.assertEqual(self.core.processes["p2"].state,
+                         ProcessStates.RUNNING)
+
+        # an empty delta changes nothing
+        yield self.core.ee_heartbeart("ee1", beat(3, [], 1))
+        self.assertEqual(resource.processes, set(["p1", "p2", "p3"]))
+        self.assertEqual(resource.heartbeat_seq, 3)
+
+        # a process dies
+        failed = [("p2", 0, ProcessStates.FAILED)]
+        yield self.core.ee_heartbeart("ee1", beat(4, failed, 2))
+        self.assertEqual(resource.processes, set(["p1", "p3"]))
+        self.assertEqual(self.core.processes["p2"].round, 1)
+        self.assertEqual(self.eeagent_client.cleaned, [("ee1", "p2")])
+
+        # stale beats are dropped
+        yield self.core.ee_heartbeart("ee1", beat(2, running, 1))
+        self.assertEqual(resource.processes, set(["p1", "p3"]))
+        self.assertEqual(self.eeagent_client.resyncs, [])
+
+        # a gap is applied, and a resync requested
+        terminated = [("p3", 0, ProcessStates.TERMINATED)]
+        yield self.core.ee_heartbeart("ee1", beat(7, terminated, 2))
+        self.assertEqual(resource.processes, set(["p1"]))
+        self.assertEqual(self.eeagent_client.resyncs, ["ee1"])
+
+        # the full beat replaces all process state for the EE
+        rerun = [("p2", 1, ProcessStates.RUNNING)]
+        yield self.core.ee_heartbeart("ee1", beat(8, rerun, 2, full=True))
+        self.assertEqual(resource.processes, set(["p2"]))
+        self.assertEqual(self.eeagent_client.resyncs, ["ee1"])
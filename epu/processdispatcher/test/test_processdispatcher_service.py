@@ -35,12 +35,13 @@ class ProcessDispatcherServiceTests(IonTestCase):
 
     @defer.inlineCallbacks
     def _spawn_eeagent(self, node_id, slot_count, engine_type,
-                       heartbeat_dest=None, heartbeat_op="ee_heartbeat"):
+                       heartbeat_dest=None, heartbeat_op="ee_heartbeat",
+                       incremental=False):
         if heartbeat_dest is None:
             heartbeat_dest = self.pd_name
         spawnargs = dict(node_id=node_id, heartbeat_dest=heartbeat_dest,
                          heartbeat_op=heartbeat_op, slot_count=slot_count,
-                         engine_type=engine_type)
+                         engine_type=engine_type, incremental=incremental)
         agent = FakeEEAgent(spawnargs=spawnargs)
         yield self._spawn_process(agent)
         agent_name = agent.get_scoped_name("system", str(agent.backend_id))
@@ -145,6 +146,92 @@ class ProcessDispatcherServiceTests(IonTestCase):
         yield self._wait_assert_pd_dump(self._assert_process_distribution,
                                         agent_counts=[2])
 
+    @defer.inlineCallbacks
+    def _test_bulk(self):
+        nodes = ["node1", "node2"]
+        for node in nodes:
+            yield self.client.dt_state(node, "dt1", InstanceStates.RUNNING)
+            yield self._spawn_eeagent(node, 2, "engine1")
+
+        spec = {"omg": "imaprocess"}
+        procs = ["proc%d" % i for i in range(5)]
+        requests = [dict(epid=proc, spec=spec, subscribers=None)
+                    for proc in procs]
+        results = yield self.client.dispatch_processes(requests)
+        self.assertEqual([r['epid'] for r in results], procs)
+
+        yield self._wait_assert_pd_dump(self._assert_process_distribution,
+                                        agent_counts=[2, 2], queued_count=1)
+
+        # retrying is harmless
+        results = yield self.client.dispatch_processes(requests)
+        self.assertEqual([r['epid'] for r in results], procs)
+
+        results = yield self.client.terminate_processes(procs[:2] + ["nope"])
+        self.assertEqual(results[0]['epid'], procs[0])
+        self.assertEqual(results[2], None)
+
+        yield self._wait_assert_pd_dump(self._assert_process_states,
+                                        ProcessStates.TERMINATED, procs[:2])
+        yield self._wait_assert_pd_dump(self._assert_process_states,
+                                        ProcessStates.RUNNING, procs[2:])
+
+    @defer.inlineCallbacks
+    def test_bulk(self):
+        yield self._test_bulk()
+
+        # EEAgents are sent a message per process by default
+        for agent in self.eeagents.itervalues():
+            self.assertEqual(agent.batch_requests, 0)
+
+    @defer.inlineCallbacks
+    def test_bulk_batch_ops(self):
+        self.pd.eeagent_client.batch = True
+        yield self._test_bulk()
+
+        batch_requests = sum(agent.batch_requests
+                             for agent in self.eeagents.itervalues())
+        self.assertTrue(batch_requests > 0)
+
+    @defer.inlineCallbacks
+    def test_incremental_heartbeats(self):
+        yield self.client.dt_state("node1", "dt1", InstanceStates.RUNNING)
+        yield self._spawn_eeagent("node1", 4, "engine1", incremental=True)
+
+        spec = {"omg": "imaprocess"}
+        procs = ["proc1", "proc2", "proc3"]
+        for proc in procs:
+            yield self.client.dispatch_process(proc, spec, None)
+
+        yield self._wait_assert_pd_dump(self._assert_process_states,
+                                        ProcessStates.RUNNING, procs)
+
+        agent = yield self._get_eeagent_for_process(procs[0])
+        yield agent.fail_process(procs[0])
+        yield self.client.terminate_process(procs[1])
+
+        def assert_rounds_and_resource(state):
+            self.assertEqual(state['processes'][procs[0]]['round'], 1)
+            resource = state['resources'].values()[0]
+            self.assertEqual(set(resource['processes']),
+                             set([procs[0], procs[2]]))
+
+        yield self._wait_assert_pd_dump(assert_rounds_and_resource)
+        yield self._wait_assert_pd_dump(self._assert_process_states,
+                                        ProcessStates.TERMINATED, procs[1:2])
+
+        # a lost heartbeat is recovered with a resync
+        self.assertEqual(agent.resync_count, 0)
+        agent.make_heartbeat()
+        yield agent.send_heartbeat()
+
+        def assert_resynced(state):
+            self.assertEqual(agent.resync_count, 1)
+            self.assertFalse(agent.needs_full)
+
+        yield self._wait_assert_pd_dump(assert_resynced)
+        yield self._wait_assert_pd_dump(assert_rounds_and_resource)
+
     @defer.inlineCallbacks
     def test_queueing(self):
 
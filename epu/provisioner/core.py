@@ -7,10 +7,13 @@
 """
 
 import time
+import threading
 import ion.util.ionlog
 
 from itertools import izip
-from twisted.internet import defer, threads
+from twisted.internet import defer, threads, reactor
+from twisted.python.failure import Failure
+from twisted.python.threadpool import ThreadPool
 
 from nimboss.ctx import ContextClient, BrokerError, BrokerAuthError, \
     ContextNotFoundError
@@ -18,7 +21,7 @@ from nimboss.cluster import ClusterDriver
 from nimboss.nimbus import NimbusClusterDocument, ValidationError
 from libcloud.compute.types import NodeState as NimbossNodeState
 from libcloud.compute.base import Node as NimbossNode
-from epu.provisioner.store import group_records
+from epu.provisioner.store import group_records, copy_record
 from epu.ionproc.dtrs import DeployableTypeLookupError
 from epu import states
 from epu import cei_events
@@ -40,11 +43,52 @@ _NIMBOSS_STATE_MAP = {
 # are assumed to be terminated out of band and marked FAILED
 _IAAS_NODE_QUERY_WINDOW_SECONDS = 60
 
+# Maximum number of IaaS sites queried at once
+DEFAULT_SITE_QUERY_CONCURRENCY = 8
+
+# Seconds to wait for a single site's list_nodes before giving up on it
+# for the current query
+DEFAULT_SITE_QUERY_TIMEOUT = 60
+
+# Maximum number of launch contexts queried at once
+DEFAULT_CONTEXT_QUERY_CONCURRENCY = 8
+
+# Maximum number of launch groups started at once. With the default of 1,
+# groups are launched one after another and a failure stops the rest.
+DEFAULT_LAUNCH_GROUP_CONCURRENCY = 1
+
+# Maximum number of IaaS termination calls made at once to a single site
+DEFAULT_TERMINATE_CONCURRENCY = 8
+
+# Maximum number of nodes terminated in a single IaaS request, for drivers
+# that support terminating many nodes at once
+_IAAS_TERMINATE_BATCH_SIZE = 100
+
+# Upper bound, in seconds, on how long querying an incomplete context can be
+# put off. The backoff itself is disabled unless configured.
+DEFAULT_CONTEXT_QUERY_MAX_BACKOFF = 30
+
+# Maximum number of launch records kept in memory for the query and notify
+# paths, which only need their subscriber lists
+DEFAULT_LAUNCH_CACHE_SIZE = 1000
+
+# Threads available to each IaaS site, so a slow or hung cloud can only tie
+# up its own calls. Can be overridden per site.
+DEFAULT_SITE_THREAD_POOL_SIZE = 8
+
+# Threads available for context broker calls
+DEFAULT_CONTEXT_THREAD_POOL_SIZE = 8
+
 class ProvisionerCore(object):
     """Provisioner functionality that is not specific to the service.
     """
 
-    def __init__(self, store, notifier, dtrs, site_drivers, context):
+    def __init__(self, store, notifier, dtrs, site_drivers, context,
+                 site_query_concurrency=None, site_query_timeout=None,
+                 context_query_concurrency=None, context_query_backoff=None,
+                 context_query_max_backoff=None, terminate_concurrency=None,
+                 launch_group_concurrency=None, launch_cache_size=None,
+                 site_thread_pool_size=None, site_thread_pool_sizes=None):
         self.store = store
         self.notifier = notifier
         self.dtrs = dtrs
@@ -52,6 +96,40 @@ class ProvisionerCore(object):
         self.site_drivers = site_drivers
         self.context = context
 
+        self.site_query_concurrency = int(site_query_concurrency or
+                                          DEFAULT_SITE_QUERY_CONCURRENCY)
+        if site_query_timeout is None:
+            site_query_timeout = DEFAULT_SITE_QUERY_TIMEOUT
+        self.site_query_timeout = float(site_query_timeout)
+
+        self.context_query_concurrency = int(context_query_concurrency or
+                                             DEFAULT_CONTEXT_QUERY_CONCURRENCY)
+
+        # contexts that keep reporting incomplete without any progress are
+        # queried less often: the delay starts at context_query_backoff
+        # seconds and doubles each time, up to context_query_max_backoff.
+        self.context_query_backoff = float(context_query_backoff or 0)
+        self.context_query_max_backoff = float(context_query_max_backoff or
+                                               DEFAULT_CONTEXT_QUERY_MAX_BACKOFF)
+
+        # launch_id -> (consecutive incomplete count, next query time)
+        self._context_backoff = {}
+
+        self.terminate_concurrency = int(terminate_concurrency or
+                                         DEFAULT_TERMINATE_CONCURRENCY)
+
+        self.launch_group_concurrency = int(launch_group_concurrency or
+                                            DEFAULT_LAUNCH_GROUP_CONCURRENCY)
+
+        self.launch_cache = LaunchCache(store, int(launch_cache_size or
+                                                   DEFAULT_LAUNCH_CACHE_SIZE))
+
+        # IaaS calls run in a pool per site, sized by site_thread_pool_sizes
+        # (site -> size) or else site_thread_pool_size
+        self.site_thread_pools = NamedThreadPools(
+            int(site_thread_pool_size or DEFAULT_SITE_THREAD_POOL_SIZE),
+            site_thread_pool_sizes)
+
         self.cluster_driver = ClusterDriver()
 
     @defer.inlineCallbacks
@@ -194,8 +272,11 @@ class ProvisionerCore(object):
 
                 node_records.append(record)
 
-        yield self.store.put_launch(launch_record)
-        yield self.store_and_notify(node_records, subscribers)
+        # launch and node records go to the store together, in as few
+        # round trips as it can manage
+        yield self.store.put_nodes(node_records, launch=launch_record)
+        self.launch_cache.invalidate(launch_record['launch_id'])
+        yield self.notifier.send_records(node_records, subscribers)
 
         defer.returnValue((launch_record, node_records))
 
@@ -236,7 +317,7 @@ class ProvisionerCore(object):
                     node['state_desc'] = error_description
 
             #store and notify launch and nodes with FAILED states
-            yield self.store.put_launch(launch)
+            yield self._put_launch(launch)
             yield self.store_and_notify(nodes, launch['subscribers'])
 
     @defer.inlineCallbacks
@@ -259,8 +340,8 @@ class ProvisionerCore(object):
         # we want to fail early, before we launch anything if possible
         launch_pairs = self._validate_launch_groups(launch_groups, specs)
 
-        has_failed = False
         #launch_pairs is a list of (spec, node list) tuples
+        pending_pairs = []
         for launch_spec, launch_nodes in launch_pairs:
 
             # for recovery case
@@ -268,35 +349,75 @@ class ProvisionerCore(object):
                 log.info('Skipping launch group %s -- all nodes started',
                          launch_spec.name)
                 continue
+            pending_pairs.append((launch_spec, launch_nodes))
 
-            newstate = None
-            try:
-                log.info("Launching group:\nlaunch_spec: '%s'\nlaunch_nodes: '%s'",
-                         launch_spec, launch_nodes)
-                yield self._launch_one_group(launch_spec, launch_nodes)
-
-            except Exception,e:
-                log.exception('Problem launching group %s: %s',
-                        launch_spec.name, str(e))
-                newstate = states.FAILED
-                has_failed = True
-                # should we have a backout of earlier groups here? or just leave it up
-                # to EPU controller to decide what to do?
-
-            if newstate:
-                for node in launch_nodes:
-                    node['state'] = newstate
-            yield self.store_and_notify(launch_nodes, subscribers)
-
-            if has_failed:
-                break
+        if self.launch_group_concurrency > 1:
+            has_failed = yield self._launch_groups_concurrently(pending_pairs,
+                                                                subscribers)
+        else:
+            has_failed = False
+            for launch_spec, launch_nodes in pending_pairs:
+                launched = yield self._launch_and_record_group(
+                    launch_spec, launch_nodes, subscribers)
+                if not launched:
+                    # should we have a backout of earlier groups here? or
+                    # just leave it up to EPU controller to decide what to do?
+                    has_failed = True
+                    break
 
         if has_failed:
             launch['state'] = states.FAILED
         else:
             launch['state'] = states.PENDING
 
-        yield self.store.put_launch(launch)
+        yield self._put_launch(launch)
+
+    @defer.inlineCallbacks
+    def _launch_groups_concurrently(self, launch_pairs, subscribers):
+        """Launches independent groups at the same time.
+
+        At most launch_group_concurrency groups are launched at once. Unlike
+        sequential launches, a failed group does not stop the others.
+
+        @retval Deferred True if any group failed to launch
+        """
+        semaphore = defer.DeferredSemaphore(self.launch_group_concurrency)
+        results = yield defer.DeferredList(
+            [semaphore.run(self._launch_and_record_group, launch_spec,
+                           launch_nodes, subscribers)
+             for launch_spec, launch_nodes in launch_pairs],
+            consumeErrors=True)
+
+        # launch problems are handled per group. Anything else (a store
+        # error for example) is passed along after all groups are done.
+        for success, result in results:
+            if not success:
+                result.raiseException()
+        defer.returnValue(not all(result for success, result in results))
+
+    @defer.inlineCallbacks
+    def _launch_and_record_group(self, launch_spec, launch_nodes, subscribers):
+        """Launches one group, stores and sends the resulting node records.
+
+        @retval Deferred True if the group was launched, False if it failed
+        and its nodes were marked FAILED
+        """
+        newstate = None
+        try:
+            log.info("Launching group:\nlaunch_spec: '%s'\nlaunch_nodes: '%s'",
+                     launch_spec, launch_nodes)
+            yield self._launch_one_group(launch_spec, launch_nodes)
+
+        except Exception,e:
+            log.exception('Problem launching group %s: %s',
+                    launch_spec.name, str(e))
+            newstate = states.FAILED
+
+        if newstate:
+            for node in launch_nodes:
+                node['state'] = newstate
+        yield self.store_and_notify(launch_nodes, subscribers)
+        defer.returnValue(newstate is None)
 
     def _validate_launch_groups(self, groups, specs):
         if len(specs) != len(groups):
@@ -346,7 +467,7 @@ class ProvisionerCore(object):
                 spec.name, spec.count, keystring, allocstring)
 
         try:
-            iaas_nodes = yield threads.deferToThread(
+            iaas_nodes = yield self.site_thread_pools.run(site,
                     self.cluster_driver.launch_node_spec, spec, driver,
                     ex_clienttoken=client_token)
         except Exception, e:
@@ -376,6 +497,38 @@ class ProvisionerCore(object):
                          'iaas_id': iaas_node.id, 'node_id': node_rec['node_id']}
             cei_events.event("provisioner", "new_node", extra=extradict)
 
+    @defer.inlineCallbacks
+    def _put_launch(self, launch):
+        """Stores a launch record and drops any cached copy of it
+        """
+        try:
+            yield self.store.put_launch(launch)
+        finally:
+            self.launch_cache.invalidate(launch['launch_id'])
+
+    def launch_cache_stats(self):
+        """Hit, miss and store call counts for the launch record cache
+        """
+        return self.launch_cache.stats()
+
+    def thread_pool_stats(self):
+        """Per-pool size, running and waiting call counts for the IaaS site
+        pools, and the context broker pool if the context client has one
+        """
+        stats = {'sites': self.site_thread_pools.stats()}
+        context_stats = getattr(self.context, 'thread_pool_stats', None)
+        if context_stats:
+            stats['context'] = context_stats()
+        return stats
+
+    def stop(self):
+        """Stops the IaaS and context broker thread pools
+        """
+        self.site_thread_pools.stop()
+        context_stop = getattr(self.context, 'stop', None)
+        if context_stop:
+            context_stop()
+
     @defer.inlineCallbacks
     def store_and_notify(self, records, subscribers):
         """Convenience method to store records and notify subscribers.
@@ -390,11 +543,12 @@ class ProvisionerCore(object):
         @param nodes list of node IDs
         @param force_subscribe optional, an extra subscriber that may not be listed in local node records
         """
-        for node_id in nodes:
-            node = yield self.store.get_node(node_id)
+        node_records = yield self.store.get_nodes_by_ids(nodes)
+        for node_id, node in izip(nodes, node_records):
             if node:
-                launch = yield self.store.get_launch(node['launch_id'])
-                subscribers = launch['subscribers']
+                launch = yield self.launch_cache.get(node['launch_id'])
+                # copied, the launch record may be shared with the store
+                subscribers = list(launch['subscribers'])
                 if force_subscribe and not force_subscribe in subscribers:
                     subscribers.append(force_subscribe)
                 yield self.notifier.send_record(node, subscribers)
@@ -417,28 +571,86 @@ class ProvisionerCore(object):
     @defer.inlineCallbacks
     def query_nodes(self, request=None):
         """Performs queries of IaaS and broker, sends updates to subscribers.
+
+        @param request optional dict narrowing the query, None queries
+            everything. Keys, all optional:
+            - sites: only query these sites
+            - min_state, max_state: only consider nodes in this state range
+              (inclusive). max_state is capped at TERMINATING.
+            - contexts: False to skip querying launch contexts
         """
-        # Right now we just query everything. Could be made more granular later
+        request = request or {}
+        max_state = request.get('max_state')
+        if max_state is None or max_state > states.TERMINATING:
+            max_state = states.TERMINATING
 
-        nodes = yield self.store.get_nodes(max_state=states.TERMINATING)
+        nodes = yield self.store.get_nodes(min_state=request.get('min_state'),
+                                           max_state=max_state)
         site_nodes = group_records(nodes, 'site')
 
-        if len(nodes):
-            log.debug("Querying state of %d nodes", len(nodes))
+        sites = request.get('sites')
+        if sites is not None:
+            site_nodes = dict((site, site_nodes[site]) for site in sites
+                              if site in site_nodes)
+
+        if site_nodes:
+            log.debug("Querying state of %d nodes at %d sites",
+                      sum(len(n) for n in site_nodes.itervalues()),
+                      len(site_nodes))
+
+        yield self.query_sites(site_nodes)
+        if request.get('contexts', True):
+            yield self.query_contexts()
+
+        log.debug("Launch cache: %s", self.launch_cache.stats())
+        log.debug("Thread pools: %s", self.thread_pool_stats())
+
+    @defer.inlineCallbacks
+    def query_sites(self, site_nodes):
+        """Queries a set of sites concurrently.
 
-        for site in site_nodes:
-            yield self.query_one_site(site, site_nodes[site])
+        At most site_query_concurrency sites are queried at once. A failure
+        or timeout querying one site is logged and does not affect the
+        others.
 
-        yield self.query_contexts()
+        @param site_nodes dict of site name to list of node records
+        @retval Deferred list of sites that could not be queried
+        """
+        semaphore = defer.DeferredSemaphore(self.site_query_concurrency)
+        sites = site_nodes.keys()
+        results = yield defer.DeferredList(
+            [semaphore.run(self.query_one_site, site, site_nodes[site])
+             for site in sites], consumeErrors=True)
+
+        failed_sites = []
+        for site, (success, result) in izip(sites, results):
+            if success:
+                continue
+            failed_sites.append(site)
+            if result.check(defer.TimeoutError):
+                log.error('Query of site "%s" timed out after %s seconds. '+
+                          'Its nodes will be queried again next time.',
+                          site, self.site_query_timeout)
+            else:
+                log.error('Query of site "%s" failed: %s', site,
+                          result.getErrorMessage(),
+                          exc_info=(result.type, result.value,
+                                    result.getTracebackObject()))
+        defer.returnValue(failed_sites)
 
     @defer.inlineCallbacks
     def query_one_site(self, site, nodes, driver=None):
         node_driver = driver or self.site_drivers[site]
 
         log.info('Querying site "%s"', site)
-        nimboss_nodes = yield threads.deferToThread(node_driver.list_nodes)
+        nimboss_nodes = yield timeout_deferred(
+            self.site_thread_pools.run(site, node_driver.list_nodes),
+            self.site_query_timeout)
         nimboss_nodes = dict((node.id, node) for node in nimboss_nodes)
 
+        # changed nodes are stored and sent after the walk, together
+        changed = []
+
         # note we are walking the nodes from datastore, NOT from nimboss
         for node in nodes:
             state = node['state']
@@ -468,10 +680,7 @@ class ProvisionerCore(object):
 
                     node['state'] = states.FAILED
                     node['state_desc'] = 'NODE_DISAPPEARED'
-
-                    launch = yield self.store.get_launch(node['launch_id'])
-                    if launch:
-                        yield self.store_and_notify([node], launch['subscribers'])
+                    changed.append(node)
             else:
                 nimboss_state = _NIMBOSS_STATE_MAP[nimboss_node.state]
                 if nimboss_state > node['state']:
@@ -487,36 +696,104 @@ class ProvisionerCore(object):
                                      'private_ip': node.get('private_ip') }
                         cei_events.event("provisioner", "node_started",
                                          extra=extradict)
+                    changed.append(node)
+
+        yield self._store_and_notify_nodes(changed)
 
-                    launch = yield self.store.get_launch(node['launch_id'])
-                    yield self.store_and_notify([node], launch['subscribers'])
         #TODO nimboss_nodes now contains any other running instances that
         # are unknown to the datastore (or were started after the query)
         # Could do some analysis of these nodes
 
+    @defer.inlineCallbacks
+    def _store_and_notify_nodes(self, nodes):
+        """Stores and sends node records, grouped by their launches'
+        subscribers so each group is a single write and notification
+        """
+        groups = {} # subscribers key -> (subscribers, nodes)
+        for launch_id, launch_nodes in group_records(nodes, 'launch_id').iteritems():
+            launch = yield self.launch_cache.get(launch_id)
+            if not launch:
+                log.warn('launch %s not found, dropping %d node updates',
+                         launch_id, len(launch_nodes))
+                continue
+            subscribers = launch['subscribers']
+            if isinstance(subscribers, basestring):
+                key = subscribers
+            else:
+                key = tuple(sorted(subscribers))
+            groups.setdefault(key, (subscribers, []))[1].extend(launch_nodes)
+
+        for subscribers, group_nodes in groups.itervalues():
+            yield self.store_and_notify(group_nodes, subscribers)
+
     @defer.inlineCallbacks
     def _get_nodes_by_id(self, node_ids, skip_missing=True):
         """Helper method tp retrieve node records from a list of IDs
         """
-        nodes = []
-        for node_id in node_ids:
-            node = yield self.store.get_node(node_id)
-            # when skip_missing is false, include a None entry for missing nodes
-            if node or not skip_missing:
-                nodes.append(node)
+        nodes = yield self.store.get_nodes_by_ids(node_ids)
+        # when skip_missing is false, include a None entry for missing nodes
+        if skip_missing:
+            nodes = [node for node in nodes if node]
         defer.returnValue(nodes)
 
     @defer.inlineCallbacks
     def query_contexts(self):
         """Queries all open launch contexts and sends node updates.
+
+        Up to context_query_concurrency contexts are queried at once.
+        Contexts that are backing off are skipped.
         """
         #grab all the launches in the pending state
         launches = yield self.store.get_launches(state=states.PENDING)
         if launches:
             log.debug("Querying state of %d contexts", len(launches))
 
+        # forget about launches that are no longer pending
+        pending_ids = set(launch['launch_id'] for launch in launches)
+        for launch_id in self._context_backoff.keys():
+            if launch_id not in pending_ids:
+                del self._context_backoff[launch_id]
+
+        now = time.time()
+        ready = []
         for launch in launches:
-            yield self._query_one_context(launch)
+            backoff = self._context_backoff.get(launch['launch_id'])
+            if backoff and backoff[1] > now:
+                log.debug('Launch %s context is backing off, skipping query',
+                          launch['launch_id'])
+            else:
+                ready.append(launch)
+
+        semaphore = defer.DeferredSemaphore(self.context_query_concurrency)
+        results = yield defer.DeferredList(
+            [semaphore.run(self._query_one_context, launch)
+             for launch in ready], consumeErrors=True)
+
+        # one bad context shouldn't keep the others from being queried
+        for launch, (success, result) in izip(ready, results):
+            if not success:
+                log.error('Context query for launch %s failed due to an '+
+                          'unexpected error. This is likely a bug and should '+
+                          'be reported. Problem: %s', launch['launch_id'],
+                          result.getErrorMessage(),
+                          exc_info=(result.type, result.value,
+                                    result.getTracebackObject()))
+
+    def _update_context_backoff(self, launch_id, progress):
+        """Tracks contexts that keep reporting incomplete.
+
+        Any progress (or a disabled backoff) clears the launch's backoff.
+        """
+        if progress or not self.context_query_backoff:
+            self._context_backoff.pop(launch_id, None)
+            return
+
+        count = self._context_backoff.get(launch_id, (0, None))[0] + 1
+        delay = min(self.context_query_backoff * 2 ** (count - 1),
+                    self.context_query_max_backoff)
+        log.debug('Launch %s context has made no progress in %d queries. '+
+                  'Next query in %s seconds', launch_id, count, delay)
+        self._context_backoff[launch_id] = (count, time.time() + delay)
 
     @defer.inlineCallbacks
     def _query_one_context(self, launch):
@@ -559,7 +836,7 @@ class ProvisionerCore(object):
                      "have likely been terminated. Marking launch as FAILED. "+
                      "nodes: %s", launch_id, node_ids)
             launch['state'] = states.FAILED
-            yield self.store.put_launch(launch)
+            yield self._put_launch(launch)
             defer.returnValue(None) # *** EARLY RETURN ***
 
         ctx_uri = context['uri']
@@ -589,7 +866,7 @@ class ProvisionerCore(object):
                 yield self.store_and_notify(updated_nodes, launch['subscribers'])
 
             launch['state'] = states.FAILED
-            yield self.store.put_launch(launch)
+            yield self._put_launch(launch)
 
             defer.returnValue(None) # *** EARLY RETURN ***
 
@@ -601,6 +878,7 @@ class ProvisionerCore(object):
         ctx_nodes = context_status.nodes
         if not ctx_nodes:
             log.debug('Launch %s context has no nodes (yet)', launch_id)
+            self._update_context_backoff(launch_id, progress=False)
             defer.returnValue(None) # *** EARLY RETURN ***
 
         updated_nodes = update_nodes_from_context(nodes, ctx_nodes)
@@ -619,14 +897,18 @@ class ProvisionerCore(object):
             launch['state'] = states.RUNNING
             extradict = {'launch_id': launch_id, 'node_ids': launch['node_ids']}
             cei_events.event("provisioner", "launch_ctx_done", extra=extradict)
-            yield self.store.put_launch(launch)
+            yield self._put_launch(launch)
+            self._update_context_backoff(launch_id, progress=True)
 
-        elif context_status.complete:
-            log.info('Launch %s context is "complete" (all checked in, but not all-ok)', launch_id)
         else:
-            log.debug('Launch %s context is incomplete: %s of %s nodes',
-                    launch_id, len(context_status.nodes),
-                    context_status.expected_count)
+            if context_status.complete:
+                log.info('Launch %s context is "complete" (all checked in, but not all-ok)', launch_id)
+            else:
+                log.debug('Launch %s context is incomplete: %s of %s nodes',
+                        launch_id, len(context_status.nodes),
+                        context_status.expected_count)
+            self._update_context_backoff(launch_id,
+                                         progress=bool(updated_nodes))
 
     @defer.inlineCallbacks
     def mark_launch_terminating(self, launch_id):
@@ -642,7 +924,7 @@ class ProvisionerCore(object):
         if updated:
             yield self.store_and_notify(nodes, launch['subscribers'])
         launch['state'] = states.TERMINATING
-        yield self.store.put_launch(launch)
+        yield self._put_launch(launch)
 
     @defer.inlineCallbacks
     def terminate_launch(self, launch_id):
@@ -651,15 +933,12 @@ class ProvisionerCore(object):
         launch = yield self.store.get_launch(launch_id)
         nodes = yield self._get_nodes_by_id(launch['node_ids'])
 
-        for node in nodes:
-            state = node['state']
-            if state < states.PENDING or state >= states.TERMINATED:
-                continue
-            #would be nice to do this as a batch operation
-            yield self._terminate_node(node, launch)
+        nodes = [node for node in nodes
+                 if states.PENDING <= node['state'] < states.TERMINATED]
+        yield self._terminate_nodes(nodes, {launch_id : launch})
 
         launch['state'] = states.TERMINATED
-        yield self.store.put_launch(launch)
+        yield self._put_launch(launch)
 
     @defer.inlineCallbacks
     def terminate_launches(self, launch_ids):
@@ -694,7 +973,7 @@ class ProvisionerCore(object):
         
         launches = group_records(nodes, 'launch_id')
         for launch_id, launch_nodes in launches.iteritems():
-            launch = yield self.store.get_launch(launch_id)
+            launch = yield self.launch_cache.get(launch_id)
             if not launch:
                 log.warn('Failed to find launch record %s', launch_id)
                 continue
@@ -708,6 +987,7 @@ class ProvisionerCore(object):
         """Destroy all specified nodes.
         """
         nodes = yield self._get_nodes_by_id(node_ids, skip_missing=False)
+        known_nodes = []
         for node_id, node in izip(node_ids, nodes):
             if not node:
                 #maybe an error should make it's way to controller from here?
@@ -716,17 +996,80 @@ class ProvisionerCore(object):
                 continue
 
             log.info("Terminating node %s", node_id)
-            launch = yield self.store.get_launch(node['launch_id'])
-            yield self._terminate_node(node, launch)
+            known_nodes.append(node)
+
+        launches = {}
+        for launch_id in group_records(known_nodes, 'launch_id'):
+            launches[launch_id] = yield self.launch_cache.get(launch_id)
+        yield self._terminate_nodes(known_nodes, launches)
 
     @defer.inlineCallbacks
-    def _terminate_node(self, node, launch):
-        nimboss_node = self._to_nimboss_node(node)
-        driver = self.site_drivers[node['site']]
-        yield threads.deferToThread(driver.destroy_node, nimboss_node)
-        node['state'] = states.TERMINATED
+    def _terminate_nodes(self, nodes, launches):
+        """Destroys nodes in IaaS, then stores and sends TERMINATED records.
+
+        Nodes are grouped by site. If a site's driver can terminate many
+        nodes in one request (ex_destroy_nodes), nodes are destroyed in
+        batches. Otherwise each node gets its own destroy_node call. At most
+        terminate_concurrency IaaS calls are made at once to each site, so a
+        slow site does not hold up terminations at the others.
+
+        Records for all destroyed nodes are written together once the IaaS
+        calls are done. If any call failed, the first error is raised after
+        that.
+
+        @param nodes list of node records
+        @param launches dict of launch_id -> launch record, for subscribers
+        """
+        calls = [] # (node batch, Deferred) pairs
+        for site, site_nodes in group_records(nodes, 'site').iteritems():
+            semaphore = defer.DeferredSemaphore(self.terminate_concurrency)
+            driver = self.site_drivers[site]
+            destroy_nodes = getattr(driver, 'ex_destroy_nodes', None)
+            if destroy_nodes:
+                for i in range(0, len(site_nodes), _IAAS_TERMINATE_BATCH_SIZE):
+                    batch = site_nodes[i:i+_IAAS_TERMINATE_BATCH_SIZE]
+                    nimboss_nodes = [self._to_nimboss_node(node)
+                                     for node in batch]
+                    d = semaphore.run(self.site_thread_pools.run, site,
+                                      destroy_nodes, nimboss_nodes)
+                    calls.append((batch, d))
+            else:
+                for node in site_nodes:
+                    d = semaphore.run(self.site_thread_pools.run, site,
+                                      driver.destroy_node,
+                                      self._to_nimboss_node(node))
+                    calls.append(([node], d))
+
+        results = yield defer.DeferredList([d for batch, d in calls],
+                                           consumeErrors=True)
+
+        terminated = []
+        first_failure = None
+        for (batch, d), (success, result) in izip(calls, results):
+            if success:
+                for node in batch:
+                    node['state'] = states.TERMINATED
+                terminated.extend(batch)
+            else:
+                log.error('Failed to terminate nodes %s: %s',
+                          ','.join(node['node_id'] for node in batch),
+                          result.getErrorMessage())
+                if first_failure is None:
+                    first_failure = result
+
+        if terminated:
+            yield self.store.put_nodes(terminated)
+            launch_nodes = group_records(terminated, 'launch_id')
+            for launch_id, records in launch_nodes.iteritems():
+                launch = launches.get(launch_id)
+                if launch:
+                    yield self.notifier.send_records(records,
+                                                     launch['subscribers'])
+                else:
+                    log.warn('Failed to find launch record %s', launch_id)
 
-        yield self.store_and_notify([node], launch['subscribers'])
+        if first_failure is not None:
+            first_failure.raiseException()
 
     def _to_nimboss_node(self, node):
         """Nimboss drivers need a Node object for termination.
@@ -739,6 +1082,121 @@ class ProvisionerCore(object):
                 public_ip=None, private_ip=None,
                 driver=self.site_drivers[node['site']])
 
+class LaunchCache(object):
+    """Bounded cache of launch records, in front of a provisioner store
+
+    Launches in a final state (TERMINATED or FAILED) are not cached, since
+    their nodes are no longer queried. Entries are dropped when a launch is
+    written, and when the cache is full the least recently used quarter is
+    evicted.
+    """
+
+    def __init__(self, store, max_size=DEFAULT_LAUNCH_CACHE_SIZE):
+        self.store = store
+        self.max_size = max_size
+
+        # launch_id -> [launch record, last use]
+        self.launches = {}
+        self.clock = 0
+
+        # launch_id -> [store fetches in flight, generation] for launches
+        # being fetched. The generation is bumped by invalidations of that
+        # launch, so a fetch that overlaps one does not cache what may be
+        # an older record
+        self.fetches = {}
+
+        self.hits = 0
+        self.misses = 0
+        self.store_gets = 0
+        self.invalidations = 0
+        self.evictions = 0
+
+    @defer.inlineCallbacks
+    def get(self, launch_id):
+        """Retrieves a launch record, from the cache if possible
+
+        @param launch_id Id of launch record to retrieve
+        @retval Deferred record, or None. A copy, so changes are only seen
+            by others once written with put_launch.
+        """
+        self.clock += 1
+        entry = self.launches.get(launch_id)
+        if entry is not None:
+            self.hits += 1
+            entry[1] = self.clock
+            defer.returnValue(copy_record(entry[0]))
+
+        self.misses += 1
+        self.store_gets += 1
+        fetch = self.fetches.setdefault(launch_id, [0, 0])
+        fetch[0] += 1
+        generation = fetch[1]
+        try:
+            launch = yield self.store.get_launch(launch_id)
+        finally:
+            fetch[0] -= 1
+            if not fetch[0]:
+                del self.fetches[launch_id]
+
+        if (launch and launch['state'] < states.TERMINATED and
+                generation == fetch[1]):
+            if len(self.launches) >= self.max_size:
+                self._evict()
+            self.launches[launch_id] = [launch, self.clock]
+            launch = copy_record(launch)
+        defer.returnValue(launch)
+
+    def invalidate(self, launch_id):
+        self.invalidations += 1
+        self.launches.pop(launch_id, None)
+        fetch = self.fetches.get(launch_id)
+        if fetch is not None:
+            fetch[1] += 1
+
+    def _evict(self):
+        by_use = sorted(self.launches.iteritems(), key=lambda item: item[1][1])
+        count = max(1, len(by_use) // 4)
+        for launch_id, entry in by_use[:count]:
+            del self.launches[launch_id]
+        self.evictions += count
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        hit_rate = float(self.hits) / lookups if lookups else 0.0
+        return dict(size=len(self.launches), max_size=self.max_size,
+                    hits=self.hits, misses=self.misses, hit_rate=hit_rate,
+                    store_gets=self.store_gets,
+                    invalidations=self.invalidations,
+                    evictions=self.evictions)
+
+
+def timeout_deferred(d, seconds):
+    """Wraps a Deferred so it fails with TimeoutError after some seconds.
+
+    The underlying operation is not interrupted: a call running in a thread
+    will still run to completion, and its result is dropped.
+    """
+    if not seconds:
+        return d
+
+    result = defer.Deferred()
+
+    def expire():
+        result.errback(defer.TimeoutError(
+            "no result after %s seconds" % seconds))
+    delayed_call = reactor.callLater(seconds, expire)
+
+    def done(value):
+        if delayed_call.active():
+            delayed_call.cancel()
+            if isinstance(value, Failure):
+                result.errback(value)
+            else:
+                result.callback(value)
+        # otherwise result has already timed out and the value is dropped
+    d.addBoth(done)
+    return result
+
 def update_node_ip_info(node_rec, iaas_node):
     """Grab node IP information from libcloud Node object, if not already set.
     """
@@ -804,35 +1262,186 @@ def _update_one_node_from_ctx(node, ctx_node, identity):
     return True
 
 
+class NamedThreadPools(object):
+    """Bounded thread pools by name, for blocking calls to remote services.
+
+    Calls for one name (an IaaS site, the context broker) queue up in their
+    own pool and cannot hold up calls for any other name, as they would in
+    the reactor's shared default pool. Pools are started on first use and
+    stopped at reactor shutdown or by stop().
+    """
+    def __init__(self, default_size, sizes=None):
+        self.default_size = int(default_size)
+        self.sizes = dict(sizes or {})
+
+        self.pools = {}
+        self._shutdown_triggers = {}
+
+        # name -> call counts, updated from the reactor and pool threads
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def _get_pool(self, name):
+        pool = self.pools.get(name)
+        if pool is None:
+            size = int(self.sizes.get(name) or self.default_size)
+            pool = ThreadPool(0, size, name="%s-pool" % name)
+            pool.start()
+            self._shutdown_triggers[name] = reactor.addSystemEventTrigger(
+                'during', 'shutdown', pool.stop)
+            self.pools[name] = pool
+            self._counts[name] = dict(size=size, waiting=0, running=0,
+                                      max_waiting=0, calls=0)
+        return pool
+
+    def run(self, name, f, *args, **kwargs):
+        """Calls f in the named pool
+
+        @param name pool name
+        @param f blocking callable
+        @retval Deferred fired with the result of f
+        """
+        pool = self._get_pool(name)
+        counts = self._counts[name]
+        with self._lock:
+            counts['calls'] += 1
+            counts['waiting'] += 1
+            counts['max_waiting'] = max(counts['max_waiting'],
+                                        counts['waiting'])
+
+        def call():
+            with self._lock:
+                counts['waiting'] -= 1
+                counts['running'] += 1
+            try:
+                return f(*args, **kwargs)
+            finally:
+                with self._lock:
+                    counts['running'] -= 1
+
+        return threads.deferToThreadPool(reactor, pool, call)
+
+    def stats(self):
+        """Returns a dict of pool name -> dict of size, running and waiting
+        calls, the most calls seen waiting at once, and the total calls made
+        """
+        with self._lock:
+            return dict((name, counts.copy())
+                        for name, counts in self._counts.iteritems())
+
+    def stop(self):
+        """Stops all pools once their running calls finish, without waiting
+
+        ThreadPool.stop() joins the pool threads, so it is run in another
+        thread: a hung IaaS call cannot block the caller, or the reactor.
+        """
+        for name, pool in self.pools.items():
+            reactor.removeSystemEventTrigger(self._shutdown_triggers.pop(name))
+            reactor.callInThread(pool.stop)
+        self.pools.clear()
+        self._counts.clear()
+
+
+class ContextClientPool(object):
+    """Idle broker clients kept for reuse, so calls can reuse a client's
+    HTTP connection instead of making a new one (and handshake) each time.
+
+    A client is only used by one thread at a time: it is taken out of the
+    pool for the length of a call and put back after. A client whose call
+    failed is dropped instead, since its connection may be in a bad state.
+    """
+    def __init__(self, factory, max_idle):
+        self.factory = factory
+        self.max_idle = int(max_idle)
+        self.idle = []
+
+        self._lock = threading.Lock()
+        self._counts = dict(created=0, reused=0, discarded=0)
+
+    def call(self, method, *args):
+        """Calls a method on an idle client, or a new one if none are idle
+
+        @param method name of the client method
+        @retval result of the method
+        """
+        client = None
+        with self._lock:
+            if self.idle:
+                client = self.idle.pop()
+                self._counts['reused'] += 1
+            else:
+                self._counts['created'] += 1
+        if client is None:
+            client = self.factory()
+
+        try:
+            result = getattr(client, method)(*args)
+        except Exception:
+            with self._lock:
+                self._counts['discarded'] += 1
+            raise
+
+        with self._lock:
+            if len(self.idle) < self.max_idle:
+                self.idle.append(client)
+        return result
+
+    def stats(self):
+        """Returns counts of clients created, reused and discarded after an
+        error, and the number currently idle
+        """
+        with self._lock:
+            stats = self._counts.copy()
+            stats['idle'] = len(self.idle)
+        return stats
+
+
 class ProvisionerContextClient(object):
     """Provisioner calls to context broker.
     """
-    def __init__(self, broker_uri, key, secret):
+    def __init__(self, broker_uri, key, secret, thread_pool_size=None):
         self._broker_uri = broker_uri
         self._key = key
         self._secret = secret
 
+        # broker calls get their own pool so they are never stuck behind
+        # slow IaaS calls
+        thread_pool_size = int(thread_pool_size or
+                               DEFAULT_CONTEXT_THREAD_POOL_SIZE)
+        self.thread_pools = NamedThreadPools(thread_pool_size)
+
+        # at most one client per pool thread is ever in use
+        self._client_pool = ContextClientPool(self._get_client,
+                                              thread_pool_size)
+
     def _get_client(self):
-        # we ran into races with sharing a ContextClient between threads so
-        # now we create a new one for each call. Technically we could probably
-        # just have one for create() and one for query() but this is safer
-        # in case we start handling multiple provisions simultaneously or
-        # something.
+        # we ran into races with sharing a ContextClient between threads, so
+        # each client is only used by one call at a time. Clients are reused
+        # through the client pool to keep their broker connections open.
         return ContextClient(self._broker_uri, self._key, self._secret)
 
     def create(self):
         """Creates a new context with the broker
         """
-        client = self._get_client()
-        return threads.deferToThread(client.create_context)
+        return self.thread_pools.run('context', self._client_pool.call,
+                                     'create_context')
 
     def query(self, resource):
         """Queries an existing context.
 
         resource is the uri returned by create operation
         """
-        client = self._get_client()
-        return threads.deferToThread(client.get_status, resource)
+        return self.thread_pools.run('context', self._client_pool.call,
+                                     'get_status', resource)
+
+    def thread_pool_stats(self):
+        return self.thread_pools.stats()
+
+    def client_stats(self):
+        return self._client_pool.stats()
+
+    def stop(self):
+        self.thread_pools.stop()
 
 
 class ProvisioningError(Exception):
@@ -5,9 +5,10 @@
 @author David LaBissoniere
 @brief Provisioner storage abstraction
 """
+import time
 from itertools import groupby
 
-from telephus.cassandra.ttypes import CfDef
+from telephus.cassandra.ttypes import CfDef, Column, Deletion, SlicePredicate
 from telephus.client import CassandraClient
 from telephus.protocol import ManagedCassandraClientFactory
 from twisted.internet import defer, reactor
@@ -18,6 +19,7 @@ from ion.util.timeout import timeout
 import ion.util.ionlog
 
 import epu.cassandra
+from epu import states
 
 CASSANDRA_TIMEOUT = epu.cassandra.get_timeout()
 
@@ -61,8 +63,41 @@ log = ion.util.ionlog.getLogger(__name__)
 # will resolve harmlessly. If a process tries to write an old state, it
 # will not overwrite more recent ones.
 #
-# There is room for denormalization of data here, to speed up queries. For
-# example, there could be structures for correlating IaaS sites to nodes.
+# Finding all records in a state range would mean pulling down the latest
+# state of every record ever stored, terminated ones included. So there is a
+# denormalized state index for each record type: a column family keyed by
+# state, with one column per record ID currently in that state.
+#
+# NodeStates = {
+#   400-PENDING : {
+#       1ce8111c-2d4d-42af-9f74-117a1a92c1f5 : '',
+#   }
+#   900-FAILED : {
+#       8f91b758-2e03-409c-ac65-6bc7ccf15d37 : '',
+#   }
+#
+# Each put writes the record first and then, in a second batch, updates the
+# index: the ID is added to the row for its new state and removed from the
+# rows of all earlier states. So an index entry never points at a state the
+# record has not reached. If the index write fails, the put fails and must
+# be retried (all puts are idempotent). Until then the record is still
+# found under an earlier state, and a query that finds it there moves its
+# entry to the record's latest state. Out-of-order writes leave behind
+# stale index entries in the same way, so queries always check the latest
+# record and repair the index as they go.
+#
+# Records in a final state (TERMINATED, FAILED) are never queried for by
+# the provisioner itself, and would otherwise pile up in those index rows
+# forever. Their index columns are written with a TTL, so get_nodes() and
+# get_launches() only return records that reached a final state recently.
+# The records themselves are kept.
+#
+# Records written before the state index existed are not in it. The index
+# is built from a full scan once, by assure_state_index(), which leaves a
+# marker row in the node state index so later starts skip the scan.
+#
+# There is more room for denormalization of data here, to speed up queries.
+# For example, there could be structures for correlating IaaS sites to nodes.
 
 
 class CassandraProvisionerStore(object):
@@ -72,8 +107,20 @@ class CassandraProvisionerStore(object):
 
     # default size of paged fetches
     _PAGE_SIZE = 100
+
+    # default number of rows written in a single batch_mutate
+    _BATCH_SIZE = 100
+
     LAUNCH_CF_NAME = "ProvisionerLaunches"
     NODE_CF_NAME = "ProvisionerNodes"
+    LAUNCH_STATE_CF_NAME = "ProvisionerLaunchStates"
+    NODE_STATE_CF_NAME = "ProvisionerNodeStates"
+
+    # row key of the marker in the node state index, never a state name
+    _STATE_INDEX_MARKER = "state-index"
+
+    # seconds that records in a final state stay in the state index
+    _FINAL_STATE_INDEX_TTL = 7 * 24 * 3600
 
     @classmethod
     def get_column_families(cls, keyspace=None, prefix=''):
@@ -82,17 +129,23 @@ class CassandraProvisionerStore(object):
         @param prefix Optional prefix for cf names. Useful for testing.
         @retval list of CfDef objects
         """
-        launch_cf_name = prefix + cls.LAUNCH_CF_NAME
-        node_cf_name = prefix + cls.NODE_CF_NAME
-        return [CfDef(keyspace, launch_cf_name,
-                  comparator_type='org.apache.cassandra.db.marshal.UTF8Type'),
-            CfDef(keyspace, node_cf_name,
-                  comparator_type='org.apache.cassandra.db.marshal.UTF8Type')]
+        cf_names = (cls.LAUNCH_CF_NAME, cls.NODE_CF_NAME,
+                    cls.LAUNCH_STATE_CF_NAME, cls.NODE_STATE_CF_NAME)
+        return [CfDef(keyspace, prefix + cf_name,
+                  comparator_type='org.apache.cassandra.db.marshal.UTF8Type')
+                for cf_name in cf_names]
 
-    def __init__(self, host, port, username, password, keyspace, prefix=''):
+    def __init__(self, host, port, username, password, keyspace, prefix='',
+                 batch_size=None, final_state_index_ttl=None):
 
         self._launch_column_family = prefix + self.LAUNCH_CF_NAME
         self._node_column_family = prefix + self.NODE_CF_NAME
+        self._launch_state_column_family = prefix + self.LAUNCH_STATE_CF_NAME
+        self._node_state_column_family = prefix + self.NODE_STATE_CF_NAME
+
+        self._batch_size = int(batch_size or self._BATCH_SIZE)
+        self._final_state_index_ttl = int(final_state_index_ttl or
+                                          self._FINAL_STATE_INDEX_TTL)
 
         authz= {'username': username, 'password': password}
 
@@ -121,24 +174,21 @@ class CassandraProvisionerStore(object):
         @param launch Launch record to store
         @retval Deferred for success
         """
-        launch_id = launch['launch_id']
-        state = launch['state']
-        value = json.dumps(launch)
-        return self.client.insert(launch_id, self._launch_column_family,
-                                  value, column=state)
+        return self._put_records([self._launch_row(launch)])
 
     @timeout(CASSANDRA_TIMEOUT)
-    @defer.inlineCallbacks
-    def put_nodes(self, nodes):
+    def put_nodes(self, nodes, launch=None):
         """
-        @brief Stores a set of node records
+        @brief Stores a set of node records, and optionally their launch
         @param nodes Iterable of node records
+        @param launch Optional launch record to store along with the nodes
         @retval Deferred for success
         """
-
-        # could be more efficient with a batch_mutate
-        for node in nodes:
-            yield self.put_node(node)
+        rows = []
+        if launch:
+            rows.append(self._launch_row(launch))
+        rows.extend(self._node_row(node) for node in nodes)
+        return self._put_records(rows)
 
     @timeout(CASSANDRA_TIMEOUT)
     def put_node(self, node):
@@ -147,11 +197,31 @@ class CassandraProvisionerStore(object):
         @param node Node record
         @retval Deferred for success
         """
-        node_id = node['node_id']
-        state = node['state']
-        value = json.dumps(node)
-        return self.client.insert(node_id, self._node_column_family, value,
-                                  column=state)
+        return self._put_records([self._node_row(node)])
+
+    def _launch_row(self, launch):
+        return (launch['launch_id'], self._launch_column_family,
+                self._launch_state_column_family, launch)
+
+    def _node_row(self, node):
+        return (node['node_id'], self._node_column_family,
+                self._node_state_column_family, node)
+
+    @defer.inlineCallbacks
+    def _put_records(self, rows):
+        # each record is written as a single state column, the same as a
+        # plain insert, so older states still never overwrite newer ones.
+        # The state index is updated after the records, see the top of this
+        # file. Rows are chunked into batches to keep individual requests
+        # reasonably sized.
+        for i in range(0, len(rows), self._batch_size):
+            chunk = rows[i:i+self._batch_size]
+            yield self.client.batch_mutate(_build_record_mutation_map(chunk))
+            yield self._put_index(chunk)
+
+    def _put_index(self, rows):
+        return self.client.batch_mutate(
+            _build_index_mutation_map(rows, self._final_state_index_ttl))
 
     @timeout(CASSANDRA_TIMEOUT)
     def get_launch(self, launch_id, count=1):
@@ -174,6 +244,7 @@ class CassandraProvisionerStore(object):
         @retval Deferred list of launch records
         """
         return self._get_records(self._launch_column_family,
+                                 self._launch_state_column_family,
                                  state=state,
                                  min_state=min_state,
                                  max_state=max_state)
@@ -188,6 +259,19 @@ class CassandraProvisionerStore(object):
         """
         return self._get_record(node_id, self._node_column_family, count)
 
+    @timeout(CASSANDRA_TIMEOUT)
+    @defer.inlineCallbacks
+    def get_nodes_by_ids(self, node_ids):
+        """
+        @brief Retrieves the latest records for a set of node ids
+        @param node_ids Ids of node records to retrieve
+        @retval Deferred list of records, in the same order as node_ids.
+                Unknown nodes have a None entry.
+        """
+        records = yield self._get_latest_records(self._node_column_family,
+                                                 node_ids)
+        defer.returnValue([records.get(node_id) for node_id in node_ids])
+
     @timeout(CASSANDRA_TIMEOUT)
     def get_nodes(self, state=None, min_state=None, max_state=None):
         """
@@ -198,10 +282,46 @@ class CassandraProvisionerStore(object):
         @retval Deferred list of launch records
         """
         return self._get_records(self._node_column_family,
+                                 self._node_state_column_family,
                                  state=state,
                                  min_state=min_state,
                                  max_state=max_state)
 
+    @defer.inlineCallbacks
+    def assure_state_index(self):
+        """
+        @brief Builds the state indexes if that has not been done yet
+        Until then, records written before the state indexes existed are not
+        returned by get_launches() or get_nodes().
+        @retval Deferred for success
+        """
+        marker = yield self.client.get_slice(self._STATE_INDEX_MARKER,
+                                             self._node_state_column_family,
+                                             count=1)
+        if marker:
+            return
+
+        log.info("Building provisioner state indexes from existing records")
+        yield self.rebuild_state_index()
+        yield self.client.insert(self._STATE_INDEX_MARKER,
+                                 self._node_state_column_family,
+                                 str(int(time.time())), column='built')
+
+    @defer.inlineCallbacks
+    def rebuild_state_index(self):
+        """
+        @brief Rebuilds the state indexes from a full scan of all records
+        Needed once for data written before the state indexes existed. Only
+        index columns are written, the records are left alone.
+        @retval Deferred for success
+        """
+        launches = yield self._scan_records(self._launch_column_family)
+        nodes = yield self._scan_records(self._node_column_family)
+        rows = [self._launch_row(launch) for launch in launches]
+        rows.extend(self._node_row(node) for node in nodes)
+        for i in range(0, len(rows), self._batch_size):
+            yield self._put_index(rows[i:i+self._batch_size])
+
     @defer.inlineCallbacks
     def _get_record(self, key, column_family, count):
         slice = yield self.client.get_slice(key, column_family,
@@ -220,24 +340,87 @@ class CassandraProvisionerStore(object):
         defer.returnValue(ret)
 
     @defer.inlineCallbacks
-    def _get_records(self, column_family, state=None, min_state=None,
-                     max_state=None, reverse=True):
+    def _get_records(self, column_family, index_column_family, state=None,
+                     min_state=None, max_state=None):
 
         # overrides range arguments
         if state:
             min_state = max_state = state
 
+        # The state index gives us candidate IDs for each state in the range.
+        # It can be stale: a delayed write of an old state re-adds an ID to
+        # that state's index row even though the record has moved on, and a
+        # failed index write leaves an ID under its previous state. So the
+        # latest record of each candidate is fetched and checked, and stale
+        # records are reindexed under their latest state as they are found.
+
+        candidates = {}
+        for index_state in states_in_range(min_state, max_state):
+            keys = yield self._get_index_row(index_column_family, index_state)
+            for key in keys:
+                candidates.setdefault(key, []).append(index_state)
+
+        latest = yield self._get_latest_records(column_family,
+                                                candidates.keys())
+        records = []
+        stale = []
+        for key, record in latest.iteritems():
+            record_state = record['state']
+            if not max_state or record_state <= max_state:
+                if not min_state or record_state >= min_state:
+                    records.append(record)
+            for index_state in candidates[key]:
+                if index_state < record_state:
+                    stale.append((key, column_family, index_column_family,
+                                  record))
+                    break
+
+        if stale:
+            log.debug("Reindexing %d records with stale state index entries "
+                      "in %s", len(stale), index_column_family)
+            for i in range(0, len(stale), self._batch_size):
+                yield self._put_index(stale[i:i+self._batch_size])
+
+        defer.returnValue(records)
+
+    @defer.inlineCallbacks
+    def _get_latest_records(self, column_family, keys):
+        # multigets the latest state record for each key, a page at a time.
+        # Returns a dict of key -> record. Unknown keys are left out.
+        records = {}
+        keys = list(keys)
+        for i in range(0, len(keys), self._PAGE_SIZE):
+            slices = yield self.client.multiget_slice(
+                keys[i:i+self._PAGE_SIZE], column_family, reverse=True,
+                count=1)
+            for key, columns in slices.iteritems():
+                if columns:
+                    records[key] = json.loads(columns[0].column.value)
+        defer.returnValue(records)
+
+    @defer.inlineCallbacks
+    def _get_index_row(self, index_column_family, state):
+        keys = []
         start = ''
-        end = min_state or ''
-        if not reverse:
-            start, end = end, start
+        while True:
+            slice = yield self.client.get_slice(state, index_column_family,
+                                                start=start,
+                                                count=self._PAGE_SIZE)
+            names = [column.column.name for column in slice]
+            if start:
+                # column_start is inclusive, skip the dupe from last page
+                names = names[1:]
+            keys.extend(names)
+
+            if len(slice) < self._PAGE_SIZE:
+                break
+            start = slice[-1].column.name
+        defer.returnValue(keys)
 
-        # this is tricky. We are only concerned with the latest state record
-        # (by sort order not necessarily time). So when we look for records
-        # within a state range, we effectively must pull down the latest state
-        # for each record, and filter them locally. This is slightly improved
-        # when a first_state (or last when reverse=False) is specified as the
-        # server can skip any records not >= that state. 
+    @defer.inlineCallbacks
+    def _scan_records(self, column_family):
+        # pages through every row in the column family, pulling down the
+        # latest state record of each.
 
         records = []
         done = False
@@ -245,9 +428,7 @@ class CassandraProvisionerStore(object):
         iterations = 0
         while not done:
             slices = yield self.client.get_range_slices(column_family,
-                                                        column_start=start,
-                                                        column_finish=end,
-                                                        reverse=reverse,
+                                                        reverse=True,
                                                         column_count=1,
                                                         start=start_key,
                                                         count=self._PAGE_SIZE)
@@ -264,10 +445,7 @@ class CassandraProvisionerStore(object):
                     # rows without matching columns will still be returned
                     continue
 
-                record = json.loads(slice.columns[0].column.value)
-                if not max_state or record['state'] <= max_state:
-                    if not min_state or record['state'] >= min_state:
-                        records.append(record)
+                records.append(json.loads(slice.columns[0].column.value))
 
             # page through results. by default only 100 are returned at a time
             if len(slices) == self._PAGE_SIZE:
@@ -312,14 +490,15 @@ class ProvisionerStore(object):
         return defer.succeed(None)
 
     @defer.inlineCallbacks
-    def put_nodes(self, nodes):
+    def put_nodes(self, nodes, launch=None):
         """
-        @brief Stores a set of node records
+        @brief Stores a set of node records, and optionally their launch
         @param nodes Iterable of node records
+        @param launch Optional launch record to store along with the nodes
         @retval Deferred for success
         """
-
-        # could be more efficient with a batch_mutate
+        if launch:
+            yield self.put_launch(launch)
         for node in nodes:
             yield self.put_node(node)
 
@@ -379,6 +558,19 @@ class ProvisionerStore(object):
             ret = None
         return defer.succeed(ret)
 
+    def get_nodes_by_ids(self, node_ids):
+        """
+        @brief Retrieves the latest records for a set of node ids
+        @param node_ids Ids of node records to retrieve
+        @retval Deferred list of records, in the same order as node_ids.
+                Unknown nodes have a None entry.
+        """
+        records = []
+        for node_id in node_ids:
+            record = self.nodes.get(node_id)
+            records.append(json.loads(record) if record else None)
+        return defer.succeed(records)
+
     def get_nodes(self, state=None, min_state=None, max_state=None):
         """
         @brief Retrieves all launch record within a state range
@@ -405,6 +597,237 @@ class ProvisionerStore(object):
         return records
 
 
+class IndexedProvisionerStore(object):
+    """In-memory version of Provisioner storage, without serialization
+
+    Unlike ProvisionerStore, records are kept as dicts instead of JSON
+    strings, and each record type has a state -> IDs index so range queries
+    only touch records in the requested states.
+
+    Records are copied when stored, so later changes by the caller do not
+    leak in. Stored records are never modified, only replaced, and reads
+    return shallow copies. Callers may change the top-level fields of a
+    record they get back, but must not modify nested values (lists, dicts)
+    in place.
+    """
+    def __init__(self):
+        self.nodes = _IndexedRecords('node_id')
+        self.launches = _IndexedRecords('launch_id')
+
+    def assure_schema(self):
+        pass
+
+    def put_launch(self, launch):
+        """
+        @brief Stores a single launch record
+        @param launch Launch record to store
+        @retval Deferred for success
+        """
+        self.launches.put(launch)
+        return defer.succeed(None)
+
+    def put_nodes(self, nodes, launch=None):
+        """
+        @brief Stores a set of node records, and optionally their launch
+        @param nodes Iterable of node records
+        @param launch Optional launch record to store along with the nodes
+        @retval Deferred for success
+        """
+        if launch:
+            self.launches.put(launch)
+        for node in nodes:
+            self.nodes.put(node)
+        return defer.succeed(None)
+
+    def put_node(self, node):
+        """
+        @brief Stores a node record
+        @param node Node record
+        @retval Deferred for success
+        """
+        self.nodes.put(node)
+        return defer.succeed(None)
+
+    def get_launch(self, launch_id, count=1):
+        """
+        @brief Retrieves a launch record by id
+        @param launch_id Id of launch record to retrieve
+        @param count Number of launch state records to retrieve
+        @retval Deferred record(s), or None. A list of records if count > 1
+        """
+        assert count == 1
+        return defer.succeed(self.launches.get(launch_id))
+
+    def get_launches(self, state=None, min_state=None, max_state=None):
+        """
+        @brief Retrieves the latest record for all launches within a state range
+        @param state Only retrieve nodes in this state.
+        @param min_state Inclusive start bound
+        @param max_state Inclusive end bound
+        @retval Deferred list of launch records
+        """
+        records = self.launches.get_range(state, min_state, max_state)
+        return defer.succeed(records)
+
+    def get_node(self, node_id, count=1):
+        """
+        @brief Retrieves a launch record by id
+        @param node_id Id of node record to retrieve
+        @param count Number of node state records to retrieve
+        @retval Deferred record(s), or None. A list of records if count > 1
+        """
+        assert count == 1
+        return defer.succeed(self.nodes.get(node_id))
+
+    def get_nodes_by_ids(self, node_ids):
+        """
+        @brief Retrieves the latest records for a set of node ids
+        @param node_ids Ids of node records to retrieve
+        @retval Deferred list of records, in the same order as node_ids.
+                Unknown nodes have a None entry.
+        """
+        return defer.succeed([self.nodes.get(node_id)
+                              for node_id in node_ids])
+
+    def get_nodes(self, state=None, min_state=None, max_state=None):
+        """
+        @brief Retrieves all launch record within a state range
+        @param state Only retrieve nodes in this state.
+        @param min_state Inclusive start bound.
+        @param max_state Inclusive end bound
+        @retval Deferred list of launch records
+        """
+        records = self.nodes.get_range(state, min_state, max_state)
+        return defer.succeed(records)
+
+
+class _IndexedRecords(object):
+    """Latest records of one type, by ID and by state
+    """
+    def __init__(self, id_key):
+        self.id_key = id_key
+        self.records = {}
+        self.state_index = {}
+
+    def __len__(self):
+        return len(self.records)
+
+    def put(self, record):
+        record_id = record[self.id_key]
+        state = record['state']
+
+        existing = self.records.get(record_id)
+        if existing:
+            existing_state = existing['state']
+            if existing_state > state:
+                return
+            if existing_state != state:
+                ids = self.state_index[existing_state]
+                ids.discard(record_id)
+                if not ids:
+                    del self.state_index[existing_state]
+
+        self.records[record_id] = copy_record(record)
+        self.state_index.setdefault(state, set()).add(record_id)
+
+    def get(self, record_id):
+        record = self.records.get(record_id)
+        if record is None:
+            return None
+        return dict(record)
+
+    def get_range(self, state=None, min_state=None, max_state=None):
+        # overrides range arguments
+        if state:
+            min_state = max_state = state
+
+        records = []
+        for index_state, ids in self.state_index.iteritems():
+            if max_state and index_state > max_state:
+                continue
+            if min_state and index_state < min_state:
+                continue
+            records.extend(dict(self.records[record_id]) for record_id in ids)
+        return records
+
+
+def copy_record(value):
+    """Copies a JSON-like structure of dicts and lists
+
+    Much cheaper than a deepcopy or a JSON round trip.
+    """
+    if isinstance(value, dict):
+        return dict((k, copy_record(v)) for k, v in value.iteritems())
+    if isinstance(value, (list, tuple)):
+        return [copy_record(v) for v in value]
+    return value
+
+
+def _build_record_mutation_map(rows):
+    """Builds a batch_mutate mutation map for a set of records
+
+    rows is a list of (key, cf, index cf, record) tuples. Each record becomes
+    a single column named by its state, and multiple records for the same
+    key are merged into the same row.
+    """
+    timestamp = _timestamp()
+    mutation_map = {}
+    for key, column_family, index_column_family, record in rows:
+        row = mutation_map.setdefault(key, {}).setdefault(column_family, [])
+        row.append(Column(record['state'], json.dumps(record), timestamp))
+    return mutation_map
+
+
+def _build_index_mutation_map(rows, final_state_ttl=None):
+    """Builds a batch_mutate mutation map that indexes a set of records
+
+    rows is a list of (key, cf, index cf, record) tuples. Each record's key
+    is added to the index row for its state and removed from the index rows
+    of all earlier states. Index columns for final states expire after
+    final_state_ttl seconds, if set.
+    """
+    timestamp = _timestamp()
+    mutation_map = {}
+    index_deletions = {}
+    for key, column_family, index_column_family, record in rows:
+        state = record['state']
+        index_row = mutation_map.setdefault(state, {}).setdefault(
+            index_column_family, [])
+        if final_state_ttl and state >= states.TERMINATED:
+            index_row.append(Column(key, '', timestamp, ttl=final_state_ttl))
+        else:
+            index_row.append(Column(key, '', timestamp))
+
+        for earlier_state in states_in_range(max_state=state):
+            if earlier_state != state:
+                index_deletions.setdefault(
+                    (earlier_state, index_column_family), []).append(key)
+
+    for (state, index_column_family), keys in index_deletions.iteritems():
+        index_row = mutation_map.setdefault(state, {}).setdefault(
+            index_column_family, [])
+        index_row.append(_deletion(keys, timestamp))
+    return mutation_map
+
+
+def _deletion(column_names, timestamp):
+    return Deletion(timestamp=timestamp,
+                    predicate=SlicePredicate(column_names=column_names))
+
+
+def _timestamp():
+    # same microsecond timestamps telephus uses for plain inserts
+    return int(time.time() * 1000000)
+
+
+def states_in_range(min_state=None, max_state=None):
+    """Returns the known record states within an inclusive range, in order
+    """
+    return [state for state in states.ALL_STATES
+            if (not min_state or state >= min_state) and
+               (not max_state or state <= max_state)]
+
+
 def group_records(records, *args):
     """Breaks records into groups of distinct values for the specified keys
 
@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+
+"""
+@file epu/provisioner/test/bench_context.py
+@brief Context broker client benchmarks
+
+Run with: python -m epu.provisioner.test.bench_context
+"""
+
+import httplib
+import socket
+import threading
+import time
+import urlparse
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+
+from twisted.internet import defer
+
+from epu.provisioner.core import ProvisionerContextClient
+from epu.test import run_benchmarks, print_benchmark
+
+# simulated broker processing time per request, in seconds
+BROKER_LATENCY = 0.002
+
+
+class _BrokerHandler(BaseHTTPRequestHandler):
+    # keep connections open between requests, as the broker does
+    protocol_version = "HTTP/1.1"
+
+    # send each response in one write, so kept-alive connections are not
+    # held up by delayed ACKs
+    wbufsize = -1
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.server.count_connection()
+
+    def _reply(self, body):
+        time.sleep(BROKER_LATENCY)
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self._reply("incomplete")
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        self._reply(self.path + "ctx/1")
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _BrokerServer(ThreadingMixIn, HTTPServer):
+    """Local stand-in for the context broker that counts connections made
+    """
+    daemon_threads = True
+
+    def __init__(self):
+        HTTPServer.__init__(self, ("127.0.0.1", 0), _BrokerHandler)
+        self.connections = 0
+        self._lock = threading.Lock()
+
+    def count_connection(self):
+        with self._lock:
+            self.connections += 1
+
+    @property
+    def uri(self):
+        return "http://%s:%d/ContextBroker/" % self.server_address
+
+
+class _HTTPContextClient(object):
+    """Stand-in for nimboss ContextClient: one persistent HTTP connection
+    per client, opened on first use
+    """
+    def __init__(self, broker_uri, key, secret):
+        url = urlparse.urlparse(broker_uri)
+        self.path = url.path
+        self.conn = httplib.HTTPConnection(url.hostname, url.port)
+
+    def _request(self, method, path, body=None):
+        self.conn.request(method, path, body)
+        response = self.conn.getresponse()
+        return response.read()
+
+    def create_context(self):
+        return self._request("POST", self.path, "")
+
+    def get_status(self, resource):
+        return self._request("GET", resource)
+
+
+class _PooledContextClient(ProvisionerContextClient):
+    def _get_client(self):
+        return _HTTPContextClient(self._broker_uri, self._key, self._secret)
+
+
+class _UnpooledContextClient(_PooledContextClient):
+    """The previous behavior: a new client for every call
+    """
+    def create(self):
+        client = self._get_client()
+        return self.thread_pools.run('context', client.create_context)
+
+    def query(self, resource):
+        client = self._get_client()
+        return self.thread_pools.run('context', client.get_status, resource)
+
+
+@defer.inlineCallbacks
+def bench_query_cycle(launch_count=200, cycles=5):
+    """Connections made to the broker per context query cycle, with and
+    without pooled clients
+    """
+    server = _BrokerServer()
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    try:
+        results = []
+        for name, client_class in (("new client per call", _UnpooledContextClient),
+                                   ("pooled clients", _PooledContextClient)):
+            context = client_class(server.uri, "key", "secret")
+            resources = []
+            for i in range(launch_count):
+                resource = yield context.create()
+                resources.append(resource)
+
+            server.connections = 0
+            start = time.time()
+            for i in range(cycles):
+                yield defer.DeferredList([context.query(resource)
+                                          for resource in resources],
+                                         fireOnOneErrback=True)
+            elapsed = time.time() - start
+            context.stop()
+
+            per_cycle = server.connections / float(cycles)
+            results.append(per_cycle)
+            print_benchmark("query_contexts %s" % name,
+                            launch_count * cycles, elapsed, "queries")
+            print "    %.1f connections/cycle" % per_cycle
+        print "    %.1f handshakes avoided/cycle" % (results[0] - results[1])
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+if __name__ == '__main__':
+    run_benchmarks(bench_query_cycle)
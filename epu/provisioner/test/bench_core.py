@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+
+"""
+@file epu/provisioner/test/bench_core.py
+@brief Provisioner core benchmarks
+
+Run with: python -m epu.provisioner.test.bench_core
+"""
+
+import time
+
+from twisted.internet import defer
+
+from epu.provisioner.core import ProvisionerCore
+from epu.provisioner.store import ProvisionerStore
+from epu.provisioner.test.util import FakeProvisionerNotifier, \
+    FakeNodeDriver, FakeContextClient, make_launch_and_nodes, make_launch, \
+    make_node, new_id
+from epu.test import run_benchmarks, print_benchmark
+from epu import states
+
+# simulated round trip to the context broker, in seconds
+BROKER_LATENCY = 0.02
+
+# simulated IaaS call duration, in seconds
+IAAS_LATENCY = 0.2
+
+_WORKSPACE = """
+  <workspace>
+    <name>%s</name>
+    <quantity>%d</quantity>
+    <image>%s</image>
+    <ctx></ctx>
+  </workspace>
+"""
+
+
+def _get_core(**kwargs):
+    store = ProvisionerStore()
+    notifier = FakeProvisionerNotifier()
+    site_drivers = {'fake' : FakeNodeDriver(latency=IAAS_LATENCY)}
+    context = FakeContextClient(latency=BROKER_LATENCY)
+    core = ProvisionerCore(store, notifier, None, site_drivers, context,
+                           **kwargs)
+    return core
+
+
+@defer.inlineCallbacks
+def bench_query_contexts(launch_count=200, nodes_per_launch=3):
+    """Times one context query cycle over many booting launches
+    """
+    for concurrency in (1, 8, 32):
+        core = _get_core(context_query_concurrency=concurrency)
+        for i in range(launch_count):
+            launch, nodes = make_launch_and_nodes(new_id(), nodes_per_launch,
+                                                  states.STARTED)
+            launch['state'] = states.PENDING
+            yield core.store.put_nodes(nodes, launch=launch)
+
+        # contexts are all still incomplete
+        start = time.time()
+        yield core.query_contexts()
+        elapsed = time.time() - start
+        print_benchmark("query_contexts concurrency=%d" % concurrency,
+                        len(core.context.queried_uris), elapsed, "contexts")
+
+
+@defer.inlineCallbacks
+def bench_execute_provision(group_count=6, nodes_per_group=2):
+    """Times a multi-group launch, sequential and concurrent
+    """
+    for concurrency in (1, group_count):
+        core = _get_core(launch_group_concurrency=concurrency)
+        context = yield core.context.create()
+        launch_id = new_id()
+
+        workspaces = []
+        nodes = []
+        for i in range(group_count):
+            group_name = "group%d" % i
+            workspaces.append(_WORKSPACE % (group_name, nodes_per_group,
+                                            "image"))
+            for j in range(nodes_per_group):
+                nodes.append(make_node(launch_id, states.REQUESTED,
+                                       site='fake', ctx_name=group_name))
+        launch = make_launch(launch_id, states.REQUESTED, nodes,
+                             document="<cluster>%s</cluster>" %
+                                      "".join(workspaces),
+                             context=context)
+        yield core.store.put_nodes(nodes, launch=launch)
+
+        start = time.time()
+        yield core.execute_provision(launch, nodes)
+        elapsed = time.time() - start
+        assert launch['state'] == states.PENDING, launch.get('state_desc')
+        print_benchmark("execute_provision launch_group_concurrency=%d" %
+                        concurrency, group_count, elapsed, "groups")
+
+
+if __name__ == '__main__':
+    run_benchmarks(bench_query_contexts, bench_execute_provision)
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+
+"""
+@file epu/provisioner/test/bench_store.py
+@brief Provisioner store benchmarks
+
+Run with: python -m epu.provisioner.test.bench_store
+"""
+
+import time
+import random
+
+from twisted.internet import defer
+
+from epu.provisioner.store import CassandraProvisionerStore, \
+    ProvisionerStore, IndexedProvisionerStore
+from epu.provisioner.test.util import FakeCassandraClient, \
+    make_launch_and_nodes, new_id
+from epu.test import run_benchmarks, print_benchmark
+from epu import states
+
+# simulated round trip to Cassandra, in seconds
+CASSANDRA_LATENCY = 0.002
+
+
+def _get_store(batch_size=None, latency=CASSANDRA_LATENCY):
+    store = CassandraProvisionerStore("localhost", 9160, "user", "pass",
+                                      "keyspace", batch_size=batch_size)
+    store.client = FakeCassandraClient(latency=latency)
+    return store
+
+
+@defer.inlineCallbacks
+def bench_put_nodes(node_count=500):
+    """Compares one insert per node against batched put_nodes
+    """
+    launch, nodes = make_launch_and_nodes(new_id(), node_count,
+                                          states.PENDING)
+
+    store = _get_store()
+    start = time.time()
+    yield store.put_launch(launch)
+    for node in nodes:
+        yield store.put_node(node)
+    elapsed = time.time() - start
+    print_benchmark("put_node loop (%d round trips)" %
+                    sum(store.client.calls.values()),
+                    node_count, elapsed, "nodes")
+
+    for batch_size in (10, 100, 1000):
+        store = _get_store(batch_size=batch_size)
+        start = time.time()
+        yield store.put_nodes(nodes, launch=launch)
+        elapsed = time.time() - start
+        print_benchmark("put_nodes batch_size=%d (%d round trips)" %
+                        (batch_size, sum(store.client.calls.values())),
+                        node_count, elapsed, "nodes")
+
+
+def bench_memory_stores(sizes=(10000, 100000), live_fraction=0.1):
+    """Compares put/get/range throughput of the in-memory stores
+
+    Most nodes end up TERMINATED, as in a long running deployment, and the
+    range query is the one query_nodes makes every cycle.
+    """
+    for node_count in sizes:
+        launch, nodes = make_launch_and_nodes(new_id(), node_count,
+                                              states.PENDING)
+        live_count = int(node_count * live_fraction)
+        node_ids = [node['node_id'] for node in nodes]
+        lookups = [random.choice(node_ids) for i in range(node_count)]
+
+        for store_class in (ProvisionerStore, IndexedProvisionerStore):
+            name = "%s %d nodes" % (store_class.__name__, node_count)
+            store = store_class()
+
+            start = time.time()
+            for node in nodes:
+                store.put_node(node)
+            for node in nodes[live_count:]:
+                node['state'] = states.TERMINATED
+                store.put_node(node)
+                node['state'] = states.PENDING
+            puts = 2 * node_count - live_count
+            print_benchmark(name + " put_node", puts, time.time() - start)
+
+            start = time.time()
+            for node_id in lookups:
+                store.get_node(node_id)
+            print_benchmark(name + " get_node", len(lookups),
+                            time.time() - start)
+
+            start = time.time()
+            found = []
+            store.get_nodes(max_state=states.TERMINATING).addCallback(
+                found.extend)
+            assert len(found) == live_count
+            print_benchmark(name + " get_nodes(max_state=TERMINATING)", 1,
+                            time.time() - start, "queries")
+
+
+if __name__ == '__main__':
+    run_benchmarks(bench_put_nodes, bench_memory_stores)
@@ -12,9 +12,10 @@ import ion.util.ionlog
 from nimboss.ctx import BrokerError, ContextNotFoundError
 
 from epu.ionproc.dtrs import DeployableTypeLookupError
+from epu.ionproc.provisioner import ProvisionerNotifier
 from epu.provisioner.core import ProvisionerCore, update_nodes_from_context, \
-    update_node_ip_info
-from epu.provisioner.store import ProvisionerStore
+    update_node_ip_info, ContextClientPool
+from epu.provisioner.store import ProvisionerStore, group_records
 from epu import states
 from epu.provisioner.test.util import FakeProvisionerNotifier, \
     FakeNodeDriver, FakeContextClient, make_launch, make_node, \
@@ -37,6 +38,9 @@ class ProvisionerCoreRecoveryTests(unittest.TestCase):
                                     dtrs=self.dtrs, site_drivers=drivers,
                                     context=self.ctx)
 
+    def tearDown(self):
+        self.core.stop()
+
     @defer.inlineCallbacks
     def test_recover_launch_incomplete(self):
         """Ensures that launches in REQUESTED state are completed
@@ -203,6 +207,9 @@ class ProvisionerCoreTests(unittest.TestCase):
                                     dtrs=self.dtrs, context=self.ctx,
                                     site_drivers=drivers)
 
+    def tearDown(self):
+        self.core.stop()
+
     @defer.inlineCallbacks
     def test_prepare_dtrs_error(self):
         self.dtrs.error = DeployableTypeLookupError()
@@ -259,6 +266,51 @@ class ProvisionerCoreTests(unittest.TestCase):
 
         yield self.core.execute_provision(launch, nodes)
 
+    @defer.inlineCallbacks
+    def _execute_two_groups(self):
+        ctx = yield self.ctx.create()
+        doc = "<cluster>%s%s</cluster>" % (
+            _get_workspace("group1", "image1", 2),
+            _get_workspace("group2", "image2", 1))
+        nodes = [make_node("thelaunchid", states.REQUESTED, site="site1",
+                           ctx_name="group1") for i in range(2)]
+        nodes.append(make_node("thelaunchid", states.REQUESTED, site="site2",
+                               ctx_name="group2"))
+        launch_record = make_launch("thelaunchid", states.REQUESTED, nodes,
+                                    document=doc, context=ctx)
+        yield self.store.put_nodes(nodes, launch=launch_record)
+
+        yield self.core.execute_provision(launch_record, nodes)
+        launch = yield self.store.get_launch("thelaunchid")
+        defer.returnValue((launch, nodes))
+
+    @defer.inlineCallbacks
+    def test_execute_groups_concurrently(self):
+        self.core.launch_group_concurrency = 2
+        self.site1_driver.latency = 0.1
+        self.site2_driver.latency = 0.1
+
+        launch, nodes = yield self._execute_two_groups()
+        self.assertEqual(launch['state'], states.PENDING)
+        self.assertTrue(self.notifier.assure_state(states.PENDING))
+        self.assertEqual(len(self.site1_driver.created), 2)
+        self.assertEqual(len(self.site2_driver.created), 1)
+
+    @defer.inlineCallbacks
+    def test_execute_groups_concurrently_one_fails(self):
+        self.core.launch_group_concurrency = 2
+        self.site1_driver.create_node_error = InvalidCredsError()
+
+        launch, nodes = yield self._execute_two_groups()
+        self.assertEqual(launch['state'], states.FAILED)
+
+        # the group that did not fail is still launched
+        self.assertTrue(self.notifier.assure_state(states.FAILED,
+            [node['node_id'] for node in nodes[:2]]))
+        self.assertTrue(self.notifier.assure_state(states.PENDING,
+            [nodes[2]['node_id']]))
+        self.assertEqual(len(self.site2_driver.created), 1)
+
     @defer.inlineCallbacks
     def test_execute_bad_doc(self):
         ctx = yield self.ctx.create()
@@ -408,6 +460,149 @@ class ProvisionerCoreTests(unittest.TestCase):
         self.assertEqual(node['state'], states.TERMINATED)
 
 
+    @defer.inlineCallbacks
+    def _put_pending_site_nodes(self):
+        # one PENDING node on each site, running in IaaS
+        node_ids = {}
+        for site, driver in (('site1', self.site1_driver),
+                             ('site2', self.site2_driver)):
+            iaas_node = driver.create_node()[0]
+            driver.set_node_running(iaas_node.id)
+            launch_id = _new_id()
+            node = make_node(launch_id, states.PENDING, site=site,
+                             iaas_id=iaas_node.id)
+            launch = make_launch(launch_id, states.PENDING, [node])
+            yield self.store.put_nodes([node], launch=launch)
+            node_ids[site] = node['node_id']
+        defer.returnValue(node_ids)
+
+    @defer.inlineCallbacks
+    def test_query_batched_notify(self):
+        sent = []
+        def send(name, operation, content):
+            sent.append((name, operation, content))
+            return defer.succeed(None)
+        self.core.notifier = ProvisionerNotifier(Mock(send=send),
+                                                 batch_subscribers=["batched"])
+
+        # 10 launches of 3 nodes each come up in a single site query
+        for i in range(10):
+            launch_id = _new_id()
+            nodes = []
+            for iaas_node in self.site1_driver.create_node(ex_mincount=3):
+                self.site1_driver.set_node_running(iaas_node.id)
+                nodes.append(make_node(launch_id, states.PENDING,
+                                       site='site1', iaas_id=iaas_node.id))
+            launch = make_launch(launch_id, states.PENDING, nodes,
+                                 subscribers=["batched", "old"])
+            yield self.store.put_nodes(nodes, launch=launch)
+
+        nodes = yield self.store.get_nodes()
+        yield self.core.query_one_site('site1', nodes)
+
+        batched = [m for m in sent if m[0] == "batched"]
+        self.assertEqual(len(batched), 1)
+        self.assertEqual(batched[0][1], "instance_states")
+        records = batched[0][2]['records']
+        self.assertEqual(len(records), 30)
+        self.assertEqual(set(r['state'] for r in records),
+                         set([states.STARTED]))
+        self.assertEqual(len([m for m in sent if m[0] == "old"]), 30)
+
+        nodes = yield self.store.get_nodes(state=states.STARTED)
+        self.assertEqual(len(nodes), 30)
+
+    @defer.inlineCallbacks
+    def test_query_request(self):
+        node_ids = yield self._put_pending_site_nodes()
+
+        # only the requested site is contacted
+        yield self.core.query_nodes({'sites': ['site2'], 'contexts': False})
+        self.assertEqual(self.site1_driver.calls.get('list_nodes'), None)
+        self.assertEqual(self.site2_driver.calls.get('list_nodes'), 1)
+        node = yield self.store.get_node(node_ids['site2'])
+        self.assertEqual(node['state'], states.STARTED)
+
+        # only sites with nodes in the requested states are contacted
+        yield self.core.query_nodes({'min_state': states.PENDING,
+                                     'max_state': states.PENDING,
+                                     'contexts': False})
+        self.assertEqual(self.site1_driver.calls.get('list_nodes'), 1)
+        self.assertEqual(self.site2_driver.calls.get('list_nodes'), 1)
+        node = yield self.store.get_node(node_ids['site1'])
+        self.assertEqual(node['state'], states.STARTED)
+
+        yield self.core.query_nodes({'min_state': states.RUNNING,
+                                     'contexts': False})
+        self.assertEqual(self.site1_driver.calls.get('list_nodes'), 1)
+        self.assertEqual(self.site2_driver.calls.get('list_nodes'), 1)
+        self.assertFalse(self.ctx.queried_uris)
+
+    @defer.inlineCallbacks
+    def test_query_site_timeout(self):
+        node_ids = yield self._put_pending_site_nodes()
+
+        # site1 takes too long to respond, site2 should still be updated
+        self.site1_driver.latency = 0.5
+        self.core.site_query_timeout = 0.1
+
+        yield self.core.query_nodes()
+
+        node = yield self.store.get_node(node_ids['site1'])
+        self.assertEqual(node['state'], states.PENDING)
+        node = yield self.store.get_node(node_ids['site2'])
+        self.assertEqual(node['state'], states.STARTED)
+
+    @defer.inlineCallbacks
+    def test_site_thread_pools(self):
+        node_ids = yield self._put_pending_site_nodes()
+        nodes = yield self.store.get_nodes()
+        site_nodes = group_records(nodes, 'site')
+
+        # site1 is slow and its one thread is taken, site2 still gets through
+        self.core.site_thread_pools.sizes['site1'] = 1
+        self.site1_driver.latency = 0.5
+        slow = [self.core.query_one_site('site1', site_nodes['site1'])
+                for i in range(2)]
+
+        yield self.core.query_one_site('site2', site_nodes['site2'])
+        node = yield self.store.get_node(node_ids['site2'])
+        self.assertEqual(node['state'], states.STARTED)
+        node = yield self.store.get_node(node_ids['site1'])
+        self.assertEqual(node['state'], states.PENDING)
+
+        stats = self.core.thread_pool_stats()['sites']
+        self.assertEqual(stats['site1']['size'], 1)
+        self.assertEqual(stats['site1']['running'], 1)
+        self.assertEqual(stats['site1']['waiting'], 1)
+        self.assertEqual(stats['site2']['size'], 8)
+        self.assertEqual(stats['site2']['calls'], 1)
+        self.assertEqual(stats['site2']['running'], 0)
+
+        yield defer.DeferredList(slow)
+        stats = self.core.thread_pool_stats()['sites']
+        self.assertEqual(stats['site1']['calls'], 2)
+        self.assertEqual(stats['site1']['waiting'], 0)
+        self.assertEqual(stats['site1']['running'], 0)
+        node = yield self.store.get_node(node_ids['site1'])
+        self.assertEqual(node['state'], states.STARTED)
+
+    @defer.inlineCallbacks
+    def test_query_site_error(self):
+        node_ids = yield self._put_pending_site_nodes()
+
+        self.site2_driver.list_nodes_error = InvalidCredsError()
+        self.core.site_query_concurrency = 1
+
+        nodes = yield self.store.get_nodes()
+        failed_sites = yield self.core.query_sites(group_records(nodes, 'site'))
+        self.assertEqual(failed_sites, ['site2'])
+
+        node = yield self.store.get_node(node_ids['site1'])
+        self.assertEqual(node['state'], states.STARTED)
+        node = yield self.store.get_node(node_ids['site2'])
+        self.assertEqual(node['state'], states.PENDING)
+
     @defer.inlineCallbacks
     def test_query_ctx(self):
         node_count = 3
@@ -445,6 +640,69 @@ class ProvisionerCoreTests(unittest.TestCase):
         self.assertTrue(self.notifier.assure_state(states.RUNNING))
         self.assertTrue(self.notifier.assure_record_count(1))
     
+    @defer.inlineCallbacks
+    def test_query_ctx_concurrent(self):
+        for i in range(5):
+            launch_id = _new_id()
+            node_records = [make_node(launch_id, states.STARTED)]
+            launch_record = make_launch(launch_id, states.PENDING,
+                                        node_records)
+            yield self.store.put_nodes(node_records, launch=launch_record)
+            self.ctx.nodes.append(_one_fake_ctx_node_ok(
+                node_records[0]['public_ip'], _new_id(), _new_id()))
+
+        self.ctx.latency = 0.01
+        self.ctx.complete = True
+        self.core.context_query_concurrency = 2
+
+        # one unexpected error shouldn't stop the others
+        launches = yield self.store.get_launches(state=states.PENDING)
+        self.ctx.uri_query_error[launches[0]['context']['uri']] = \
+            ValueError("bad programmer")
+
+        yield self.core.query_contexts()
+        self.assertEqual(len(self.ctx.queried_uris), 5)
+
+        # contexts were complete, nothing but the error launch is PENDING
+        launches = yield self.store.get_launches(state=states.PENDING)
+        self.assertEqual(len(launches), 1)
+
+    @defer.inlineCallbacks
+    def test_query_ctx_backoff(self):
+        launch_id = _new_id()
+        node_records = [make_node(launch_id, states.STARTED)
+                for i in range(2)]
+        launch_record = make_launch(launch_id, states.PENDING,
+                                    node_records)
+        yield self.store.put_nodes(node_records, launch=launch_record)
+
+        self.core.context_query_backoff = 60
+        self.core.context_query_max_backoff = 600
+        self.ctx.expected_count = len(node_records)
+
+        # no nodes have checked in, so the next query is put off
+        yield self.core.query_contexts()
+        yield self.core.query_contexts()
+        self.assertEqual(len(self.ctx.queried_uris), 1)
+        count, next_time = self.core._context_backoff[launch_id]
+        self.assertEqual(count, 1)
+
+        # once the backoff expires it is queried again and backs off further
+        self.core._context_backoff[launch_id] = (count, 0)
+        yield self.core.query_contexts()
+        self.assertEqual(len(self.ctx.queried_uris), 2)
+        count, next_time = self.core._context_backoff[launch_id]
+        self.assertEqual(count, 2)
+        self.assertTrue(next_time - time.time() > 60)
+
+        # progress resets the backoff
+        self.core._context_backoff[launch_id] = (count, 0)
+        self.ctx.nodes = [_one_fake_ctx_node_ok(node_records[0]['public_ip'],
+            _new_id(), _new_id())]
+        yield self.core.query_contexts()
+        self.assertEqual(len(self.ctx.queried_uris), 3)
+        self.assertNotIn(launch_id, self.core._context_backoff)
+
     @defer.inlineCallbacks
     def test_query_ctx_error(self):
         node_count = 3
@@ -672,6 +930,92 @@ class ProvisionerCoreTests(unittest.TestCase):
         self.assertEqual(self.notifier.nodes_rec_count[node_ids[1]], 1)
         self.assertNotIn(node_ids[2], self.notifier.nodes)
 
+    @defer.inlineCallbacks
+    def _put_running_nodes(self, driver, site, count):
+        launch_id = _new_id()
+        iaas_nodes = driver.create_node(ex_mincount=count)
+        node_records = [make_node(launch_id, states.RUNNING, site=site,
+                                  iaas_id=iaas_node.id)
+                        for iaas_node in iaas_nodes]
+        launch_record = make_launch(launch_id, states.RUNNING, node_records)
+        yield self.store.put_nodes(node_records, launch=launch_record)
+        defer.returnValue((launch_record, node_records))
+
+    @defer.inlineCallbacks
+    def test_terminate_launch_batched(self):
+        self.site1_driver = FakeNodeDriver(batch_destroy=True)
+        self.core.site_drivers['site1'] = self.site1_driver
+        launch, nodes = yield self._put_running_nodes(self.site1_driver,
+                                                      'site1', 5)
+
+        yield self.core.terminate_launch(launch['launch_id'])
+
+        self.assertEqual(self.site1_driver.calls.get('ex_destroy_nodes'), 1)
+        self.assertNotIn('destroy_node', self.site1_driver.calls)
+        self.assertEqual(len(self.site1_driver.destroyed), 5)
+        self.assertFalse(self.site1_driver.running)
+
+        node_ids = [node['node_id'] for node in nodes]
+        self.assertTrue(self.notifier.assure_state(states.TERMINATED,
+                                                   nodes=node_ids))
+        launch = yield self.store.get_launch(launch['launch_id'])
+        self.assertEqual(launch['state'], states.TERMINATED)
+
+    @defer.inlineCallbacks
+    def test_terminate_nodes_error(self):
+        launch1, nodes1 = yield self._put_running_nodes(self.site1_driver,
+                                                        'site1', 3)
+        launch2, nodes2 = yield self._put_running_nodes(self.site2_driver,
+                                                        'site2', 2)
+        self.site2_driver.destroy_node_error = InvalidCredsError()
+        self.core.terminate_concurrency = 2
+
+        node_ids = [node['node_id'] for node in nodes1 + nodes2]
+        try:
+            yield self.core.terminate_nodes(node_ids)
+        except InvalidCredsError:
+            pass
+        else:
+            self.fail("expected an error from terminate_nodes")
+
+        # site1 nodes were still destroyed, one call each
+        self.assertEqual(self.site1_driver.calls.get('destroy_node'), 3)
+        self.assertEqual(self.site2_driver.calls.get('destroy_node'), 2)
+        ok_ids = [node['node_id'] for node in nodes1]
+        self.assertTrue(self.notifier.assure_state(states.TERMINATED,
+                                                   nodes=ok_ids))
+        for node in nodes2:
+            self.assertNotIn(node['node_id'], self.notifier.nodes)
+            record = yield self.store.get_node(node['node_id'])
+            self.assertEqual(record['state'], states.RUNNING)
+
+    @defer.inlineCallbacks
+    def test_terminate_nodes_per_site(self):
+        launch1, nodes1 = yield self._put_running_nodes(self.site1_driver,
+                                                        'site1', 2)
+        launch2, nodes2 = yield self._put_running_nodes(self.site2_driver,
+                                                        'site2', 2)
+        self.core.terminate_concurrency = 1
+        self.site1_driver.latency = 0.5
+
+        # site2 terminations are not held up behind slow site1 ones
+        destroy_times = []
+        destroy_node = self.site2_driver.destroy_node
+        def timed_destroy_node(node):
+            destroy_times.append(time.time())
+            return destroy_node(node)
+        self.site2_driver.destroy_node = timed_destroy_node
+
+        start = time.time()
+        node_ids = [node['node_id'] for node in nodes1 + nodes2]
+        yield self.core.terminate_nodes(node_ids)
+
+        self.assertEqual(len(destroy_times), 2)
+        self.assertTrue(max(destroy_times) - start < 0.4)
+        self.assertEqual(self.site1_driver.calls.get('destroy_node'), 2)
+        self.assertTrue(self.notifier.assure_state(states.TERMINATED,
+                                                   nodes=node_ids))
+
     @defer.inlineCallbacks
     def test_mark_nodes_terminating(self):
         launch_id = _new_id()
@@ -695,6 +1039,181 @@ class ProvisionerCoreTests(unittest.TestCase):
             terminating_node = yield self.store.get_node(node_id)
             self.assertEqual(terminating_node['state'], states.TERMINATING)
 
+    @defer.inlineCallbacks
+    def test_launch_cache(self):
+        launch_id = _new_id()
+        iaas_nodes = self.site1_driver.create_node(ex_mincount=4)
+        node_records = [make_node(launch_id, states.PENDING, site='site1',
+                                  iaas_id=iaas_node.id,
+                                  pending_timestamp=time.time())
+                        for iaas_node in iaas_nodes]
+        launch_record = make_launch(launch_id, states.PENDING, node_records)
+        yield self.store.put_launch(launch_record)
+        yield self.store.put_nodes(node_records)
+
+        store_gets = []
+        get_launch = self.store.get_launch
+        def counting_get_launch(launch_id, *args, **kwargs):
+            store_gets.append(launch_id)
+            return get_launch(launch_id, *args, **kwargs)
+        self.store.get_launch = counting_get_launch
+
+        # four nodes change state but the launch is only fetched once
+        self.site1_driver.set_nodes_running([n.id for n in iaas_nodes])
+        yield self.core.query_one_site('site1', node_records)
+        self.assertTrue(self.notifier.assure_state(states.STARTED))
+        self.assertEqual(store_gets, [launch_id])
+
+        node_ids = [node['node_id'] for node in node_records]
+        yield self.core.dump_state(node_ids[:2])
+        yield self.core.mark_nodes_terminating(node_ids[2:])
+        self.assertEqual(store_gets, [launch_id])
+
+        stats = self.core.launch_cache_stats()
+        self.assertEqual(stats['store_gets'], 1)
+        self.assertEqual(stats['hits'], 3)
+        self.assertEqual(stats['size'], 1)
+
+        # writing the launch drops it from the cache, and launches in a
+        # final state are not cached
+        launch_record['state'] = states.FAILED
+        yield self.core._put_launch(launch_record)
+        self.assertEqual(self.core.launch_cache_stats()['size'], 0)
+
+        yield self.core.dump_state(node_ids[:1])
+        yield self.core.dump_state(node_ids[:1])
+        self.assertEqual(store_gets, [launch_id] * 3)
+        self.assertEqual(self.core.launch_cache_stats()['size'], 0)
+
+    @defer.inlineCallbacks
+    def test_launch_cache_bounded(self):
+        self.core.launch_cache.max_size = 8
+        launch_ids = []
+        for i in range(20):
+            launch_record, node_records = make_launch_and_nodes(
+                _new_id(), 1, states.RUNNING)
+            yield self.store.put_launch(launch_record)
+            launch_ids.append(launch_record['launch_id'])
+
+        for launch_id in launch_ids:
+            launch = yield self.core.launch_cache.get(launch_id)
+            self.assertEqual(launch['launch_id'], launch_id)
+            yield self.core.launch_cache.get(launch_ids[0])
+
+        stats = self.core.launch_cache_stats()
+        self.assertTrue(stats['size'] <= 8)
+        self.assertTrue(stats['evictions'] > 0)
+        # the most recently used launch survives eviction
+        self.assertEqual(stats['store_gets'], 20)
+
+    @defer.inlineCallbacks
+    def test_launch_cache_copies(self):
+        launch_record, node_records = make_launch_and_nodes(_new_id(), 1,
+                                                            states.RUNNING)
+        launch_id = launch_record['launch_id']
+        yield self.store.put_launch(launch_record)
+
+        # changes that are never written do not leak into the cache
+        for i in range(2):
+            launch = yield self.core.launch_cache.get(launch_id)
+            self.assertEqual(launch['state'], states.RUNNING)
+            launch['state'] = states.TERMINATING
+            launch['node_ids'].append("unwritten")
+        self.assertEqual(self.core.launch_cache_stats()['hits'], 1)
+
+    @defer.inlineCallbacks
+    def test_launch_cache_invalidate_during_fetch(self):
+        launches = []
+        for i in range(2):
+            launch_record, node_records = make_launch_and_nodes(
+                _new_id(), 1, states.RUNNING)
+            yield self.store.put_launch(launch_record)
+            launches.append(launch_record['launch_id'])
+        fetching, other = launches
+
+        get_launch = self.store.get_launch
+        invalidate = [other]
+        def invalidating_get_launch(launch_id, *args, **kwargs):
+            for launch_id_to_invalidate in invalidate:
+                self.core.launch_cache.invalidate(launch_id_to_invalidate)
+            return get_launch(launch_id, *args, **kwargs)
+        self.store.get_launch = invalidating_get_launch
+
+        # invalidating another launch does not stop this one being cached
+        yield self.core.launch_cache.get(fetching)
+        self.assertIn(fetching, self.core.launch_cache.launches)
+
+        # but invalidating the launch being fetched does
+        self.core.launch_cache.invalidate(fetching)
+        invalidate[:] = [fetching]
+        yield self.core.launch_cache.get(fetching)
+        self.assertNotIn(fetching, self.core.launch_cache.launches)
+        self.assertEqual(self.core.launch_cache.fetches, {})
+
+
+class ContextClientPoolTests(unittest.TestCase):
+
+    def setUp(self):
+        self.clients = []
+        self.pool = ContextClientPool(self._new_client, 2)
+
+    def _new_client(self):
+        client = FakeBrokerClient()
+        self.clients.append(client)
+        return client
+
+    def test_reuse(self):
+        for i in range(5):
+            self.assertEqual(self.pool.call('get_status', 'uri%d' % i),
+                             'uri%d' % i)
+        self.assertEqual(len(self.clients), 1)
+        self.assertEqual(self.clients[0].queried, ['uri%d' % i
+                                                   for i in range(5)])
+        self.assertEqual(self.pool.stats(),
+                         dict(created=1, reused=4, discarded=0, idle=1))
+
+    def test_error_recycles(self):
+        self.pool.call('get_status', 'uri')
+        self.clients[0].error = BrokerError("expected")
+        self.assertRaises(BrokerError, self.pool.call, 'get_status', 'uri')
+
+        # the failed client is not used again
+        self.pool.call('get_status', 'uri')
+        self.assertEqual(len(self.clients), 2)
+        self.assertEqual(len(self.clients[1].queried), 1)
+        self.assertEqual(self.pool.stats(),
+                         dict(created=2, reused=1, discarded=1, idle=1))
+
+    def test_max_idle(self):
+        self.pool.max_idle = 1
+
+        # a call made while another is in progress gets its own client,
+        # but only max_idle clients are kept after
+        def nested_call():
+            self.pool.call('get_status', 'nested')
+        client = self._new_client()
+        client.during_call = nested_call
+        self.pool.idle.append(client)
+
+        self.pool.call('get_status', 'uri')
+        self.assertEqual(len(self.clients), 2)
+        self.assertEqual(self.pool.idle, [self.clients[1]])
+
+
+class FakeBrokerClient(object):
+    def __init__(self):
+        self.error = None
+        self.queried = []
+        self.during_call = None
+
+    def get_status(self, resource):
+        if self.during_call:
+            self.during_call()
+        if self.error:
+            raise self.error
+        self.queried.append(resource)
+        return resource
+
 
 def _one_fake_ctx_node_ok(ip, hostname, pubkey):
     identity = Mock(ip=ip, hostname=hostname, pubkey=pubkey)
@@ -730,17 +1249,22 @@ def _new_id():
     return str(uuid.uuid4())
 
 
-_ONE_NODE_CLUSTER_DOC = """
-<cluster>
+_WORKSPACE = """
   <workspace>
     <name>%s</name>
     <quantity>%d</quantity>
     <image>%s</image>
     <ctx></ctx>
   </workspace>
-</cluster>
 """
 
+_ONE_NODE_CLUSTER_DOC = """
+<cluster>%s</cluster>
+"""
+
+def _get_workspace(name, imagename, quantity=1):
+    return _WORKSPACE % (name, quantity, imagename)
+
 def _get_one_node_cluster_doc(name, imagename, quantity=1):
-    return _ONE_NODE_CLUSTER_DOC % (name, quantity, imagename)
+    return _ONE_NODE_CLUSTER_DOC % _get_workspace(name, imagename, quantity)
     
@@ -1,7 +1,8 @@
 from twisted.internet.task import LoopingCall
 from twisted.internet import defer
 
-from epu.ionproc.provisioner_query import ProvisionerQueryService
+from epu.ionproc.provisioner_query import ProvisionerQueryService, \
+    ACTIVE_QUERY
 from ion.test.iontest import IonTestCase
 
 class TestProvisionerQueryService(IonTestCase):
@@ -50,6 +51,27 @@ class TestProvisionerQueryService(IonTestCase):
         query.query()
         self.assertTrue(self.query_called)
 
+    @defer.inlineCallbacks
+    def test_tick(self):
+        query = ProvisionerQueryService(spawnargs={"interval_seconds": 5.0,
+                                                   "full_interval_seconds": 60.0})
+        yield self._spawn_process(query)
+
+        requests = []
+        def fake_query(request=None):
+            requests.append(request)
+            return defer.succeed(None)
+        self.patch(query.client, "query", fake_query)
+
+        # the first tick is a full query, then only booting nodes
+        for i in range(3):
+            yield query.tick()
+        self.assertEqual(requests, [None, ACTIVE_QUERY, ACTIVE_QUERY])
+
+        query.last_full_query -= 60.0
+        yield query.tick()
+        self.assertEqual(requests[-1], None)
+
     @defer.inlineCallbacks
     def tearDown(self):
         yield self._shutdown_processes()
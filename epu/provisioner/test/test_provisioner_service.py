@@ -110,6 +110,38 @@ class ProvisionerConfigTest(unittest.TestCase):
         self.assertEqual(ec2_west.key, 'myec2key')
 
 
+class ProvisionerNotifierTest(unittest.TestCase):
+
+    def setUp(self):
+        self.sent = []
+        self.notifier = provisioner.ProvisionerNotifier(self,
+            batch_subscribers=["batched"])
+
+    def send(self, name, operation, content):
+        self.sent.append((name, operation, content))
+        return defer.succeed(None)
+
+    @defer.inlineCallbacks
+    def test_send_records(self):
+        records = [dict(node_id=_new_id(), state=states.STARTED)
+                   for i in range(3)]
+        yield self.notifier.send_records(records, ["batched", "old"])
+
+        batched = [m for m in self.sent if m[0] == "batched"]
+        self.assertEqual(len(batched), 1)
+        self.assertEqual(batched[0][1], "instance_states")
+        self.assertEqual(batched[0][2], {'records': records})
+
+        old = [m for m in self.sent if m[0] == "old"]
+        self.assertEqual(len(old), 3)
+        self.assertEqual([m[1] for m in old], ["instance_state"] * 3)
+        self.assertEqual([m[2] for m in old], records)
+
+        self.sent[:] = []
+        yield self.notifier.send_records([], ["batched", "old"])
+        self.assertEqual(self.sent, [])
+
+
 class BaseProvisionerServiceTests(IonTestCase):
 
     def __init__(self, *args, **kwargs):
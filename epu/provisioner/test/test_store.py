@@ -8,6 +8,7 @@
 
 import uuid
 
+import simplejson as json
 from twisted.internet import defer
 from twisted.trial import unittest
 from ion.test.iontest import IonTestCase
@@ -15,9 +16,10 @@ from epu.cassandra import CassandraSchemaManager
 import epu.cassandra as cassandra
 
 from epu.provisioner.store import CassandraProvisionerStore, \
-    ProvisionerStore, group_records
+    ProvisionerStore, IndexedProvisionerStore, group_records
 from epu import states
 from epu.test import cassandra_test
+from epu.provisioner.test.util import FakeCassandraClient
 
 import ion.util.ionlog
 log = ion.util.ionlog.getLogger(__name__)
@@ -111,6 +113,24 @@ class BaseProvisionerStoreTests(unittest.TestCase):
         for l in at_most_pending:
             self.assertTrue(l['launch_id'] in (launch_id_1, launch_id_2))
 
+    @defer.inlineCallbacks
+    def test_get_nodes_by_ids(self):
+        node_ids = list((yield self.put_many_nodes(5, states.REQUESTED,
+                                                   states.PENDING)))
+        unknown_id = new_id()
+
+        nodes = yield self.store.get_nodes_by_ids([])
+        self.assertEqual(nodes, [])
+
+        request_ids = node_ids[:2] + [unknown_id] + node_ids[2:]
+        nodes = yield self.store.get_nodes_by_ids(request_ids)
+        self.assertEqual(len(nodes), 6)
+        self.assertEqual(nodes[2], None)
+        for node_id, node in zip(request_ids, nodes):
+            if node_id != unknown_id:
+                self.assertEqual(node['node_id'], node_id)
+                self.assertEqual(node['state'], states.PENDING)
+
     @defer.inlineCallbacks
     def put_node(self, node_id, *states):
         for state in states:
@@ -211,6 +231,227 @@ class CassandraProvisionerStoreTests(BaseProvisionerStoreTests):
         self.assertNodesInSet(nodes, requested, pending, running)
 
 
+class IndexedProvisionerStoreTests(BaseProvisionerStoreTests):
+    """Runs same tests as BaseProvisionerStoreTests but indexed backend
+    """
+    def setUp(self):
+        self.store = IndexedProvisionerStore()
+
+    @defer.inlineCallbacks
+    def test_records_are_copies(self):
+        node = {'node_id' : new_id(), 'state' : states.REQUESTED,
+                'tags' : ['a']}
+        yield self.store.put_node(node)
+        node['state'] = states.RUNNING
+        node['tags'].append('b')
+
+        stored = yield self.store.get_node(node['node_id'])
+        self.assertEqual(stored['state'], states.REQUESTED)
+        self.assertEqual(stored['tags'], ['a'])
+
+        stored['state'] = states.FAILED
+        stored = yield self.store.get_node(node['node_id'])
+        self.assertEqual(stored['state'], states.REQUESTED)
+
+    @defer.inlineCallbacks
+    def test_state_index(self):
+        node_ids = yield self.put_many_nodes(10, states.REQUESTED,
+                                             states.PENDING, states.REQUESTED)
+        index = self.store.nodes.state_index
+        self.assertEqual(index.keys(), [states.PENDING])
+        self.assertEqual(index[states.PENDING], node_ids)
+
+        yield self.put_many_nodes(5, states.TERMINATED)
+        nodes = yield self.store.get_nodes(max_state=states.TERMINATING)
+        self.assertEqual(len(nodes), 10)
+        self.assertNodesInSet(nodes, node_ids)
+
+
+class FakeClientCassandraProvisionerStoreTests(BaseProvisionerStoreTests):
+    """Runs same tests as BaseProvisionerStoreTests against the Cassandra
+    store, but with an in-memory stand-in for the telephus client
+    """
+
+    def setUp(self):
+        self.store = CassandraProvisionerStore("localhost", 9160, "user",
+                                               "pass", "keyspace",
+                                               batch_size=10)
+        self.client = FakeCassandraClient()
+        self.store.client = self.client
+
+    @defer.inlineCallbacks
+    def test_put_nodes_batched(self):
+        launch_id = new_id()
+        nodes = [{'node_id' : new_id(), 'launch_id' : launch_id,
+                  'state' : states.REQUESTED} for i in range(24)]
+        launch = {'launch_id' : launch_id, 'state' : states.REQUESTED,
+                  'node_ids' : [node['node_id'] for node in nodes]}
+
+        # 25 rows with a batch size of 10, records then index for each
+        yield self.store.put_nodes(nodes, launch=launch)
+        self.assertEqual(self.client.calls.get('batch_mutate'), 6)
+        self.assertNotIn('insert', self.client.calls)
+
+        latest = yield self.store.get_launch(launch_id)
+        self.assertEqual(latest['state'], states.REQUESTED)
+        all_nodes = yield self.store.get_nodes(state=states.REQUESTED)
+        self.assertNodesInSet(all_nodes, launch['node_ids'])
+        self.assertEqual(len(all_nodes), 24)
+
+        # older states must not hide newer ones
+        for node in nodes:
+            node['state'] = states.PENDING
+        yield self.store.put_nodes(nodes)
+        for node in nodes:
+            node['state'] = states.REQUESTED
+        yield self.store.put_nodes(nodes)
+
+        pending = yield self.store.get_nodes(state=states.PENDING)
+        self.assertEqual(len(pending), 24)
+        records = yield self.store.get_node(nodes[0]['node_id'], count=2)
+        self.assertEqual([r['state'] for r in records],
+                         [states.PENDING, states.REQUESTED])
+
+    def _get_index_row(self, state):
+        index = self.client.column_families[self.store._node_state_column_family]
+        return set(index.get(state, {}).keys())
+
+    @defer.inlineCallbacks
+    def test_state_index(self):
+        running = yield self.put_many_nodes(5, states.REQUESTED,
+                                            states.PENDING, states.RUNNING)
+        terminated = yield self.put_many_nodes(20, states.REQUESTED,
+                                               states.RUNNING,
+                                               states.TERMINATED)
+
+        self.assertEqual(self._get_index_row(states.RUNNING), running)
+        self.assertEqual(self._get_index_row(states.TERMINATED), terminated)
+        self.assertFalse(self._get_index_row(states.REQUESTED))
+        self.assertFalse(self._get_index_row(states.PENDING))
+
+        # only the live records should be fetched
+        self.client.calls.clear()
+        nodes = yield self.store.get_nodes(max_state=states.TERMINATING)
+        self.assertEqual(len(nodes), 5)
+        self.assertNodesInSet(nodes, running)
+        self.assertEqual(self.client.calls['multiget_slice'], 1)
+        self.assertNotIn('get_range_slices', self.client.calls)
+
+    @defer.inlineCallbacks
+    def test_get_nodes_by_ids_paged(self):
+        node_ids = yield self.put_many_nodes(250, states.RUNNING)
+
+        self.client.calls.clear()
+        nodes = yield self.store.get_nodes_by_ids(list(node_ids))
+        self.assertNodesInSet(nodes, node_ids)
+        self.assertEqual(len(nodes), 250)
+        self.assertEqual(self.client.calls, {'multiget_slice' : 3})
+
+    @defer.inlineCallbacks
+    def test_state_index_stale(self):
+        # an out of order write leaves the node in an old index row
+        node_ids = yield self.put_many_nodes(3, states.PENDING,
+                                             states.REQUESTED)
+        self.assertEqual(self._get_index_row(states.REQUESTED), node_ids)
+        self.assertEqual(self._get_index_row(states.PENDING), node_ids)
+
+        nodes = yield self.store.get_nodes(state=states.REQUESTED)
+        self.assertEqual(len(nodes), 0)
+        self.assertFalse(self._get_index_row(states.REQUESTED))
+
+        nodes = yield self.store.get_nodes(max_state=states.PENDING)
+        self.assertEqual(len(nodes), 3)
+        self.assertNodesInSet(nodes, node_ids)
+
+    @defer.inlineCallbacks
+    def test_state_index_write_failure(self):
+        node_ids = yield self.put_many_nodes(3, states.PENDING)
+
+        # the records are written but their index update is lost
+        put_index = self.store._put_index
+        def fail_put_index(rows):
+            raise Exception("index write failed")
+        self.store._put_index = fail_put_index
+        nodes = [{'node_id' : node_id, 'state' : states.RUNNING}
+                 for node_id in node_ids]
+        try:
+            yield self.store.put_nodes(nodes)
+        except Exception:
+            pass
+        else:
+            self.fail("Expected put_nodes to fail")
+        self.store._put_index = put_index
+
+        # the index never points at a state the records did not reach
+        self.assertFalse(self._get_index_row(states.RUNNING))
+        self.assertEqual(self._get_index_row(states.PENDING), node_ids)
+
+        # a query that finds them under their old state repairs the index
+        nodes = yield self.store.get_nodes(max_state=states.RUNNING)
+        self.assertEqual(len(nodes), 3)
+        self.assertEqual(self._get_index_row(states.RUNNING), node_ids)
+        self.assertFalse(self._get_index_row(states.PENDING))
+
+    @defer.inlineCallbacks
+    def test_state_index_final_ttl(self):
+        running = yield self.put_many_nodes(2, states.RUNNING)
+        terminated = yield self.put_many_nodes(2, states.RUNNING,
+                                               states.TERMINATED)
+
+        index = self.store._node_state_column_family
+        ttl = self.store._final_state_index_ttl
+        for node_id in terminated:
+            self.assertEqual(self.client.ttls[(index, states.TERMINATED,
+                                               node_id)], ttl)
+        for node_id in running:
+            self.assertNotIn((index, states.RUNNING, node_id),
+                             self.client.ttls)
+
+        # the records themselves do not expire
+        self.assertFalse([key for key in self.client.ttls
+                          if key[0] != index])
+
+    @defer.inlineCallbacks
+    def test_rebuild_state_index(self):
+        # records written before there was a state index
+        node_ids = set()
+        for i in range(3):
+            node = {'node_id' : new_id(), 'state' : states.RUNNING}
+            node_ids.add(node['node_id'])
+            yield self.client.insert(node['node_id'],
+                                     self.store._node_column_family,
+                                     json.dumps(node), column=node['state'])
+
+        nodes = yield self.store.get_nodes()
+        self.assertEqual(len(nodes), 0)
+
+        self.client.calls.clear()
+        yield self.store.rebuild_state_index()
+        nodes = yield self.store.get_nodes(state=states.RUNNING)
+        self.assertEqual(len(nodes), 3)
+        self.assertNodesInSet(nodes, node_ids)
+
+        # only the index was written
+        self.assertEqual(self.client.calls['batch_mutate'], 1)
+
+    @defer.inlineCallbacks
+    def test_assure_state_index(self):
+        # a record written before there was a state index
+        node = {'node_id' : new_id(), 'state' : states.RUNNING}
+        yield self.client.insert(node['node_id'],
+                                 self.store._node_column_family,
+                                 json.dumps(node), column=node['state'])
+
+        yield self.store.assure_state_index()
+        nodes = yield self.store.get_nodes()
+        self.assertEqual(nodes, [node])
+
+        # the index is only built once
+        self.client.calls.clear()
+        yield self.store.assure_state_index()
+        self.assertEqual(self.client.calls, {'get_slice' : 1})
+
+
 class GroupRecordsTests(IonTestCase):
 
     def test_group_records(self):
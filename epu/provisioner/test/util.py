@@ -7,11 +7,15 @@
 @brief Provisioner testing fixtures and utils
 """
 import uuid
+import time
+import threading
 from libcloud.compute.base import NodeDriver, Node, NodeSize
 from libcloud.compute.types import NodeState
 from nimboss.ctx import ContextResource
+from telephus.cassandra.ttypes import Column, ColumnOrSuperColumn, \
+    KeySlice, Deletion
 
-from twisted.internet import defer
+from twisted.internet import defer, reactor
 
 import ion.util.procutils as pu
 
@@ -128,14 +132,34 @@ class FakeProvisionerNotifier(object):
 class FakeNodeDriver(NodeDriver):
     
     type = 42 # libcloud uses a driver type number in id generation.
-    def __init__(self):
+    def __init__(self, latency=None, batch_destroy=False):
         self.created = []
         self.destroyed = []
         self.running = {}
         self.create_node_error = None
+        self.list_nodes_error = None
+        self.destroy_node_error = None
         self.sizes = [NodeSize("m1.small", "small", 256, 200, 1000, 1.0, self)]
 
+        # seconds each IaaS call blocks for, to simulate a remote cloud
+        self.latency = latency
+
+        # count of IaaS calls, by method name
+        self.calls = {}
+        self._calls_lock = threading.Lock()
+
+        # only some drivers can terminate many instances in one request
+        if batch_destroy:
+            self.ex_destroy_nodes = self._destroy_nodes
+
+    def _call(self, name):
+        with self._calls_lock:
+            self.calls[name] = self.calls.get(name, 0) + 1
+        if self.latency:
+            time.sleep(self.latency)
+
     def create_node(self, **kwargs):
+        self._call('create_node')
         if self.create_node_error:
             raise self.create_node_error
         count = int(kwargs['ex_mincount']) if 'ex_mincount' in kwargs else 1
@@ -154,10 +178,24 @@ class FakeNodeDriver(NodeDriver):
             self.set_node_running(iaas_id)
 
     def destroy_node(self, node):
+        self._call('destroy_node')
+        if self.destroy_node_error:
+            raise self.destroy_node_error
         self.destroyed.append(node)
         self.running.pop(node.id, None)
 
+    def _destroy_nodes(self, nodes):
+        self._call('ex_destroy_nodes')
+        if self.destroy_node_error:
+            raise self.destroy_node_error
+        for node in nodes:
+            self.destroyed.append(node)
+            self.running.pop(node.id, None)
+
     def list_nodes(self):
+        self._call('list_nodes')
+        if self.list_nodes_error:
+            raise self.list_nodes_error
         return self.running.values()
 
     def list_sizes(self):
@@ -165,7 +203,10 @@ class FakeNodeDriver(NodeDriver):
 
 
 class FakeContextClient(object):
-    def __init__(self):
+    def __init__(self, latency=None):
+        # seconds before each query result is delivered, to simulate a
+        # remote broker
+        self.latency = latency
         self.nodes = []
         self.expected_count = 0
         self.complete = False
@@ -196,9 +237,114 @@ class FakeContextClient(object):
             return defer.fail(self.uri_query_error[uri])
         response = Mock(nodes=self.nodes, expected_count=self.expected_count,
         complete=self.complete, error=self.error)
+        if self.latency:
+            d = defer.Deferred()
+            reactor.callLater(self.latency, d.callback, response)
+            return d
         return defer.succeed(response)
 
 
+class FakeCassandraClient(object):
+    """Stand-in for a telephus CassandraClient, for tests and benchmarks
+
+    Keeps column families in memory and counts calls by operation name.
+    If latency is set, results are delivered that many seconds later via the
+    reactor, to simulate a round trip to a remote Cassandra.
+    """
+    def __init__(self, latency=None):
+        self.latency = latency
+        self.column_families = {}
+        self.calls = {}
+
+        # Key: (column family, row key, column name)
+        # Value: TTL the column was last written with
+        self.ttls = {}
+
+    def _result(self, operation, result):
+        self.calls[operation] = self.calls.get(operation, 0) + 1
+        if self.latency:
+            d = defer.Deferred()
+            reactor.callLater(self.latency, d.callback, result)
+            return d
+        return defer.succeed(result)
+
+    def _row(self, key, column_family):
+        return self.column_families.setdefault(column_family, {}).setdefault(
+            key, {})
+
+    def insert(self, key, column_family, value, column, **kwargs):
+        self._row(key, column_family)[column] = value
+        return self._result('insert', None)
+
+    def batch_mutate(self, mutationmap, **kwargs):
+        for key, cfmap in mutationmap.iteritems():
+            for column_family, mutations in cfmap.iteritems():
+                row = self._row(key, column_family)
+                if isinstance(mutations, dict):
+                    row.update(mutations)
+                    continue
+                # deletions win over inserts within a single batch, as they
+                # do in Cassandra when timestamps are equal
+                for mutation in mutations:
+                    if isinstance(mutation, Column):
+                        row[mutation.name] = mutation.value
+                        if mutation.ttl:
+                            self.ttls[(column_family, key, mutation.name)] = \
+                                mutation.ttl
+                for mutation in mutations:
+                    if isinstance(mutation, Deletion):
+                        for name in mutation.predicate.column_names:
+                            row.pop(name, None)
+        return self._result('batch_mutate', None)
+
+    def get_slice(self, key, column_family, start='', finish='', count=100,
+                  reverse=False, **kwargs):
+        row = self.column_families.get(column_family, {}).get(key, {})
+        columns = _slice_columns(row, start, finish, count, reverse)
+        return self._result('get_slice', columns)
+
+    def multiget_slice(self, keys, column_family, start='', finish='',
+                       count=100, reverse=False, **kwargs):
+        rows = self.column_families.get(column_family, {})
+        result = {}
+        for key in keys:
+            result[key] = _slice_columns(rows.get(key, {}), start, finish,
+                                         count, reverse)
+        return self._result('multiget_slice', result)
+
+    def get_range_slices(self, column_family, start='', finish='',
+                         column_start='', column_finish='', count=100,
+                         column_count=100, reverse=False, **kwargs):
+        rows = self.column_families.get(column_family, {})
+        slices = []
+        for key in sorted(rows):
+            if start and key < start:
+                continue
+            if finish and key > finish:
+                break
+            columns = _slice_columns(rows[key], column_start, column_finish,
+                                     column_count, reverse)
+            slices.append(KeySlice(key=key, columns=columns))
+            if len(slices) == count:
+                break
+        return self._result('get_range_slices', slices)
+
+
+def _slice_columns(row, start, finish, count, reverse):
+    names = sorted(row, reverse=reverse)
+    if reverse:
+        start, finish = finish, start
+    columns = []
+    for name in names:
+        if (start and name < start) or (finish and name > finish):
+            continue
+        column = Column(name=name, value=row[name], timestamp=0)
+        columns.append(ColumnOrSuperColumn(column=column))
+        if len(columns) == count:
+            break
+    return columns
+
+
 def new_id():
     return str(uuid.uuid4())
 
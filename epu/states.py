@@ -32,3 +32,7 @@ TERMINATED = '800-TERMINATED'
 
 FAILED = '900-FAILED'
 """Instance has failed and will not be retried"""
+
+ALL_STATES = (REQUESTING, REQUESTED, ERROR_RETRYING, PENDING, STARTED, RUNNING,
+              RUNNING_FAILED, TERMINATING, TERMINATED, FAILED)
+"""All instance states, in order"""
@@ -48,3 +48,32 @@ def cassandra_test(func):
         return f
     
     return func
+
+
+def run_benchmarks(*benchmarks):
+    """Runs benchmark functions in order under a reactor, then stops it
+
+    Each benchmark is called with no arguments and may return a Deferred.
+    Results are expected to be printed by the benchmarks themselves. Meant
+    to be called from the __main__ block of a benchmark module.
+    """
+    from twisted.internet import defer, reactor
+
+    @defer.inlineCallbacks
+    def run():
+        try:
+            for benchmark in benchmarks:
+                yield benchmark()
+        finally:
+            reactor.stop()
+
+    reactor.callWhenRunning(run)
+    reactor.run()
+
+
+def print_benchmark(name, count, elapsed, unit="ops"):
+    """Prints a single benchmark result line
+    """
+    rate = count / elapsed if elapsed else float('inf')
+    print "%-50s %8d %s in %8.3fs (%10.1f %s/s)" % (name, count, unit,
+                                                   elapsed, rate, unit)